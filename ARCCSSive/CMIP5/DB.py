@@ -20,19 +20,31 @@ limitations under the License.
 from __future__ import print_function
 
 import os
-
-from sqlalchemy import create_engine, func, select, and_
-from sqlalchemy.orm import sessionmaker
-
-from ARCCSSive.CMIP5.Model import Base, Instance
-
-SQASession = sessionmaker()
+import json
+import struct
+import binascii
+import hashlib
+import threading
+import sqlite3
+import shutil
+import glob
+from collections import OrderedDict
+
+from sqlalchemy import create_engine, event, func, select, and_, or_, case, literal, distinct
+from sqlalchemy.orm import sessionmaker, selectinload
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import StaticPool
+from six.moves.urllib.request import pathname2url
+
+from ARCCSSive.CMIP5.Model import Base, Instance, Version
+from ARCCSSive.CMIP5.other_functions import constraint_values, experiment_families
 
 class Session(object):
     """Holds a connection to the catalog
 
     Create using :func:`ARCCSSive.CMIP5.connect()`
     """
+    _facets = None
 
     def query(self, *args, **kwargs):
         """Query the CMIP5 catalog
@@ -60,50 +72,359 @@ class Session(object):
 
         :return: A list of strings
         """
-        return [x[0] for x in self.query(Instance.model).distinct().all()]
+        return list(self.facets()['model'])
 
     def experiments(self):
         """ Get the list of all experiments in the dataset
 
         :return: A list of strings
         """
-        return [x[0] for x in self.query(Instance.experiment).distinct().all()]
+        return list(self.facets()['experiment'])
 
     def variables(self):
         """ Get the list of all variables in the dataset
 
         :return: A list of strings
         """
-        return [x[0] for x in self.query(Instance.variable).distinct().all()]
+        return list(self.facets()['variable'])
 
     def mips(self):
         """ Get the list of all MIP tables in the dataset
 
         :return: A list of strings
         """
-        return [x[0] for x in self.query(Instance.mip).distinct().all()]
+        return list(self.facets()['mip'])
+
+    def facets(self):
+        """ Get all the values of each facet in the dataset, with the number of
+        instances having that value
+
+        The catalogue is read with a single query the first time, then kept
+        in memory and in a cache file under :func:`cache_dir()` until the
+        database file changes. Databases that aren't SQLite files are
+        read every time.
+
+        :return: A dictionary {facet: {value: count}} for the facets in
+            :data:`facet_names`
+
+        .. testsetup::
+
+            >>> cmip5  = getfixture('session')
+
+        >>> cmip5.facets()['mip']['cfMon']
+        2
+        """
+        stamp = _catalogue_stamp(self.session.get_bind())
+        if stamp is None:
+            return self._query_facets()
+        if self._facets is None or self._facets[0] != stamp:
+            cachefile = os.path.join(cache_dir(), 'facets',
+                    hashlib.md5(stamp[0].encode('utf-8')).hexdigest() + '.json')
+            facets = _read_facet_cache(cachefile, stamp)
+            if facets is None:
+                facets = self._query_facets()
+                _write_facet_cache(cachefile, stamp, facets)
+            self._facets = (stamp, facets)
+        return self._facets[1]
+
+    def facet_counts(self, **kwargs):
+        """ Count the instances for each value of every facet matching a query
+
+        Arguments are the same as :func:`outputs()`. Each facet is counted
+        with all the constraints except its own, so the counts show both the
+        alternatives to the values already selected and the values still
+        available for the other facets. All facets are counted with a single
+        query.
+
+        :return: A dictionary {facet: {value: count}} for the facets in
+            :data:`facet_names`
+
+        .. testsetup::
+
+            >>> cmip5  = getfixture('session')
+
+        >>> counts = cmip5.facet_counts(model='MIROC5', experiment='rcp45')
+        >>> counts['variable'] == {'a': 1, 'tas': 1}
+        True
+        >>> counts['model'] == {'ACCESS1-3': 1, 'MIROC5': 2}
+        True
+        """
+        return self._query_facets(**kwargs)
 
-    def outputs(self, **kwargs):
+    def _query_facets(self, **kwargs):
+        """
+        Count the instances for each value of every facet, filtering each
+        facet by the constraints on the other facets
+        """
+        queries = []
+        for name in facet_names:
+            column = getattr(Instance, name)
+            query = self.query(literal(name).label('facet'),
+                               column.label('value'),
+                               func.count(Instance.id).label('count'))
+            for key, value in kwargs.items():
+                if key != name:
+                    query = query.filter(_constraint(key, value))
+            queries.append(query.group_by(column))
+        facets = OrderedDict((name, OrderedDict()) for name in facet_names)
+        for name, value, count in sorted(queries[0].union_all(*queries[1:]).all(),
+                                         key=lambda x: (x[0], x[1] is None, x[1])):
+            facets[name][value] = count
+        return facets
+
+    def outputs(self, load=None, **kwargs):
         """ Get the most recent instances matching a query
 
-        Arguments are optional, using them will select only matching outputs
+        Arguments are optional, using them will select only matching outputs.
+        Each argument can also be a list of values, matching any of them, to
+        search for all their combinations with a single query. The experiment
+        families `'decadal'` and `'noVolc'` match all the experiments starting
+        with those names. Use
+        :func:`ARCCSSive.CMIP5.other_functions.group_by_constraints()` to
+        split the results by combination.
 
         :argument variable: CMIP variable name
         :argument experiment: CMIP experiment
         :argument mip: MIP table
         :argument model: Model used to generate the dataset
         :argument ensemble: Ensemble member
+        :argument load: Relationships to load together with the instances,
+            one of `'versions'`, `'versions+files'`, `'versions+warnings'` or
+            `'versions+files+warnings'`. Each relationship is loaded with one
+            extra query for all results, instead of one query per object
+            when first accessed
 
         :return: An iterable sequence of :class:`ARCCSSive.CMIP5.Model.Instance`
+
+        .. testsetup::
+
+            >>> cmip5  = getfixture('session')
+
+        >>> outputs = cmip5.outputs(mip='cfMon', load='versions+files')
+        >>> len(outputs.first().versions)
+        2
+        >>> cmip5.outputs(model=['c', 'MIROC5'], mip=['cfMon', 'Amon']).count()
+        3
         """
-        return self.query(Instance).filter_by(**kwargs)
+        query = self.query(Instance)
+        for key, value in kwargs.items():
+            query = query.filter(_constraint(key, value))
+        if load is not None:
+            query = query.options(*_load_options(load))
+        return query
+
+    def complete_ensembles(self, variables, load=None, **kwargs):
+        """ Get the ensembles that have all of a list of variables
+
+        Finds the model, experiment, MIP table and ensemble combinations
+        having an instance for each of the variables, with a single query
+
+        :argument variables: List of CMIP variable names that must all be present
+        :argument load: Relationships to load, as in :func:`outputs()`
+        :argument **kwargs: Other constraints, as in :func:`outputs()`
+
+        :return: A SQLAlchemy query returning (:class:`ARCCSSive.CMIP5.Model.Instance`,
+            :class:`ARCCSSive.CMIP5.Model.Version`) pairs for all the variables
+            of the complete ensembles, with a None version for instances that
+            have no versions
+
+        .. testsetup::
+
+            >>> import six
+            >>> cmip5  = getfixture('session')
+
+        >>> for o, v in cmip5.complete_ensembles(['tas'], experiment='rcp45', mip='Amon'):
+        ...     six.print_(o.model, o.ensemble, o.variable, v.version)
+        ACCESS1-3 r1i1p1 tas v20130507
+        """
+        variables = list(set(variables))
+        keys = [Instance.model, Instance.experiment, Instance.mip, Instance.ensemble]
+        complete = self.outputs(variable=variables, **kwargs) \
+                .with_entities(*keys) \
+                .group_by(*keys) \
+                .having(func.count(distinct(Instance.variable)) == len(variables)) \
+                .subquery()
+        return self.outputs(variable=variables, load=load, **kwargs) \
+                .join(complete, and_(*[k == complete.c[k.key] for k in keys])) \
+                .outerjoin(Instance.versions) \
+                .add_entity(Version) \
+                .order_by(*(keys + [Instance.variable, Version.version]))
+
+    def latest_outputs(self, **kwargs):
+        """ Get the latest versions of the instances matching a query
+
+        Selects the same versions as :func:`Model.Instance.latest()`, but
+        for all matching instances in a single query rather than loading
+        every version of every instance
+
+        Arguments are the same as :func:`outputs()`
+
+        :return: A SQLAlchemy query returning (:class:`ARCCSSive.CMIP5.Model.Instance`,
+            :class:`ARCCSSive.CMIP5.Model.Version`) pairs, instances with
+            more than one latest version appear once for each of them, in
+            the order :func:`Model.Instance.latest()` lists them
+
+        .. testsetup::
+
+            >>> import six
+            >>> cmip5  = getfixture('session')
+
+        >>> for o, v in cmip5.latest_outputs(variable='a', model='c'):
+        ...     six.print_(o.mip, v.version)
+        6hrLev v20120101
+        """
+        date = _version_date(Version.version)
+        stats = self.query(
+                Version.instance_id.label('instance_id'),
+                func.count(Version.id).label('nversions'),
+                func.sum(case((Version.is_latest == True, 1), else_=0)).label('nlatest'),
+                func.max(case((Version.version != 'NA', date))).label('date'),
+                ).group_by(Version.instance_id).subquery()
+        newest = and_(stats.c.nversions > 1, stats.c.nlatest == 0, stats.c.date != None)
+
+        # Same rules as Instance.latest(): a single version, else any flagged
+        # is_latest, else the newest date stamp, else all undefined versions
+        return self.outputs(**kwargs) \
+                .join(Instance.versions) \
+                .join(stats, stats.c.instance_id == Instance.id) \
+                .add_entity(Version) \
+                .filter(or_(
+                    stats.c.nversions == 1,
+                    and_(stats.c.nlatest > 0, Version.is_latest == True),
+                    and_(stats.c.nlatest == 0, stats.c.date == None),
+                    and_(stats.c.nlatest == 0, Version.version != 'NA', date == stats.c.date),
+                    )) \
+                .order_by(Instance.id,
+                    # versions sharing the newest date in reverse order, as latest() lists them
+                    case((newest, Version.version)).desc(),
+                    case((newest, Version.id)).desc(),
+                    Version.version, Version.id)
+
+def _catalogue_stamp(engine):
+    """
+    Identify the current state of a SQLite database file, None for other databases
+    """
+    url = engine.url
+    if not url.drivername.startswith('sqlite') or _is_memory(url):
+        return None
+    path = os.path.abspath(url.database)
+    if not os.path.exists(path):
+        return [path]
+    return [path] + _sqlite_stamp(path)
+
+def _sqlite_stamp(path):
+    """
+    Identify the committed content of a SQLite file by the file change counter
+    in its header, incremented by every transaction, and for databases in WAL
+    mode by the salts and size of the write-ahead log, which every commit
+    changes as the counter isn't updated until a checkpoint
+    """
+    with open(path, 'rb') as f:
+        header = f.read(28)
+    stamp = [struct.unpack('>I', header[24:28])[0] if len(header) == 28 else 0]
+    wal = path + '-wal'
+    try:
+        with open(wal, 'rb') as f:
+            salts = f.read(24)[16:24]
+        stamp.extend([binascii.hexlify(salts).decode('ascii'), os.path.getsize(wal)])
+    except (IOError, OSError):
+        pass
+    return stamp
+
+def _read_facet_cache(cachefile, stamp):
+    """
+    Read the facets saved by :func:`_write_facet_cache()`, None if missing or out of date
+    """
+    try:
+        with open(cachefile) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if cache.get('stamp') != stamp:
+        return None
+    return OrderedDict((name, OrderedDict((v, c) for v, c in cache['facets'][name]))
+                       for name in facet_names)
+
+def _write_facet_cache(cachefile, stamp, facets):
+    """
+    Save the facets to a cache file, skipped if the cache directory isn't writable
+    """
+    cache = {'stamp': stamp,
+             'facets': dict((name, list(values.items())) for name, values in facets.items())}
+    try:
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            os.makedirs(os.path.dirname(cachefile))
+        tmpfile = '%s.%d'%(cachefile, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError):
+        pass
+
+def _constraint(key, value):
+    """
+    Build the filter for one :func:`Session.outputs()` argument
+    """
+    column = getattr(Instance, key)
+    values = constraint_values(value)
+    families = [v for v in values if key == 'experiment' and v in experiment_families]
+    exact = [v for v in values if v not in families]
+    clauses = [column.like(v + '%') for v in families]
+    if len(exact) == 1:
+        clauses.append(column == exact[0])
+    elif len(exact) > 1 or not clauses:
+        clauses.append(column.in_(exact))
+    return or_(*clauses)
+
+def _load_options(load):
+    """
+    Convert a loading profile for :func:`Session.outputs()` into eager loading options
+    """
+    relations = load.split('+')
+    if relations[0] != 'versions' or not set(relations[1:]).issubset(['files', 'warnings']):
+        raise ValueError("Unknown loading profile '%s'"%load)
+    versions = selectinload(Instance.versions)
+    return [versions] + [versions.selectinload(getattr(Version, r)) for r in relations[1:]]
+
+def _version_date(version):
+    """
+    SQL equivalent of `version[-8:]`, the date stamp used to order versions
+    """
+    return case((func.length(version) > 8, func.substr(version, func.length(version) - 7)),
+                else_=version)
+
+# Instance attributes listed by Session.facets()
+facet_names = ['model', 'experiment', 'mip', 'variable', 'ensemble', 'realm']
+
+def cache_dir():
+    """
+    Directory for local caches of catalogue information, set with the
+    environment variable `ARCCSSIVE_CACHE`, default `~/.cache/arccssive`
+    """
+    return os.environ.get('ARCCSSIVE_CACHE',
+            os.path.join(os.path.expanduser('~'), '.cache', 'arccssive'))
 
 # Default CMIP5 database
 default_db = 'sqlite:////g/data1/ua6/unofficial-ESG-replica/tmp/tree/cmip5_raijin_latest.db'
 
-def connect(path = None):
+def connect(path = None, create = True, readonly = False, snapshot = None):
     """Connect to the CMIP5 catalog
 
+    Connections to the same database share a single engine and its pool
+    of connections, so connecting again is cheap
+
+    :argument path: Database URL, default from the environment variable
+        `CMIP5_DB` or :data:`default_db`
+    :argument create: Create any missing tables, set to False for
+        read-only catalogues
+    :argument readonly: Open a SQLite catalogue file as read-only and
+        immutable, without any locking, and memory map it. Any attempt to
+        write to the database will fail.
+    :argument snapshot: Read a local copy of a SQLite catalogue file,
+        made by :func:`local_snapshot()`. Either a directory for the copy,
+        e.g. `os.environ['TMPDIR']` for node-local storage in a batch
+        job, or True to use the default directory. Implies `readonly`.
+
     :return: A new :py:class:`Session`
 
     Example::
@@ -117,11 +438,174 @@ def connect(path = None):
         # Get the path from the environment
         path = os.environ.get('CMIP5_DB', default_db)
 
-    engine = create_engine(path)
-    Base.metadata.create_all(engine)
-    SQASession.configure(bind=engine, autoflush=False)
+    if snapshot:
+        url = make_url(path)
+        if not url.drivername.startswith('sqlite') or _is_memory(url):
+            raise ValueError("Snapshots need a SQLite database file, not '%s'"%str(url))
+        source = os.path.abspath(url.database)
+        path = 'sqlite:///' + local_snapshot(url.database,
+                                             None if snapshot is True else snapshot)
+        # Registered by source so a refreshed snapshot replaces the engine of the old one
+        engine = _get_engine(path, False, True, key=('snapshot', source))
+    else:
+        engine = _get_engine(path, create and not readonly, readonly)
 
     connection = Session()
-    connection.session = SQASession()
+    connection.session = sessionmaker(bind=engine, autoflush=False)()
     return connection
 
+def local_snapshot(dbfile, directory = None):
+    """Copy a SQLite catalogue file to local storage
+
+    The copy is named after the source file path and the state of its
+    content, see :func:`_sqlite_stamp()`, so processes on the same node
+    share it for as long as the source is unchanged. A changed source is
+    copied again to a temporary file with the SQLite backup API, which
+    includes the transactions still in the write-ahead log, and renamed
+    into place, then older copies are removed, processes still reading
+    them keep their open files.
+
+    :argument dbfile: Path to the SQLite database file
+    :argument directory: Directory for the copy, default `snapshots` under
+        :func:`cache_dir()`
+
+    :return: Path to the local copy
+    """
+    if directory is None:
+        directory = os.path.join(cache_dir(), 'snapshots')
+    source = os.path.abspath(dbfile)
+    prefix = os.path.join(directory, hashlib.md5(source.encode('utf-8')).hexdigest())
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(directory):
+                raise
+    for attempt in range(snapshot_attempts):
+        stamp = _sqlite_stamp(source)
+        local = '%s-%s.db'%(prefix, '-'.join(str(x) for x in stamp))
+        if os.path.exists(local):
+            return local
+        tmpfile = '%s.%d.tmp'%(local, os.getpid())
+        _copy_database(source, tmpfile)
+        # A copy made while the source was written to is discarded
+        if _sqlite_stamp(source) == stamp:
+            break
+        os.remove(tmpfile)
+    else:
+        raise IOError("Database file '%s' kept changing while it was copied"%source)
+    os.rename(tmpfile, local)
+    for old in glob.glob(prefix + '-*.db'):
+        if old != local:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    return local
+
+# Times local_snapshot() tries to copy a database that changes during the copy
+snapshot_attempts = 3
+
+def _copy_database(source, target):
+    """
+    Copy a SQLite database file consistently, with the backup API where
+    available (Python 3.7+)
+    """
+    if not hasattr(sqlite3.Connection, 'backup'):
+        shutil.copyfile(source, target)
+        return
+    src = sqlite3.connect('file:%s?mode=ro'%pathname2url(source), uri=True)
+    try:
+        dst = sqlite3.connect(target)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+# Engines shared by connections to the same database, by URL and mode,
+# or by source database for snapshots, as (URL, engine, tables created)
+_engines = {}
+_engines_lock = threading.Lock()
+
+def _get_engine(path, create, readonly=False, key=None):
+    """
+    Get the engine for a database URL, creating it and the tables if needed
+
+    An engine registered under the same key for another URL, i.e. an older
+    snapshot, is disposed of and replaced
+    """
+    if key is None:
+        key = (path, readonly)
+    with _engines_lock:
+        old_path, engine, created = _engines.get(key, (None, None, False))
+        if engine is not None and old_path != path:
+            engine.dispose()
+            engine, created = None, False
+        if engine is None:
+            url = make_url(path)
+            if readonly:
+                engine = _readonly_engine(url)
+            else:
+                engine = create_engine(path, **_engine_options(url))
+        if create and not created:
+            Base.metadata.create_all(engine)
+            created = True
+        # In-memory databases are private to their engine, so are never shared
+        if not _is_memory(engine.url):
+            _engines[key] = (path, engine, created)
+    return engine
+
+# Settings for read-only catalogues, memory map up to 1 GB of the file and
+# use up to 64 MB of page cache
+readonly_pragmas = [
+        'PRAGMA query_only = 1',
+        'PRAGMA mmap_size = 1073741824',
+        'PRAGMA cache_size = -65536',
+        'PRAGMA temp_store = MEMORY',
+        ]
+
+def _readonly_engine(url):
+    """
+    Create an engine opening a SQLite file as read-only and immutable
+    """
+    if not url.drivername.startswith('sqlite') or _is_memory(url):
+        raise ValueError("Read-only connections need a SQLite database file, not '%s'"%str(url))
+    path = os.path.abspath(url.database)
+    if not os.path.exists(path):
+        raise IOError("Database file '%s' not found"%path)
+    uri = 'file:%s?mode=ro&immutable=1'%pathname2url(path)
+
+    def creator():
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    engine = create_engine(url, creator=creator)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in readonly_pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+def _is_memory(url):
+    return url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:')
+
+def _engine_options(url):
+    """
+    Connection pool settings for a database
+    """
+    if url.drivername.startswith('sqlite'):
+        if _is_memory(url):
+            # A single connection, shared between threads so they all see the same database
+            return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+        # Files use the default pool, giving each session its own connection so
+        # that a commit or rollback never affects the work of another session
+        return {}
+    # Server connections can be dropped while idle, check them before use
+    return {'pool_pre_ping': True, 'pool_recycle': 3600}
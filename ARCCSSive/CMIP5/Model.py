@@ -18,13 +18,13 @@ limitations under the License.
 """
 
 from __future__ import print_function
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Date, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Date, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from ARCCSSive.data import *
 
 import os
-import glob
+from ARCCSSive.CMIP5.listing import glob_dir
 
 Base = declarative_base()
 
@@ -78,6 +78,8 @@ class Instance(Base):
 
     __table_args__ = (
             UniqueConstraint('variable','experiment','mip','model','ensemble'),
+            # Grouping by ensemble, see Session.complete_ensembles()
+            Index('ix_instances_model_experiment_mip_ensemble', 'model', 'experiment', 'mip', 'ensemble'),
             )
 
     def latest(self):
@@ -168,6 +170,12 @@ class Version(Base):
     files   = relationship('VersionFile', order_by='VersionFile.id', 
                             backref='version', cascade="all, delete-orphan", passive_deletes=True)
 
+    __table_args__ = (
+            # Covers finding the latest versions, see Session.latest_outputs()
+            Index('ix_versions_instance_latest', 'instance_id', 'is_latest', 'version'),
+            Index('ix_versions_dataset_id', 'dataset_id'),
+            )
+
 
     def glob(self):
         """
@@ -191,9 +199,11 @@ class Version(Base):
 
     def build_filepaths(self):
         """
-        Returns the list of files matching this version
+        Returns the list of files matching this version, the directory
+        listing is cached while the directory doesn't change, see
+        :mod:`ARCCSSive.CMIP5.listing`
 
-        :returns: List of file names
+        :returns: List of file paths
 
         .. testsetup::
 
@@ -203,8 +213,7 @@ class Version(Base):
         >>> version.build_filepaths()
         []
         """
-        g = os.path.join(self.path, self.glob())
-        return glob.glob(g)
+        return glob_dir(self.path, self.glob())
          
     def filenames(self):
         """
@@ -277,5 +286,20 @@ class VersionFile(Base):
     sha256       = Column(String)
     version_id   = Column(Integer, ForeignKey('versions.version_id'), index = True)
 
+    __table_args__ = (
+            Index('ix_files_version_filename', 'version_id', 'filename'),
+            Index('ix_files_tracking_id', 'tracking_id'),
+            )
+
     def __str__(self):
         return '%s'%(self.filename)
+
+class SchemaVersion(Base):
+    """
+    Migrations applied to the database, see :mod:`ARCCSSive.CMIP5.migrate`
+    """
+    __tablename__ = 'schema_version'
+
+    version      = Column(Integer, primary_key = True)
+    description  = Column(String)
+    applied_on   = Column(String)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Checksums of data files
+
+All the requested checksums of a file are calculated in a single read pass,
+and lists of files are processed by a pool of threads. hashlib releases the
+GIL while hashing large blocks, so threads keep both the disk and the CPUs
+busy without starting new processes.
+
+Checksums already calculated are kept in a :class:`ChecksumCache`, a SQLite
+file in the user cache directory keyed on the file path, size, modification
+time and inode, so only files that changed since they were last seen are
+read again.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+# Size of each read, large reads work best on parallel filesystems
+blocksize = 8 * 1024 * 1024
+
+# Checksum types stored in the database
+hash_types = ['md5', 'sha256']
+
+# Checksum types hashlib can calculate
+supported_types = set(t.lower() for t in hashlib.algorithms_available)
+
+
+def default_workers():
+    ''' Number of threads used to calculate checksums, set with the
+        environment variable ARCCSSIVE_HASH_WORKERS, default the number of CPUs up to 8
+    '''
+    try:
+        return int(os.environ['ARCCSSIVE_HASH_WORKERS'])
+    except (KeyError, ValueError):
+        return min(cpu_count(), 8)
+
+def file_checksums(path, types=hash_types):
+    ''' Calculate checksums of a file reading it once
+        :argument path: file path
+        :argument types: list of checksum types, as hashlib names e.g. md5, sha256
+        :return: a dictionary {type: hex digest}
+    '''
+    hashes = [(t.lower(), hashlib.new(t.lower())) for t in types]
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for _, h in hashes:
+                h.update(view[:n])
+    return dict((t, h.hexdigest()) for t, h in hashes)
+
+def _safe_checksums(args):
+    ''' file_checksums() returning empty strings if the file can't be read '''
+    path, types = args
+    try:
+        return file_checksums(path, types)
+    except (IOError, OSError):
+        print("Warning cannot calculate ", ",".join(types), " for file ", path)
+        return dict((t.lower(), "") for t in types)
+
+def _hash_files(paths, types, workers):
+    ''' Calculate checksums of a list of files with a pool of threads '''
+    args = [(p, types) for p in paths]
+    if workers is None:
+        workers = default_workers()
+    if workers <= 1 or len(args) <= 1:
+        return [_safe_checksums(a) for a in args]
+    pool = ThreadPool(min(workers, len(args)))
+    try:
+        return pool.map(_safe_checksums, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def checksum_files(paths, types=hash_types, workers=None, cache=None):
+    ''' Calculate checksums of a list of files in parallel
+        :argument paths: list of file paths
+        :argument types: list of checksum types, as hashlib names e.g. md5, sha256
+        :argument workers: number of threads, default from default_workers()
+        :argument cache: a :class:`ChecksumCache` to look up and store the checksums, default none
+        :return: a list of dictionaries {type: hex digest}, in the same order as paths,
+                 with empty strings for files that can't be read
+        :raises ValueError: if one of the types isn't supported by hashlib
+    '''
+    types = [t.lower() for t in types]
+    unknown = [t for t in types if t not in supported_types]
+    if unknown:
+        raise ValueError("Unsupported checksum type %s" % ",".join(unknown))
+    if cache is None:
+        return _hash_files(paths, types, workers)
+    results = cache.get_many(paths, types)
+    missing = [i for i, r in enumerate(results) if r is None]
+    # identify the content before reading it, so a file changed while it's hashed
+    # is stored under its old key and hashed again next time
+    keys = [_safe_file_key(paths[i]) for i in missing]
+    sums = _hash_files([paths[i] for i in missing], types, workers)
+    stored = []
+    for i, key, r in zip(missing, keys, sums):
+        results[i] = r
+        # don't remember files that couldn't be read
+        if key is not None and all(r.values()):
+            stored.append((paths[i], r, key))
+    cache.put_many(stored)
+    return results
+
+
+def _file_key(path):
+    ''' Return (real path, size, mtime in ns, inode) identifying the current content of a file '''
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1e9)
+    return path, st.st_size, mtime, st.st_ino
+
+def _safe_file_key(path):
+    ''' _file_key() returning None if the file is missing '''
+    try:
+        return _file_key(path)
+    except OSError:
+        return None
+
+class ChecksumCache(object):
+    """
+    Persistent store of file checksums
+
+    Entries are valid as long as the file keeps the same path, size,
+    modification time and inode, any change means the file is hashed again.
+    The cache can be shared by threads and by processes.
+
+    :argument path: path of the SQLite cache file, created if missing
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS checksums (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER,
+                md5 TEXT, sha256 TEXT, last_used INTEGER)''')
+
+    def close(self):
+        ''' Close the cache file '''
+        self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT count(*) FROM checksums').fetchone()[0]
+
+    def get_many(self, paths, types=hash_types):
+        ''' Return the cached checksums of a list of files, looked up with one query for
+            each 500 files and marked as used in a single transaction
+            :argument paths: list of file paths
+            :argument types: list of checksum types
+            :return: list of dictionaries {type: hex digest}, in the same order as paths, with
+                     None for files that changed, aren't in the cache or are missing one of the types
+        '''
+        results = [None] * len(paths)
+        columns = [t.lower() for t in types]
+        if not columns or any(c not in hash_types for c in columns):
+            return results
+        keys = [(i, _safe_file_key(p)) for i, p in enumerate(paths)]
+        keys = [(i, key) for i, key in keys if key is not None]
+        names = list(set(key[0] for _, key in keys))
+        rows = {}
+        with self._lock:
+            for start in range(0, len(names), 500):
+                batch = names[start:start+500]
+                for row in self._db.execute('SELECT path, size, mtime_ns, inode, ' + ', '.join(columns) +
+                                            ' FROM checksums WHERE path IN (' + ', '.join('?' * len(batch)) + ')',
+                                            batch):
+                    rows[row[0]] = row
+            used = set()
+            for i, key in keys:
+                row = rows.get(key[0])
+                if row is not None and tuple(row[1:4]) == key[1:] and all(row[4:]):
+                    results[i] = dict(zip(columns, row[4:]))
+                    used.add(key[0])
+            if used:
+                now = int(time.time())
+                with self._db:
+                    self._db.executemany('UPDATE checksums SET last_used = ? WHERE path = ?',
+                                         [(now, p) for p in used])
+        return results
+
+    def get(self, path, types=hash_types):
+        ''' Return the cached checksums of a file
+            :argument path: file path
+            :argument types: list of checksum types
+            :return: dictionary {type: hex digest}, None if the file changed, isn't in the
+                     cache or is missing one of the types
+        '''
+        return self.get_many([path], types)[0]
+
+    def put_many(self, items):
+        ''' Store checksums of files, keeping those of other types if the file is unchanged
+            :argument items: list of (file path, dictionary {type: hex digest}), or of
+                (file path, checksums, key) with the key from _file_key() taken before the
+                file was read
+        '''
+        rows = []
+        now = int(time.time())
+        for item in items:
+            path, sums = item[:2]
+            key = item[2] if len(item) > 2 else _safe_file_key(path)
+            if key is None:
+                continue
+            rows.append(key + (sums.get('md5'), sums.get('sha256'), now))
+        if not rows:
+            return
+        with self._lock, self._db:
+            for row in rows:
+                old = self._db.execute('SELECT size, mtime_ns, inode, md5, sha256 FROM checksums '
+                                       'WHERE path = ?', row[:1]).fetchone()
+                if old is not None and tuple(old[:3]) == row[1:4]:
+                    row = row[:4] + (row[4] or old[3], row[5] or old[4], now)
+                self._db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+
+    def put(self, path, sums):
+        ''' Store the checksums of a file
+            :argument path: file path
+            :argument sums: dictionary {type: hex digest}
+        '''
+        self.put_many([(path, sums)])
+
+    def evict(self, max_age=None):
+        ''' Remove entries of files that were deleted or changed
+            :argument max_age: also remove entries not used in this many days
+            :return: number of entries removed
+        '''
+        with self._lock:
+            rows = self._db.execute('SELECT path, size, mtime_ns, inode, last_used FROM checksums').fetchall()
+        oldest = time.time() - max_age * 86400 if max_age is not None else None
+        stale = []
+        for row in rows:
+            try:
+                current = _file_key(row[0])
+            except OSError:
+                current = None
+            if current != tuple(row[:4]) or (oldest is not None and row[4] < oldest):
+                stale.append(row[:1])
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM checksums WHERE path = ?', stale)
+        return len(stale)
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def default_cache():
+    ''' Return the checksum cache shared by the library, in the ARCCSSive cache directory
+        as `checksums.db` or at the path set with the environment variable
+        ARCCSSIVE_CHECKSUM_CACHE. Setting the variable to an empty string disables it.
+        :return: a :class:`ChecksumCache`, None if disabled or it can't be opened
+    '''
+    global _default_cache
+    # imported here as DB depends on this module through other_functions
+    from ARCCSSive.CMIP5.DB import cache_dir
+    path = os.environ.get('ARCCSSIVE_CHECKSUM_CACHE', os.path.join(cache_dir(), 'checksums.db'))
+    if not path:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None or _default_cache.path != path:
+            try:
+                _default_cache = ChecksumCache(path)
+            except (OSError, sqlite3.Error) as e:
+                print("Warning cannot open checksum cache ", path, ": ", e)
+                return None
+        return _default_cache
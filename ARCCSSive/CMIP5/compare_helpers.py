@@ -20,12 +20,18 @@ limitations under the License.
 
 from __future__ import print_function
 
-from ARCCSSive.CMIP5.other_functions import write_log, get_instance, get_mip, compare_tracking_ids, compare_checksums, today 
-from ARCCSSive.CMIP5.Model import Instance 
+from ARCCSSive.CMIP5.other_functions import get_instance, get_mip, compare_tracking_ids, compare_checksums, today 
+from ARCCSSive.CMIP5.Model import Instance, VersionFile 
+from ARCCSSive.CMIP5.update_db_functions import add_bulk_items, update_item 
+from ARCCSSive.CMIP5.checksums import checksum_files, default_cache, hash_types 
+from ARCCSSive.CMIP5.comparison_log import ComparisonLog
 from ARCCSSive.CMIP5.pyesgf_functions import FileResult 
 from collections import defaultdict
 import argparse
 from datetime import datetime 
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 import os
 
 
@@ -139,23 +145,20 @@ def update_files(local,remote):
     ''' return urls of files to update '''
     urls=[]
     dataset_info=[]
+    by_id=dict((x.id,x) for x in local)
     # this return too many we need to do it variable by variable
     for ind,ds in enumerate(remote):
         if ds['files']==[]:
             print("This dataset has no files, skip ",ds['dataset_id'])
             continue
         if ds['update'] != []: 
-            dsfnames=set()
-            for f in ds['files']:
-                dsfnames.add(f.filename)
-            for vid in ds['update']:
-                v=[x for x in local if x.id==vid][0]
-                missing=dsfnames.difference(v.filenames())
-                extra=set(v.filenames()).difference(dsfnames)
-                same=dsfnames.intersection(v.filenames())
             ctype=ds['checksum_type']
-            different=check_same(same,v,ds['files'],ctype) + list(missing)
-            if different != []:
+            # files missing or different in any of the local versions to update
+            different=set()
+            for vid in ds['update']:
+                diff=diff_files(by_id[vid].files,ds['files'],ctype)
+                different.update(diff['missing'],diff['changed'])
+            if different:
                 inst=get_instance(ds['dataset_id'])
             # found dataset local path from download url, replace thredds with /g/data1/ua6/unof...
                 if ctype is None: ctype="None"
@@ -176,17 +179,28 @@ def update_files(local,remote):
     return urls,dataset_info
 
 
+def diff_files(local_files,remote_files,ctype):
+    ''' Compare the files of a local version and of a remote dataset by filename
+        :argument local_files: list of VersionFile
+        :argument remote_files: list of FileResult
+        :argument ctype: remote checksum type, md5 or sha256, files are not compared for other values
+        :return: dictionary of sets of filenames, missing locally, extra locally,
+                 same (in both) and changed (in both with a different checksum)
+    '''
+    local=dict((f.filename,f) for f in local_files)
+    remote=dict((f.filename,f) for f in remote_files)
+    same=set(remote).intersection(local)
+    ctype=str(ctype).lower()
+    changed=set()
+    if ctype in ['md5','sha256']:
+        changed=set(n for n in same if getattr(local[n],ctype)!=remote[n].checksum)
+    return {'missing': set(remote).difference(local), 'extra': set(local).difference(remote),
+            'same': same, 'changed': changed}
+
 def check_same(same,v,dsfiles,ctype):
-    ''' '''
-    different=[]
-    tocompare=[]
-    for fname in same:
-        tup0=[f for f in v.files if f.filename==fname][0]
-        tup1=[f for f in dsfiles if f.filename==fname][0] 
-        tocompare.append((tup0,tup1)) 
-    for tup in tocompare:
-        if tup[0].__dict__[ctype]!=tup[1].checksum: different.append(tup[0].filename)
-    return different
+    ''' return the filenames in same whose local checksum is different from the remote one '''
+    changed=diff_files(v.files,dsfiles,ctype)['changed']
+    return [fname for fname in same if fname in changed]
 
 def retrieve_ds(args):
     ''' Retrieve info from a remote dataset object '''
@@ -226,55 +240,138 @@ def retrieve_ds(args):
     return ds_info
 
 
-def compare_instances(db,remote,local,const_keys,admin):
+class NodeRateLimiter(object):
+    ''' Spaces out the requests sent to each ESGF index node
+        :argument rate: maximum number of requests per second to a node, None for no limit
+    '''
+    def __init__(self, rate=None):
+        self.interval = 1.0/rate if rate else 0.0
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, node):
+        ''' Wait until a new request can be sent to node '''
+        if not self.interval: return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next.get(node, now))
+            self._next[node] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def fetch_files(ds, limiter=None, retries=3, backoff=2.0):
+    ''' Search the files of a remote dataset, retrying with exponential backoff if the search
+        fails or returns no files. The files are kept on the dataset object, see DatasetResult.files()
+        :return: list of FileResult, empty if all the attempts failed
+    '''
+    node = getattr(ds, 'index_node', None)
+    for attempt in range(retries+1):
+        if attempt > 0:
+            time.sleep(backoff * 2**(attempt-1))
+        if limiter is not None:
+            limiter.wait(node)
+        try:
+            allfiles = ds.files(refresh=attempt > 0)
+        except Exception as e:
+            print("Search for files of ", ds.dataset_id, " failed: ", e)
+            allfiles = []
+        if len(allfiles) > 0:
+            break
+    return allfiles
+
+def retrieve_all(results, workers=8, rate=None, retries=3, backoff=2.0, limiter=None):
+    ''' Retrieve info from many remote datasets concurrently with retrieve_ds()
+        :argument results: list of (DatasetResult, variables)
+        :argument workers: number of concurrent file searches
+        :argument rate: maximum number of file searches per second to each index node, None for no limit
+        :argument retries: number of times a failed search is tried again
+        :argument backoff: seconds to wait before the first retry, doubled at each retry
+        :argument limiter: NodeRateLimiter shared with other searches, replaces rate
+        :return: list of retrieve_ds() results, in the same order as results
+    '''
+    if limiter is None:
+        limiter = NodeRateLimiter(rate)
+    def retrieve(args):
+        ds = args[0]
+        if 'esgf.nci.org.au' not in ds.dataset_id and fetch_files(ds, limiter, retries, backoff) == []:
+            print('There is an issue with the server response for dataset:\n')
+            print(ds.dataset_id)
+            print('We have to skip this dataset, please send this warning to climate_help@nci.org.au')
+            return []
+        return retrieve_ds(args)
+    if workers <= 1 or len(results) <= 1:
+        return [retrieve(r) for r in results]
+    pool = ThreadPool(min(workers, len(results)))
+    try:
+        return pool.map(retrieve, results, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# directory where the logs of non-admin comparisons are stored
+logdir="/g/data1/ua6/unofficial-ESG-replica/tmp/pxp581/requests/"
+
+def user_log():
+    ''' Return the ComparisonLog of the current user for today, in logdir '''
+    return ComparisonLog(logdir+"log_" + os.environ['USER'] + "_" + today.replace("-","") + ".jsonl")
+
+def compare_instances(db,remote,local,const_keys,admin,log=None):
     ''' Compare remote and local search results they're both a list of dictionaries
         :argument db: sqlalchemy local db session 
         :argument remote: each dict has keys version, files (objs), filenames, tracking_ids, dataset_id 
         :argument local:  list of version objects
         :argument const_keys:  list of instance attributes defined by user constraints
         :argument admin:  boolean if True user is admin and can update db directly, optherwise new info saved in log file
+        :argument log: ComparisonLog for the changes if not admin, default user_log() closed on return
         :return: remote, local with updated attributes 
     '''
-    global logfile
-    logdir="/g/data1/ua6/unofficial-ESG-replica/tmp/pxp581/requests/"
-    if not admin:
-        logfile=logdir+"log_" + os.environ['USER'] + "_" + today.replace("-","") + ".txt"
-        #print(logfile)
+    own_log = not admin and log is None
+    if own_log:
+        log=user_log()
     # a list of the unique constraints defining one instance in the database which are not in user constraints
     undefined=[x for x in Instance.__table_args__[0].columns.keys() if x not in const_keys]
+    # index local versions by the values of the undefined fields and by (dataset_id, variable)
+    # dataset_id can change while comparing so the second index is kept up to date by set_dataset_id()
+    by_identity=defaultdict(list)
+    by_dataset=defaultdict(set)
+    for pos,v in enumerate(local):
+        by_identity[tuple(getattr(v.variable,key) for key in undefined)].append(v)
+        by_dataset[(v.dataset_id,v.variable.variable)].add(pos)
+    position=dict((id(v),pos) for pos,v in enumerate(local))
+    def set_dataset_id(v,dataset_id):
+        by_dataset[(v.dataset_id,v.variable.variable)].discard(position[id(v)])
+        v.dataset_id=dataset_id
+        by_dataset[(v.dataset_id,v.variable.variable)].add(position[id(v)])
     # loop through all returned remote datasets
     for ind,ds in enumerate(remote):
-        # loop through all local versions and choose only version with same fields as ds
+        # choose only the local versions with same fields as ds
         ds_instance=get_instance(ds['dataset_id'])
         ds_instance['variable']=ds['variable']
-        for v in local:
-            dummy=[False for key in undefined if  ds_instance[key] != v.variable.__dict__[key]]
-            if False in dummy:
-                continue
+        # a field missing from the remote dataset raises KeyError, as comparing each local version did
+        identity=tuple(ds_instance[key] for key in undefined) if local else None
+        for v in by_identity.get(identity,[]):
             v.checked_on = today
             # compare files for all cases except if version regular but different from remote 
             if v.version in [ds['version'],'NA',r'v\d',r'\d']:
-                extra = compare_files(db,ds,v,admin)
+                extra = compare_files(db,ds,v,admin,log)
                 # if tracking_ids or checksums are same
                 if extra==set([]):
                     v.to_update = False
                 else:
                     v.to_update = True
-                    if not admin:
-                        ds_info=[str(x) for x in ds_instance.items()]
-                        write_log(" ".join(["update"]+ds_info+[v.version,v.path,"\n"]))
             # if local dataset_id is the same as remote skip all other checks
             if v.dataset_id==ds['dataset_id']:
                 v.is_latest = True
             # if version same as latest on esgf 
             elif v.version == ds['version']:
-                v.dataset_id = ds['dataset_id']
+                set_dataset_id(v,ds['dataset_id'])
                 v.is_latest = True
             # if version undefined 
             elif v.version in ['NA',r'v\d*',r'\d']:
                 if extra==set([]):
                     v.version = ds['version']
-                    v.dataset_id = ds['dataset_id']
+                    set_dataset_id(v,ds['dataset_id'])
                     v.is_latest = True
             # if version different or undefined but one or more tracking_ids are different
             # assume different version from latest
@@ -285,33 +382,28 @@ def compare_instances(db,remote,local,const_keys,admin):
                 if v.version > ds['version']:
                     print("Warning!!!")
                     print(" ".join(["Local version",v.version,"is more recent than the latest version",ds['version'], "found on ESGF"]))
-                if v.dataset_id is None: v.dataset_id = "NA"
+                if v.dataset_id is None: set_dataset_id(v,"NA")
     # update local version on database
             if admin:
                 db.commit()
-            else:
-                if db.dirty:
-                    line=["version"]+ds_instance.values()[:-1]+[v.version,str(v.id),str(v.dataset_id),
-                          str(v.is_latest),str(v.checked_on),"\n"]
-                    write_log(" ".join(line))
+            elif v in db.dirty:
+                log.update('versions', v.id, version=v.version, dataset_id=v.dataset_id,
+                           is_latest=v.is_latest, checked_on=v.checked_on, to_update=v.to_update)
 
     # add to remote dictionary list of local identical versions
-        remote[ind]['same_as']=[v.id for v in local if v.dataset_id == ds['dataset_id'] 
-                                and v.variable.__dict__['variable'] == ds['variable']]
-        remote[ind]['update']=[]
-        remote[ind]['update']=[v.id for v in local if v.to_update and v.dataset_id == ds['dataset_id']
-                                and v.variable.__dict__['variable'] == ds['variable']]
-    try:
-        flog.close()
-    except:
-        pass
+        same=[local[pos] for pos in sorted(by_dataset.get((ds['dataset_id'],ds['variable']),[]))]
+        remote[ind]['same_as']=[v.id for v in same]
+        remote[ind]['update']=[v.id for v in same if v.to_update]
+    if own_log:
+        log.close()
     return remote, local
 
 
-def compare_files(db,rds,v,admin):
+def compare_files(db,rds,v,admin,log=None):
     ''' Compare files of remote and local version of a dataset
         :argument rds: dictionary of remote dataset object selected attributes  
         :argument v:  local version object   
+        :argument log: ComparisonLog for new files and checksums if not admin
         :return: result set, NB updating VerisonFiles object in databse if calculating checksums 
     '''
     extra=None
@@ -325,7 +417,7 @@ def compare_files(db,rds,v,admin):
             add_bulk_items(db, VersionFile, rows)
         else:
             for r in rows:
-                write_log("new file "+ str(r) + "\n")
+                log.insert('files', **r)
         local_files_num=len(rows)
     # first compare tracking_ids if all are present in local version
     # if a file is INVALID or missing skip both tracking-id and checksums comparison
@@ -338,37 +430,27 @@ def compare_files(db,rds,v,admin):
     # calculate checksums and update local db if necessary  
     # uncomment this to check also if tracking_ids are the same
     #if extra is None or  extra==set([]):
-    # if tracking_ids are not present compare checksums
-    if extra is None:
+    # if tracking_ids are not present compare checksums, if the remote files have any
+    cktype=str(rds['checksum_type']).lower()
+    if extra is None and cktype in hash_types:
         local_sums=[]
-        cktype=str(rds['checksum_type']).lower()
         for f in v.files:
             try:
                 cksum=f.__dict__[cktype]
             except (TypeError, KeyError):
                 #print("type or key error ",cktype)
                 cksum=None
-            if cksum in ["",None]:
-                cksum=check_hash(v.path+"/"+f.filename,cktype)
-                if admin:
-                    update_item(db,VersionFile,f.id,{cktype:cksum})
-                else:
-                    write_log(" ".join([cktype,str(f.id),cksum,"\n"]))
             local_sums.append(cksum)
+        # calculate all the missing checksums of the version in parallel
+        missing=[i for i,cksum in enumerate(local_sums) if cksum in ["",None]]
+        sums=checksum_files([v.path+"/"+v.files[i].filename for i in missing],[cktype],cache=default_cache())
+        for i,cksum in zip(missing,sums):
+            f=v.files[i]
+            local_sums[i]=cksum[cktype]
+            if admin:
+                update_item(db,VersionFile,f.id,{cktype:local_sums[i]})
+            else:
+                log.update('files', f.id, **{cktype:local_sums[i]})
         rds_sums=[f.checksum for f in rds['files']]
         extra = compare_checksums(rds_sums,local_sums)
     return extra
-
-
-
-# functions to write logs
-def write_log(line):
-    ''' add str to log file, open new file if does not exist yet '''
-    global flog
-    try:
-        flog.write(line)
-    except:
-        flog=open(logfile,"a")
-        flog.write(line)
-    return
-
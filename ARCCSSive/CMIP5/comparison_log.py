@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Logs of the database changes found by compare_ESGF
+
+Users other than the admins can't change the catalogue, the changes their
+comparisons find are written to a log instead, one record per change::
+
+    {"action": "update", "table": "versions", "id": 12, "values": {"is_latest": true, ...}}
+    {"action": "insert", "table": "files", "id": null, "values": {"filename": ..., "version_id": 12}}
+
+Logs are JSON Lines files, or CSV files with the same columns and the
+values as JSON, when the file name ends with `.csv`. The admins apply them
+to the catalogue with :func:`apply_log()`.
+"""
+
+from __future__ import print_function
+
+import csv
+import json
+import threading
+from collections import defaultdict
+
+from ARCCSSive.CMIP5.Model import Instance, Version, VersionFile, VersionWarning
+from ARCCSSive.CMIP5.update_db_functions import bulk_upsert
+
+# Columns of each record
+log_fields = ['action', 'table', 'id', 'values']
+
+# Tables that can be changed, with the columns identifying existing rows for inserts
+log_tables = {
+    'instances': (Instance, ['variable', 'experiment', 'mip', 'model', 'ensemble']),
+    'versions': (Version, ['instance_id', 'version', 'path']),
+    'files': (VersionFile, ['version_id', 'filename']),
+    'warnings': (VersionWarning, ['version_id', 'warning']),
+    }
+
+
+def _is_csv(path):
+    return path.lower().endswith('.csv')
+
+class ComparisonLog(object):
+    """
+    Buffered writer of a comparison log, records are appended to the file
+
+    Use as a context manager, or call :meth:`close()` to write the
+    remaining records::
+
+        with ComparisonLog('log.jsonl') as log:
+            log.update('versions', v.id, is_latest=True)
+
+    :argument path: log file path, a CSV file if it ends with `.csv`
+    :argument buffer_size: number of records kept in memory before writing them
+    """
+    def __init__(self, path, buffer_size=1000):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.csv = _is_csv(path)
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._file = None
+
+    def open(self):
+        ''' Open the file for appending, done by the first write if not called '''
+        if self._file is None:
+            self._file = open(self.path, 'a')
+            if self.csv and self._file.tell() == 0:
+                csv.writer(self._file, lineterminator='\n').writerow(log_fields)
+        return self
+
+    def write(self, action, table, id=None, **values):
+        ''' Add a record to the log
+            :argument action: 'update' or 'insert'
+            :argument table: name of the table changed, one of log_tables
+            :argument id: id of the row to update
+            :argument values: column values
+        '''
+        if action not in ['update', 'insert'] or table not in log_tables:
+            raise ValueError("Unknown log record %s %s" % (action, table))
+        record = [action, table, id, values]
+        with self._lock:
+            self._buffer.append(record)
+            if len(self._buffer) >= self.buffer_size:
+                self._flush()
+
+    def update(self, table, id, **values):
+        ''' Add a record updating row id of table '''
+        self.write('update', table, id, **values)
+
+    def insert(self, table, **values):
+        ''' Add a record inserting a row in table '''
+        self.write('insert', table, None, **values)
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        self.open()
+        if self.csv:
+            csv.writer(self._file, lineterminator='\n').writerows(
+                r[:3] + [json.dumps(r[3], sort_keys=True, default=str)] for r in self._buffer)
+        else:
+            self._file.write("".join(json.dumps(dict(zip(log_fields, r)), sort_keys=True, default=str) + "\n"
+                                     for r in self._buffer))
+        self._file.flush()
+        self._buffer = []
+
+    def flush(self):
+        ''' Write the buffered records '''
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        ''' Write the buffered records and close the file '''
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_log(path):
+    ''' Read a comparison log
+        :return: generator of records, as dictionaries with keys log_fields
+    '''
+    with open(path, 'r') as f:
+        if _is_csv(path):
+            for row in csv.DictReader(f):
+                row['id'] = int(row['id']) if row['id'] else None
+                row['values'] = json.loads(row['values'])
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def apply_log(db, records, batch_size=500):
+    ''' Apply the changes in a comparison log to the database, in batches
+        Updates of the same row are merged, the last value of each column wins.
+        Inserts skip the rows already existing.
+        :argument db: SQLAlchemy session
+        :argument records: records from read_log()
+        :return: dictionary {(action, table): number of rows}
+    '''
+    updates = defaultdict(dict)
+    inserts = defaultdict(list)
+    for r in records:
+        if r['table'] not in log_tables:
+            raise ValueError("Unknown table in log record: %s" % r)
+        if r['action'] == 'update':
+            updates[r['table']].setdefault(r['id'], {}).update(r['values'])
+        elif r['action'] == 'insert':
+            inserts[r['table']].append(r['values'])
+        else:
+            raise ValueError("Unknown action in log record: %s" % r)
+    counts = {}
+    # new rows first, updates can refer to them
+    for table, rows in inserts.items():
+        klass, keys = log_tables[table]
+        bulk_upsert(db, klass, rows, keys, batch_size)
+        counts[('insert', table)] = len(rows)
+    for table, rows in updates.items():
+        klass = log_tables[table][0]
+        mappings = [dict(values, id=id) for id, values in rows.items()]
+        for start in range(0, len(mappings), batch_size):
+            db.bulk_update_mappings(klass, mappings[start:start+batch_size])
+            db.commit()
+        counts[('update', table)] = len(mappings)
+    return counts
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Recorded ESGF search responses
+
+Every ESGF search, for datasets or for the files of a dataset, is a query to
+the index node's `search` endpoint returning a JSON document. A
+:class:`ResponseStore` keeps these documents in a directory, one file for
+each distinct node and set of query parameters, so a comparison run again
+with the same constraints replays them instead of querying the node.
+Responses older than the store's time to live are searched again, unless
+the store is used offline.
+
+See :class:`ARCCSSive.CMIP5.pyesgf_functions.StoredSearchConnection` for
+the connection using it.
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+# Seconds a recorded response is replayed before searching again
+default_ttl = 24 * 3600
+
+
+def default_store_path():
+    ''' Return the directory of the ESGF response store, set with the environment
+        variable ARCCSSIVE_ESGF_STORE, default `esgf` in the ARCCSSive cache directory
+    '''
+    from ARCCSSive.CMIP5.DB import cache_dir
+    return os.environ.get('ARCCSSIVE_ESGF_STORE', os.path.join(cache_dir(), 'esgf'))
+
+def response_key(url, endpoint, query):
+    ''' Return the key of a response, a hash of the node url, endpoint and query parameters
+        :argument url: search node url
+        :argument endpoint: endpoint name, e.g. search
+        :argument query: list of (parameter, value), in any order
+        :return: hex digest
+    '''
+    params = sorted((str(k), str(v)) for k, v in query)
+    return hashlib.sha256(json.dumps([url.rstrip('/'), endpoint, params]).encode('utf-8')).hexdigest()
+
+class ResponseStore(object):
+    """
+    Directory of recorded search responses, addressed by :func:`response_key()`
+
+    Each response is a JSON file with the node url and query it answers and
+    the time it was recorded. The store can be shared by threads and by
+    processes, files are replaced atomically.
+
+    :argument path: directory of the store, created by the first response saved
+    :argument ttl: seconds a response is valid, None to keep them forever
+    """
+    def __init__(self, path=None, ttl=default_ttl):
+        self.path = path or default_store_path()
+        self.ttl = ttl
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def _expired(self, saved):
+        return self.ttl is not None and time.time() - saved > self.ttl
+
+    def get(self, url, endpoint, query, expired=False):
+        ''' Return a recorded response
+            :argument url, endpoint, query: search identifying the response, see response_key()
+            :argument expired: return also responses older than the ttl
+            :return: the JSON document, None if missing or expired
+        '''
+        try:
+            with open(self._file(response_key(url, endpoint, query))) as f:
+                record = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not expired and self._expired(record['saved']):
+            return None
+        return record['response']
+
+    def put(self, url, endpoint, query, response):
+        ''' Record a response, skipped if the store directory isn't writable
+            :argument url, endpoint, query: search identifying the response, see response_key()
+            :argument response: the JSON document
+        '''
+        query = list(query)
+        filename = self._file(response_key(url, endpoint, query))
+        record = {'url': url, 'endpoint': endpoint, 'query': [[str(k), str(v)] for k, v in query],
+                  'saved': time.time(), 'response': response}
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            tmpfile = '%s.%d.%d'%(filename, os.getpid(), threading.current_thread().ident)
+            with open(tmpfile, 'w') as f:
+                json.dump(record, f)
+            os.rename(tmpfile, filename)
+        except (IOError, OSError):
+            pass
+
+    def _files(self):
+        if not os.path.isdir(self.path):
+            return []
+        return [os.path.join(self.path, d, f) for d in os.listdir(self.path)
+                for f in os.listdir(os.path.join(self.path, d)) if f.endswith('.json')]
+
+    def __len__(self):
+        return len(self._files())
+
+    def evict(self):
+        ''' Remove the expired responses
+            :return: number of responses removed
+        '''
+        removed = 0
+        for filename in self._files():
+            try:
+                with open(filename) as f:
+                    saved = json.load(f)['saved']
+            except (IOError, OSError, ValueError, KeyError):
+                saved = 0
+            if self._expired(saved):
+                try:
+                    os.remove(filename)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
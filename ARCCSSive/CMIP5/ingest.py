@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Pipelined ingest of new datasets into the catalogue
+
+Datasets listed in tmp/tree listings (see :func:`other_functions.iter_tmpdir()`),
+download logs (see :func:`other_functions.iter_logfile()`) or journals of
+changed files written by :func:`scan.write_journal()` go through three
+stages connected by bounded queues, so memory use doesn't depend on the size
+of the input:
+
+ * a scanner thread reading the inputs and listing the files of each dataset
+ * a pool of workers calculating the missing checksums and reading the file headers
+ * a single writer, in the calling thread, adding the datasets to the database
+   in batches with :func:`update_db_functions.bulk_upsert()`
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import itertools
+import threading
+from collections import OrderedDict
+import six
+from six.moves import queue
+
+from ARCCSSive.CMIP5.Model import Instance, Version, VersionFile
+from ARCCSSive.CMIP5.update_db_functions import bulk_upsert
+from ARCCSSive.CMIP5.other_functions import iter_tmpdir, iter_logfile, list_drs_files, file_details
+from ARCCSSive.CMIP5.checksums import checksum_files, default_workers
+from ARCCSSive.CMIP5.netcdf_header import read_headers
+from ARCCSSive.CMIP5.scan import read_journal, journal_header
+
+# Fields identifying existing rows for each table
+inst_keys = ['variable', 'experiment', 'mip', 'model', 'ensemble']
+vers_keys = ['instance_id', 'version', 'path']
+file_keys = ['version_id', 'filename']
+
+# Marks the end of the items put in a queue
+_done = object()
+
+
+class StageStats(object):
+    """
+    Counts of the datasets and files processed by a stage of the pipeline
+    and of the time spent working on them, summed over its threads
+    """
+    def __init__(self, name):
+        self.name = name
+        self.datasets = 0
+        self.files = 0
+        self.removed = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, datasets, files, seconds, removed=0):
+        with self._lock:
+            self.datasets += datasets
+            self.files += files
+            self.removed += removed
+            self.busy += seconds
+
+    def report(self, elapsed):
+        ''' Return a line with the throughput of the stage over elapsed seconds '''
+        line = "%-7s %8d datasets %10d files %10.1f files/s   busy %.1fs" % (
+            self.name + ":", self.datasets, self.files,
+            self.files / elapsed if elapsed > 0 else 0.0, self.busy)
+        if self.removed:
+            line += "   removed %d files" % self.removed
+        return line
+
+
+def input_format(path):
+    ''' Return 'tmpdir' for tmp/tree listings and 'journal' for scan journals, recognised by
+        their header line, 'log' for download logs
+    '''
+    with open(path, 'r') as f:
+        first = f.readline()
+    if first.startswith('variable,'):
+        return 'tmpdir'
+    if first.strip() == ",".join(journal_header):
+        return 'journal'
+    return 'log'
+
+def _checksum_type(ctype):
+    ctype = ctype.strip().lower()
+    return 'sha256' if ctype in ['none', ''] else ctype
+
+def _journal_datasets(path):
+    ''' Group the files added or modified in a scan journal by directory and instance
+        The files removed from a directory are listed by its first dataset, or by a
+        dataset with no instance and files if nothing was added to the directory
+    '''
+    for directory, group in itertools.groupby(read_journal(path), lambda c: os.path.dirname(c.path)):
+        version = os.path.basename(directory)
+        if not re.match(r'v\d{8}$', version):
+            version = 'NA'
+        datasets = OrderedDict()
+        removed = []
+        for c in group:
+            filename = os.path.basename(c.path)
+            if c.change == 'removed':
+                removed.append(filename)
+                continue
+            try:
+                details = file_details(filename)
+                key = tuple(details[k] for k in inst_keys)
+            except (TypeError, KeyError, IndexError):
+                # a single file with an unexpected name is skipped, not the whole ingest
+                print("Warning skipping file not following the CMIP5 file name convention ", c.path)
+                continue
+            if key not in datasets:
+                details['realm'] = 'NA'
+                datasets[key] = dict(instance=details, version=dict(version=version, path=directory),
+                                     checksum_type='sha256', files=[], modified=[])
+            datasets[key]['files'].append(dict(filename=filename, tracking_id=None, sha256=None))
+            if c.change == 'modified':
+                datasets[key]['modified'].append(filename)
+        if removed and not datasets:
+            datasets[None] = dict(instance=None, version=dict(version=version, path=directory),
+                                  checksum_type='sha256', files=[], modified=[])
+        for i, dataset in enumerate(datasets.values()):
+            dataset['removed'] = removed if i == 0 else []
+            yield dataset
+
+def read_datasets(path):
+    ''' Yield the datasets listed in a tmp/tree listing, a download log or a scan journal
+        as dictionaries with keys instance, version, checksum_type and files, a list of
+        dictionaries with filename, tracking_id and the checksum. Values that need to be
+        read or calculated from the files are None. Datasets from journals also list the
+        modified files, which are updated if already in the database, and the removed
+        files, whose rows are deleted from it.
+    '''
+    fmt = input_format(path)
+    if fmt == 'journal':
+        for dataset in _journal_datasets(path):
+            yield dataset
+    elif fmt == 'tmpdir':
+        for record in iter_tmpdir(path):
+            record = dict(record)
+            version = dict(version=record.pop('version'), path=record.pop('path'))
+            var = record['variable']
+            files = [dict(filename=f, tracking_id=None, sha256=None)
+                     for f in sorted(list_drs_files(version['path'])) if f.split("_")[0] == var]
+            yield dict(instance=record, version=version, checksum_type='sha256', files=files)
+    else:
+        for record in iter_logfile(path):
+            record = dict(record)
+            ctype = _checksum_type(record.pop('cks_type'))
+            version = dict(version=record.pop('version'), dataset_id=record.pop('dataset_id'),
+                           path=record.pop('path'))
+            files = []
+            for f in record.pop('files'):
+                checksum = f.get('checksum')
+                files.append({'filename': f['filename'],
+                              'tracking_id': None if f.get('tracking_id') in [None, 'None', ''] else f['tracking_id'],
+                              ctype: None if checksum in [None, 'None', ''] else checksum})
+            yield dict(instance=record, version=version, checksum_type=ctype, files=files)
+
+def process_dataset(dataset, cache=None):
+    ''' Fill in the missing checksums, tracking ids, realm and version of a dataset
+        from its files, each file is read at most once for each
+    '''
+    if dataset['instance'] is None:
+        return dataset
+    path = dataset['version']['path']
+    ctype = dataset['checksum_type']
+    files = dataset['files']
+    needs_meta = dataset['instance'].get('realm', 'NA') == 'NA' or len(dataset['version']['version']) < 9
+
+    tohash = [f for f in files if f.get(ctype) is None]
+    for f, sums in zip(tohash, checksum_files([path + "/" + f['filename'] for f in tohash],
+                                              [ctype], workers=1, cache=cache)):
+        f[ctype] = sums[ctype]
+
+    toread = [i for i, f in enumerate(files) if f['tracking_id'] is None or (i == 0 and needs_meta)]
+    headers = dict(zip(toread, read_headers([path + "/" + files[i]['filename'] for i in toread], workers=1)))
+    for i, header in headers.items():
+        if files[i]['tracking_id'] is None:
+            files[i]['tracking_id'] = header['tracking_id'] if header is not None else "INVALID"
+    first = headers.get(0) or {}
+    if dataset['instance'].get('realm', 'NA') == 'NA' and first.get('modeling_realm'):
+        dataset['instance']['realm'] = first['modeling_realm']
+    if len(dataset['version']['version']) < 9:
+        dataset['version']['version'] = first.get('version_number') or "NA"
+    return dataset
+
+def write_datasets(db, datasets):
+    ''' Add a batch of datasets to the database, with their versions and files
+        :return: number of files rows written and of files removed
+    '''
+    removals = [d for d in datasets if d.get('removed')]
+    datasets = [d for d in datasets if d['instance'] is not None]
+    inst_ids = bulk_upsert(db, Instance, [d['instance'] for d in datasets], inst_keys)
+    versions = []
+    for d, inst_id in zip(datasets, inst_ids):
+        d['version']['instance_id'] = inst_id
+        versions.append(d['version'])
+    vers_ids = bulk_upsert(db, Version, versions, vers_keys)
+    rows = []
+    modified = []
+    for d, vers_id in zip(datasets, vers_ids):
+        changed = set(d.get('modified', []))
+        for f in d['files']:
+            f['version_id'] = vers_id
+            rows.append(f)
+            modified.append(f['filename'] in changed)
+    file_ids = bulk_upsert(db, VersionFile, rows, file_keys)
+    # files modified in place get the new checksums and tracking id
+    updates = []
+    for f, file_id, changed in zip(rows, file_ids, modified):
+        if changed:
+            values = dict(id=file_id, md5=None, sha256=None)
+            values.update((k, f[k]) for k in f if k not in file_keys)
+            updates.append(values)
+    if updates:
+        db.bulk_update_mappings(VersionFile, updates)
+        db.commit()
+    return len(rows), remove_files(db, removals)
+
+def remove_files(db, datasets):
+    ''' Delete the files removed from the directories of a batch of datasets,
+        their versions and instances are kept, also when left without files
+        :return: number of files rows deleted
+    '''
+    removed = 0
+    for d in datasets:
+        ids = [v for v, in db.query(Version.id).filter(Version.path == d['version']['path'])]
+        if not ids:
+            continue
+        removed += db.query(VersionFile).filter(VersionFile.version_id.in_(ids),
+                VersionFile.filename.in_(d['removed'])).delete(synchronize_session=False)
+    db.commit()
+    return removed
+
+
+def _put(q, item, stop):
+    ''' Put an item in a bounded queue, giving up if the pipeline is stopped '''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _scanner(inputs, out, nworkers, stats, stop, errors):
+    try:
+        for path in inputs:
+            datasets = read_datasets(path)
+            while True:
+                start = time.time()
+                dataset = next(datasets, None)
+                if dataset is None:
+                    break
+                stats.add(1, len(dataset['files']), time.time() - start)
+                if not _put(out, dataset, stop):
+                    return
+    except Exception:
+        errors.append(sys.exc_info())
+        stop.set()
+    finally:
+        for _ in range(nworkers):
+            _put(out, _done, stop)
+
+def _worker(inq, out, cache, stats, stop, errors):
+    try:
+        while not stop.is_set():
+            try:
+                dataset = inq.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if dataset is _done:
+                break
+            start = time.time()
+            process_dataset(dataset, cache)
+            stats.add(1, len(dataset['files']), time.time() - start)
+            if not _put(out, dataset, stop):
+                break
+    except Exception:
+        errors.append(sys.exc_info())
+        stop.set()
+    finally:
+        _put(out, _done, stop)
+
+def ingest(db, inputs, workers=None, batch_size=200, queue_size=None, cache=None, progress=None):
+    ''' Add to the database the datasets listed in tmp/tree listings, download logs or scan
+        journals, deleting the rows of the files a journal lists as removed
+        :argument db: SQLAlchemy session
+        :argument inputs: list of input file paths, in any of the formats
+        :argument workers: number of threads calculating checksums and reading headers,
+                           default as for checksums
+        :argument batch_size: number of datasets written to the database at once
+        :argument queue_size: maximum number of datasets waiting between two stages,
+                              default twice the batch size
+        :argument cache: a ChecksumCache to use, default none
+        :argument progress: optional function called with the list of StageStats and
+                            the elapsed seconds after each batch is written
+        :return: list of StageStats for the scan, process and write stages, and the elapsed seconds,
+                 the write stage also counts the files removed from the database
+    '''
+    if workers is None:
+        workers = default_workers()
+    workers = max(workers, 1)
+    if queue_size is None:
+        queue_size = 2 * batch_size
+    stats = [StageStats('scan'), StageStats('process'), StageStats('write')]
+    scanned = queue.Queue(queue_size)
+    processed = queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+    threads = [threading.Thread(target=_scanner, args=(inputs, scanned, workers, stats[0], stop, errors))]
+    threads.extend(threading.Thread(target=_worker, args=(scanned, processed, cache, stats[1], stop, errors))
+                   for _ in range(workers))
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    begin = time.time()
+    try:
+        batch = []
+        finished = 0
+        while finished < workers and not stop.is_set():
+            try:
+                dataset = processed.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if dataset is _done:
+                finished += 1
+            else:
+                batch.append(dataset)
+            if batch and (len(batch) >= batch_size or finished == workers):
+                start = time.time()
+                nfiles, removed = write_datasets(db, batch)
+                stats[2].add(len(batch), nfiles, time.time() - start, removed)
+                batch = []
+                if progress is not None:
+                    progress(stats, time.time() - begin)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    if errors:
+        six.reraise(*errors[0])
+    return stats, time.time() - begin
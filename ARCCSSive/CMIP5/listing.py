@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Cached directory listings
+
+Listing a directory on Lustre costs tens of milliseconds, the same version
+directories are listed many times while comparing and updating the
+catalogue. Listings are kept in a per-process LRU cache and reused as long
+as the directory modification time doesn't change, adding, removing or
+renaming a file in a directory always changes it.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import fnmatch
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from ARCCSSive.CMIP5.checksums import default_workers
+from ARCCSSive.CMIP5.scan import scandir, _mtime_ns
+
+# Maximum number of directories kept in the cache
+cache_size = 4096
+
+# Directories modified less than this many seconds ago are not cached, as
+# further changes within the filesystem timestamp resolution wouldn't be seen
+racy_seconds = 2
+
+_listings = OrderedDict()
+_lock = threading.Lock()
+
+
+def clear_cache():
+    ''' Forget all the cached listings '''
+    with _lock:
+        _listings.clear()
+
+def listdir(path):
+    ''' Return the sorted names of the entries of a directory, cached while its
+        modification time doesn't change
+        :argument path: directory path
+        :return: list of names, empty if the directory doesn't exist
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return []
+    mtime = _mtime_ns(st)
+    key = (path, st.st_ino)
+    with _lock:
+        cached = _listings.get(key)
+        if cached is not None and cached[0] == mtime:
+            # most recently used at the end
+            del _listings[key]
+            _listings[key] = cached
+            return cached[1]
+    try:
+        if scandir is not None:
+            names = sorted(e.name for e in scandir(path))
+        else:
+            names = sorted(os.listdir(path))
+    except OSError:
+        return []
+    if time.time() - st.st_mtime > racy_seconds:
+        with _lock:
+            _listings[key] = (mtime, names)
+            while len(_listings) > cache_size:
+                _listings.popitem(last=False)
+    return names
+
+def glob_dir(path, pattern):
+    ''' Return the entries of a directory matching a file name pattern, as glob.glob(path/pattern)
+        would, hidden files match only patterns starting with '.'
+        :argument path: directory path, without wildcards
+        :argument pattern: file name pattern
+        :return: sorted list of paths
+    '''
+    names = fnmatch.filter(listdir(path), pattern)
+    if not pattern.startswith('.'):
+        names = [n for n in names if not n.startswith('.')]
+    return [os.path.join(path, n) for n in names]
+
+def _glob_dir(args):
+    return glob_dir(*args)
+
+def glob_dirs(paths, pattern, workers=None):
+    ''' Match a file name pattern in many directories in parallel
+        :argument paths: list of directory paths
+        :argument pattern: file name pattern, or a list with a pattern for each directory
+        :argument workers: number of threads, default as for checksums
+        :return: a list of glob_dir() results, in the same order as paths
+    '''
+    if isinstance(pattern, (list, tuple)):
+        args = list(zip(paths, pattern))
+    else:
+        args = [(p, pattern) for p in paths]
+    if workers is None:
+        workers = default_workers()
+    if workers <= 1 or len(args) <= 1:
+        return [_glob_dir(a) for a in args]
+    pool = ThreadPool(min(workers, len(args)))
+    try:
+        return pool.map(_glob_dir, args)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Schema migrations for existing catalogue files
+
+New databases get the full schema from :func:`ARCCSSive.CMIP5.connect()`,
+existing ones are brought up to date in place by applying the
+:data:`migrations` not yet recorded in their `schema_version` table. Every
+migration checks for what already exists, so applying one to a database
+that already has its changes is safe.
+"""
+
+from __future__ import print_function
+
+import re
+from datetime import date
+
+from sqlalchemy import func, text
+
+from ARCCSSive.CMIP5.Model import Base, Version, VersionFile, SchemaVersion
+
+
+def _create_indexes(connection, table, names):
+    """
+    Create the named indexes of a table as defined in the model, if missing
+    """
+    for index in Base.metadata.tables[table].indexes:
+        if index.name in names:
+            index.create(connection, checkfirst=True)
+
+def _composite_indexes(connection):
+    ''' Migration 1, indexes matching the search, comparison and update queries '''
+    _create_indexes(connection, 'instances', ['ix_instances_model_experiment_mip_ensemble'])
+    _create_indexes(connection, 'versions', ['ix_versions_instance_latest', 'ix_versions_dataset_id'])
+    _create_indexes(connection, 'files', ['ix_files_version_filename', 'ix_files_tracking_id'])
+
+# All migrations in order, as (version, description, function to apply it to a connection)
+migrations = [
+    (1, 'Composite indexes for search, comparison and update queries', _composite_indexes),
+    ]
+
+
+def current_version(engine):
+    ''' Return the schema version of a database, 0 if no migrations were applied
+        :argument engine: SQLAlchemy engine connected to the database
+        :return: version number
+    '''
+    SchemaVersion.__table__.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        version = connection.execute(func.max(SchemaVersion.__table__.c.version).select()).scalar()
+    return version or 0
+
+def pending(engine):
+    ''' Return the migrations not yet applied to a database
+        :argument engine: SQLAlchemy engine connected to the database
+        :return: list of (version, description, function)
+    '''
+    version = current_version(engine)
+    return [m for m in migrations if m[0] > version]
+
+def upgrade(engine, target=None):
+    ''' Apply the pending migrations, each in its own transaction
+        :argument engine: SQLAlchemy engine connected to the database
+        :argument target: last version to apply, default all
+        :return: list of the versions applied
+    '''
+    applied = []
+    for version, description, apply in pending(engine):
+        if target is not None and version > target:
+            break
+        with engine.begin() as connection:
+            apply(connection)
+            connection.execute(SchemaVersion.__table__.insert().values(
+                version=version, description=description,
+                applied_on=date.today().strftime('%Y-%m-%d')))
+        applied.append(version)
+    return applied
+
+
+def query_shapes(cmip5):
+    ''' Representative examples of the queries run by the library and scripts
+        :argument cmip5: a :class:`ARCCSSive.CMIP5.DB.Session`
+        :return: list of (name, SQLAlchemy query)
+    '''
+    return [
+        ('outputs', cmip5.outputs(variable='tas', experiment='historical', mip='Amon')),
+        ('outputs by model', cmip5.outputs(model='ACCESS1-3', experiment='historical')),
+        ('latest_outputs', cmip5.latest_outputs(variable='tas', experiment='historical')),
+        ('complete_ensembles', cmip5.complete_ensembles(['tas', 'pr'], experiment='historical', mip='Amon')),
+        ('instance versions', cmip5.query(Version).filter_by(instance_id=1)),
+        ('version by dataset_id', cmip5.query(Version).filter_by(dataset_id='cmip5.output1.x')),
+        ('version files', cmip5.query(VersionFile).filter_by(version_id=1, filename='tas.nc')),
+        ('file by tracking_id', cmip5.query(VersionFile).filter_by(tracking_id='x')),
+        ]
+
+def explain(cmip5):
+    ''' Report the query plan of each of the query_shapes(), SQLite databases only
+        :argument cmip5: a :class:`ARCCSSive.CMIP5.DB.Session`
+        :return: list of (name, indexes used, query plan lines)
+    '''
+    bind = cmip5.session.get_bind()
+    report = []
+    for name, query in query_shapes(cmip5):
+        sql = str(query.statement.compile(dialect=bind.dialect,
+                                          compile_kwargs={'literal_binds': True}))
+        plan = [row[-1] for row in cmip5.session.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+        indexes = sorted(set(i for line in plan
+                             for i in re.findall(r'USING (?:COVERING )?INDEX (\w+)', line)))
+        report.append((name, indexes, plan))
+    return report
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Global attributes of NetCDF files
+
+Reads in a single open all the global attributes the catalogue needs from a
+file. Classic and 64-bit offset files are read directly, parsing only the
+header at the start of the file, NetCDF4 files use netCDF4 or h5py, if
+available.
+"""
+
+from __future__ import print_function
+
+import struct
+import six
+from multiprocessing.pool import ThreadPool
+
+from ARCCSSive.CMIP5.checksums import default_workers
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# Global attributes read by default
+header_attributes = ['tracking_id', 'version_number', 'modeling_realm', 'creation_date', 'frequency']
+
+# Classic format types, as (struct format, size in bytes), 2 is char
+_nc_types = {1: ('b', 1), 2: ('s', 1), 3: ('h', 2), 4: ('i', 4), 5: ('f', 4), 6: ('d', 8),
+             7: ('B', 1), 8: ('H', 2), 9: ('I', 4), 10: ('q', 8), 11: ('Q', 8)}
+_NC_DIMENSION = 10
+_NC_ATTRIBUTE = 12
+
+
+def _value(value):
+    ''' Convert an attribute value read by any backend to a string, a number or a list '''
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if isinstance(value, list) and len(value) == 1:
+        value = value[0]
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    if isinstance(value, six.string_types):
+        value = value.rstrip('\x00')
+    return value
+
+class _ClassicHeader(object):
+    ''' Reader of the header of classic (CDF-1), 64-bit offset (CDF-2) and CDF-5 files '''
+    def __init__(self, f, version):
+        self.f = f
+        # CDF-5 uses 64 bit integers for counts and lengths
+        self.count = '>q' if version == 5 else '>i'
+
+    def read(self, fmt):
+        size = struct.calcsize(fmt)
+        data = self.f.read(size)
+        if len(data) != size:
+            raise ValueError('truncated NetCDF header')
+        return struct.unpack(fmt, data)
+
+    def read_count(self):
+        return self.read(self.count)[0]
+
+    def read_bytes(self, n):
+        ''' Read n bytes, skipping the padding to 4 bytes '''
+        data = self.f.read(n + (-n % 4))
+        if len(data) < n:
+            raise ValueError('truncated NetCDF header')
+        return data[:n]
+
+    def read_name(self):
+        return self.read_bytes(self.read_count()).decode('utf-8', 'replace')
+
+    def attributes(self, names):
+        ''' Return the requested global attributes, stops reading when all are found '''
+        # number of records, then the list of dimensions
+        self.read_count()
+        tag, ndims = self.read('>i')[0], self.read_count()
+        if tag not in (0, _NC_DIMENSION):
+            raise ValueError('invalid NetCDF dimension list')
+        for _ in range(ndims):
+            self.read_name()
+            self.read_count()
+        attrs = {}
+        tag, nattrs = self.read('>i')[0], self.read_count()
+        if tag not in (0, _NC_ATTRIBUTE):
+            raise ValueError('invalid NetCDF attribute list')
+        for _ in range(nattrs):
+            name = self.read_name()
+            nc_type = self.read('>i')[0]
+            n = self.read_count()
+            fmt, size = _nc_types[nc_type]
+            data = self.read_bytes(n * size)
+            if name in names:
+                if fmt == 's':
+                    attrs[name] = _value(data)
+                else:
+                    attrs[name] = _value(list(struct.unpack('>%d%s' % (n, fmt), data)))
+                if len(attrs) == len(names):
+                    break
+        return attrs
+
+def _hdf5_attributes(path, names):
+    ''' Return the requested global attributes of a NetCDF4 file '''
+    if netCDF4 is not None:
+        f = netCDF4.Dataset(path, 'r')
+        try:
+            present = set(f.ncattrs())
+            return dict((n, _value(f.getncattr(n))) for n in names if n in present)
+        finally:
+            f.close()
+    if h5py is not None:
+        with h5py.File(path, 'r') as f:
+            return dict((n, _value(f.attrs[n])) for n in names if n in f.attrs)
+    raise ValueError('netCDF4 or h5py are needed to read NetCDF4 files')
+
+def read_header(path, names=header_attributes):
+    ''' Read global attributes of a NetCDF file, opening it once
+        :argument path: file path
+        :argument names: list of attribute names
+        :return: dictionary {name: value} with None for missing attributes,
+                 None if the file isn't a valid NetCDF file
+    '''
+    try:
+        with open(path, 'rb') as f:
+            magic = bytearray(f.read(4))
+            if magic[:3] == b'CDF' and magic[3] in (1, 2, 5):
+                attrs = _ClassicHeader(f, magic[3]).attributes(names)
+            elif magic == b'\x89HDF':
+                attrs = None
+            else:
+                raise ValueError('not a NetCDF file')
+        if attrs is None:
+            attrs = _hdf5_attributes(path, names)
+    except (IOError, OSError, RuntimeError, ValueError, KeyError, struct.error):
+        print("INVALID NETCDF,%s" % path)
+        return None
+    return dict((n, attrs.get(n)) for n in names)
+
+def _read_header(args):
+    return read_header(*args)
+
+def read_headers(paths, names=header_attributes, workers=None):
+    ''' Read global attributes of a list of NetCDF files in parallel
+        :argument paths: list of file paths
+        :argument names: list of attribute names
+        :argument workers: number of threads, default as for checksums
+        :return: a list of read_header() results, in the same order as paths
+    '''
+    args = [(p, names) for p in paths]
+    if workers is None:
+        workers = default_workers()
+    if workers <= 1 or len(args) <= 1:
+        return [_read_header(a) for a in args]
+    pool = ThreadPool(min(workers, len(args)))
+    try:
+        return pool.map(_read_header, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -21,16 +21,18 @@ limitations under the License.
 from __future__ import print_function
 
 import os
+import csv
 import itertools
 from datetime import date
 import glob
-import subprocess
 import re
-#import cdms2 to open netcdf files
 from collections import defaultdict
 from ARCCSSive.data import mip_dict, frq_dict 
 from ARCCSSive.CMIP5.update_db_functions import add_bulk_items, update_item 
 from ARCCSSive.CMIP5.Model import Instance, VersionFile
+from ARCCSSive.CMIP5.checksums import checksum_files, default_cache
+from ARCCSSive.CMIP5.netcdf_header import read_header
+from ARCCSSive.CMIP5.listing import glob_dir
 
 
 def combine_constraints(**kwargs):
@@ -43,6 +45,46 @@ def combine_constraints(**kwargs):
     except:
         return [dict(zip(kwargs, x)) for x in itertools.product(*kwargs.values())]
 
+def constraint_values(value):
+    ''' Return a constraint as a list of values, constraints can be a single value or a list
+        :argument value: constraint value or list of values
+        :return: a list of values
+    '''
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+def match_constraint(key, attribute, value):
+    ''' Check if an instance attribute satisfies one constraint value,
+        experiment families like decadal match all experiments starting with the family name
+        :argument key: constraint field
+        :argument attribute: value of the field for the instance
+        :argument value: one constraint value
+        :return: True if matching
+    '''
+    if key == 'experiment' and value in experiment_families:
+        return attribute is not None and attribute.startswith(value)
+    return attribute == value
+
+def group_by_constraints(results, **kwargs):
+    ''' Split the results of a single search with multiple values per constraint
+        by the constraints combination each result satisfies
+        :argument results: Instances, or rows starting with an Instance, returned by a search
+        :argument kwargs: dictionary, keys are fields and values are single values or lists of values
+        :return: a list of (constraints, results) pairs, one for each constraints combination
+    '''
+    keys = list(kwargs.keys())
+    values = [constraint_values(kwargs[k]) for k in keys]
+    groups = [(c, []) for c in itertools.product(*values)]
+    index = dict((c, i) for i, (c, _) in enumerate(groups))
+    for r in results:
+        o = r if isinstance(r, Instance) else r[0]
+        matched = [[v for v in vals if match_constraint(k, getattr(o, k), v)]
+                   for k, vals in zip(keys, values)]
+        for c in itertools.product(*matched):
+            groups[index[c]][1].append(r)
+    return [(dict(zip(keys, c)), res) for c, res in groups]
+
 def join_varmip(var0,mip0):
     ''' List all combinations of selected variables and mips '''
     comb = ["_".join(x) for x in itertools.product(*[var0,mip0])]
@@ -85,43 +127,103 @@ def list_drstree(**kwargs):
     indir=drstree + drs_glob(**kwargs)
     return glob.glob(indir)
 
+# columns of tmp/tree listings
+tmpdir_keys=['variable','mip','model','experiment','ensemble','realm','version','path']
+# columns of the dataset and file lines of download logs
+logfile_keys=['variable','mip','model','experiment','ensemble','realm','version','dataset_id','path','cks_type']
+logfile_file_keys=['filename','tracking_id','checksum']
+
+def _split_line(flist, n, line, ncols):
+    ''' Split a csv line, checking it has one of the expected numbers of columns '''
+    values=line.split(',')
+    if len(values) not in ncols:
+        raise ValueError("%s line %d: expected %s columns, found %d" %
+                         (flist, n, " or ".join(str(x) for x in ncols), len(values)))
+    return values
+
+def iter_tmpdir(flist):
+    ''' Read a tmp/tree listing one instance at a time, skipping the header line
+        variable,mip_table,model,experiment,ensemble,realm,version,path
+        :return: generator of dictionaries, one for each line
+    '''
+    with open(flist,'r') as f:
+        next(f, None)
+        for n,line in enumerate(f,2):
+            line=line.rstrip("\r\n")
+            if line.strip()=="": continue
+            yield dict(zip(tmpdir_keys, _split_line(flist,n,line,[len(tmpdir_keys)])))
+
+def iter_logfile(flist):
+    ''' Read a download log one dataset at a time, each dataset line is followed by
+        a filename,tracking_id,checksum line for each of its files
+        The version copied from esgfcog dataset ids can keep the data node, as in
+        v20120101|esgfcog.ccs.ornl.gov, this is removed
+        :return: generator of dictionaries, one for each dataset, with its files
+                 as a list of dictionaries under 'files'
+    '''
+    ds_dict=None
+    with open(flist,'r') as f:
+        for n,line in enumerate(f,1):
+            line=line.rstrip("\r\n")
+            if line.strip()=="": continue
+            values=_split_line(flist,n,line,[len(logfile_file_keys),len(logfile_keys)])
+            if len(values)==len(logfile_keys):
+                if ds_dict is not None:
+                    yield ds_dict
+                ds_dict=dict(zip(logfile_keys, values))
+                ds_dict['version']=ds_dict['version'].split("|")[0]
+                ds_dict['files']=[]
+            elif ds_dict is None:
+                raise ValueError("%s line %d: file listed before any dataset" % (flist, n))
+            else:
+                ds_dict['files'].append(dict(zip(logfile_file_keys, values)))
+    if ds_dict is not None:
+        yield ds_dict
+
 def list_tmpdir(flist):
-    ''' this read from file list of instances on tmp/tree and return the ones matching constraints '''
-# skip first line
-# variable,mip_table,model,experiment,ensemble,realm,version,path
-    keys=['variable','mip','model','experiment','ensemble','realm','version','path']
-    f=open(flist,'r')
-    inst_list=[]
-    lines=f.readlines()
-    for line in lines[1:]:
-        values=line[:-1].split(',')
-        inst_list.append(dict(zip(keys, values)))
-    f.close()
-    return inst_list
+    ''' this read from file list of instances on tmp/tree and return the ones matching constraints,
+        use iter_tmpdir() to read large files '''
+    return list(iter_tmpdir(flist))
 
 def list_logfile(flist):
-    ''' this read from file list of instances from download log file and return the ones matching constraints '''
-    keys=['variable','mip','model','experiment','ensemble','realm','version','dataset_id','path','cks_type','files']
-    file_keys=['filename','tracking_id','checksum']
-    f=open(flist,'r')
-    inst_list=[]
-    file_list=[]
-    lines=f.readlines()
-    values=lines[0].replace("\n","").split(',')
-    ds_dict=dict(zip(keys[:-1], values))
-    for line in lines[1:]:
-        values=line.replace("\n","").split(',')
-        if len(values)<5:
-            file_list.append(dict(zip(file_keys, values)))
+    ''' this read from file list of instances from download log file and return the ones matching constraints,
+        use iter_logfile() to read large files '''
+    return list(iter_logfile(flist))
+
+# constraints accepted in the sets read by read_constraint_sets(), experiment and variable are required
+constraint_set_keys=['experiment','variable','model','mip','frequency','ensemble','version']
+
+def read_constraint_sets(path):
+    ''' Read the constraint sets of a batch comparison, either a YAML file (.yaml or .yml)
+        with a list of mappings or a csv file with a header line of constraint names,
+        values can be single values or lists, in a csv cell separated by spaces
+        :argument path: file path
+        :return: list of dictionaries {constraint: list of values}, without the empty constraints
+    '''
+    with open(path) as f:
+        if path.endswith(('.yaml','.yml')):
+            # optional dependency, needed only for YAML files
+            import yaml
+            rows=yaml.safe_load(f) or []
         else:
-            ds_dict['files']=file_list
-            inst_list.append(ds_dict)
-            file_list=[]
-            ds_dict=dict(zip(keys[:-1], values))
-    ds_dict['files']=file_list
-    inst_list.append(ds_dict)
-    f.close()
-    return inst_list
+            rows=list(csv.DictReader(f))
+    sets=[]
+    for n,row in enumerate(rows):
+        if not isinstance(row,dict):
+            raise ValueError("%s: constraint set %d is not a mapping"%(path,n+1))
+        unknown=[k for k in row.keys() if k not in constraint_set_keys]
+        if unknown:
+            raise ValueError("%s: unknown constraints %s in set %d"%(path,",".join(map(str,unknown)),n+1))
+        constraints={}
+        for k,v in row.items():
+            values=v if isinstance(v,list) else str(v or "").split()
+            if values!=[]:
+                constraints[k]=[str(x) for x in values]
+        for k in ['experiment','variable']:
+            if k not in constraints:
+                raise ValueError("%s: no %s in constraint set %d"%(path,k,n+1))
+        sets.append(constraints)
+    return sets
 
 def file_glob(**kwargs):
     """ Get the glob string matching the CMIP5 filename
@@ -170,11 +272,14 @@ def drs_details(path):
     return dummy.pop('frequency'), dummy
 
 def file_details(fname):
-    ''' Split the filename in variable, MIP code, model, experiment, ensemble (period is excluded) '''
+    ''' Split the filename in variable, MIP code, model, experiment, ensemble (period is excluded,
+        fx files have none), None if the filename has fewer fields '''
     keys=['variable','mip','model','experiment','ensemble']
+    if fname.endswith('.nc'):
+        fname = fname[:-3]
     values = fname.split('_')
     if len(values) >= 5:
-        return dict((keys[i],values[i]) for i  in range(len(values[:-1])))
+        return dict(zip(keys, values[:5]))
     else:
         return 
 
@@ -187,29 +292,19 @@ def find_version(bits,string):
         return dummy[0]
 
 def get_trackid(fpath):
-    ''' Return trackid from netcdf file '''
-    # open netcdf file
-    try:
-        f = cdms2.open(fpath,'r')
-    except:
-        print("INVALID NETCDF,%s" % fpath)
+    ''' Return trackid from netcdf file, use netcdf_header.read_headers() for lists of files '''
+    header=read_header(fpath,['tracking_id'])
+    if header is None:
         return "INVALID" 
-    # read tracking id attribute
-    try:
-        trackid=f.tracking_id
-    except:
-        trackid=None
-    # close file
-    f.close()
-    return trackid
+    return header['tracking_id']
 
 def list_drs_versions(path):
     ''' Returns matching string if found in directory structure '''
-    return [x.split("/")[-1] for x in glob.glob(path+"/v*")]
+    return [x.split("/")[-1] for x in glob_dir(path,"v*")]
 
 def list_drs_files(path):
     ''' Returns matching string if found in directory structure '''
-    return [x.split("/")[-1] for x in glob.glob(path+"/*.nc")]
+    return [x.split("/")[-1] for x in glob_dir(path,"*.nc")]
  
 def get_mip(filename):
     ''' Returns mip for instance 
@@ -226,14 +321,11 @@ def tree_path(drspath):
     return "/".join(path.split("/")[:-1])
 
 def check_hash(path,hash_type):
-    ''' Execute md5sum/sha256sum on file on tree and return checksum value '''
-    hash_cmd="md5sum"
-    if hash_type in ["SHA256","sha256"]: hash_cmd="sha256sum"
-    try:
-        return subprocess.check_output([hash_cmd, path]).split()[0]
-    except:
-        print("Warning cannot calculate ",hash_type," for file ",path)
-        return ""
+    ''' Calculate md5/sha256 checksum of file on tree and return checksum value,
+        using the checksum cache if the file didn't change,
+        use checksums.checksum_files() for lists of files '''
+    hash_type="sha256" if hash_type in ["SHA256","sha256"] else "md5"
+    return checksum_files([path],[hash_type],cache=default_cache())[0][hash_type]
 
 # functions to manage dictionaries
 def assign_mips(**kwargs):
@@ -248,17 +340,6 @@ def frequency(mip):
     ''' returns frequency for input mip '''
     return  mip_dict[mip]
 
-# functions to write logs
-def write_log(line):
-    ''' add str to log file, open new file if does not exist yet '''
-    global flog
-    try:
-        flog.write(line)
-    except:
-        flog=open(logfile,"a")
-        flog.write(line)
-    return
-      
 def unique(outputs,column_name):
     ''' Return all distinct values for selected column and search results '''
     column=getattr(Instance,column_name)
@@ -274,6 +355,9 @@ except KeyError:
     drstree = "/g/data1/ua6/DRSv2/CMIP5/GCM/"
 tmptree="/g/data1/ua6/unofficial-ESG-replica/tmp/tree/"
 
+# experiment names selecting all the experiments of a family, ie decadal1960, decadal1965, ..
+experiment_families = ['decadal', 'noVolc']
+
 # define date string for current date
 today = date.today().strftime('%Y-%m-%d')
 
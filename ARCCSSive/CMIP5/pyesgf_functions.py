@@ -24,6 +24,7 @@ from pyesgf.logon import LogonManager
 from pyesgf.search import SearchConnection
 from pyesgf.search.results import DatasetResult as DatasetResult
 from pyesgf.search.results import FileResult as FileResult
+from pyesgf.search.exceptions import EsgfSearchException
 from ARCCSSive.data import model_names_dict
 
 import sys
@@ -43,6 +44,31 @@ def logoff(lm):
     lm.logoff()
     return not lm.is_logged_on()
 
+class StoredSearchConnection(SearchConnection):
+    ''' SearchConnection replaying the responses recorded in a ResponseStore,
+        the searches missing from the store are sent to the node and recorded
+        :param url: search node url
+        :param store: ResponseStore of the recorded responses
+        :param offline: if True never query the node, replay also expired responses and
+            raise EsgfSearchException for the searches that weren't recorded
+        other arguments are passed to SearchConnection
+    '''
+    def __init__(self, url, store, offline=False, **kwargs):
+        SearchConnection.__init__(self, url, **kwargs)
+        self.store = store
+        self.offline = offline
+
+    def send_search(self, query_dict, limit=None, offset=None, shards=None):
+        ''' Return the json document for a search, from the store if recorded '''
+        query = list(self._build_query(query_dict, limit, offset, shards).items())
+        response = self.store.get(self.url, 'search', query, expired=self.offline)
+        if response is None:
+            if self.offline:
+                raise EsgfSearchException('Search not recorded in %s: %s' % (self.store.path, query))
+            response = SearchConnection.send_search(self, query_dict, limit, offset, shards)
+            self.store.put(self.url, 'search', query, response)
+        return response
+
 class ESGFSearch(object):
     ''' defines a ESGF search object 
         :param connection: The SearchConnection
@@ -75,6 +101,8 @@ class ESGFSearch(object):
              distrib: default True search across all nodes 
              replica: default False exclude replicas from results
              project: default CMIP5 ESGF project to search
+             store: ResponseStore to replay recorded responses from, default None always search the node
+             offline: default False, if True use only the responses in store
         :return: 
         ''' 
         # set default values for node, project, distributed search and replica
@@ -83,9 +111,13 @@ class ESGFSearch(object):
         if "distrib" in kwargs.keys(): distrib = kwargs.pop('distrib')
         if "replica" in kwargs.keys(): replica = kwargs.pop('replica')
         if "project" in kwargs.keys(): project = kwargs.pop('project')
+        store, offline = kwargs.pop('store', None), kwargs.pop('offline', False)
         if 'model' in kwargs.keys():
             kwargs['model']=self.model_names(kwargs['model']) 
-        self.conn = SearchConnection(node, distrib=distrib)
+        if store is not None:
+            self.conn = StoredSearchConnection(node, store, offline, distrib=distrib)
+        else:
+            self.conn = SearchConnection(node, distrib=distrib)
         self.ctx = self.conn.new_context(project=project, latest=True, 
                                            replica=replica, **kwargs)
         return 
@@ -166,9 +198,17 @@ def variables(self):
     self.variables=self.json['cf_standard_name']
     return
 
-def files(self):
-    ''' return list of FileResult for one  dataset object '''
-    return self.file_context().search()
+def files(self, refresh=False):
+    ''' return list of FileResult for one  dataset object
+        the files are searched only the first time and kept on the object,
+        use refresh=True or clear_files() to search them again '''
+    if refresh or getattr(self, '_files', None) is None:
+        self._files = list(self.file_context().search())
+    return self._files
+
+def clear_files(self):
+    ''' forget the files found by files(), the next call will search them again '''
+    self._files = None
 
 def filenames(self):
     ''' return list of filenames for files in the dataset object '''
@@ -186,6 +226,15 @@ def chksum_type(self):
     ''' return checksum_type for files in the dataset object '''
     return self.files()[0].checksum_type
 
+# columns returned by file_table()
+file_columns = ['filename', 'tracking_id', 'checksum', 'checksum_type', 'size', 'download_url']
+
+def file_table(self):
+    ''' return all the files details in the dataset object with one search,
+        as a dictionary with a list for each of file_columns '''
+    allfiles = self.files()
+    return dict((c, [getattr(f, c) for f in allfiles]) for c in file_columns)
+
 # all FileResult properties
 # 'checksum', 'checksum_type', 'context', 'download_url', 'file_id', 'filename', 'index_node', 'json', 'las_url', 'opendap_url', 'size', 'tracking_id', 'urls']
 
@@ -203,6 +252,8 @@ def get_variable(self):
 # Adding methods to DatasetResult class
 DatasetResult.variables = variables
 DatasetResult.files = files
+DatasetResult.clear_files = clear_files
+DatasetResult.file_table = file_table
 DatasetResult.filenames = filenames
 DatasetResult.tracking_ids = tracking_ids
 DatasetResult.checksums = checksums
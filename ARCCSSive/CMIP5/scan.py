@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Incremental scans of the drstree and tmp/tree directories
+
+The modification time of every directory and the size, modification time
+and inode of every file seen are kept in a :class:`ScanState` file. A new
+scan lists again only the directories whose modification time changed,
+files added, removed or renamed in a directory always change it, and
+returns a journal of the files added, removed or modified since the last
+scan. The journal can be saved with :func:`write_journal()` and passed to
+`arccssive-ingest`.
+"""
+
+from __future__ import print_function
+
+import os
+import csv
+import fnmatch
+import sqlite3
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# One file added, removed or modified since the last scan
+Change = namedtuple('Change', ['change', 'path', 'size', 'mtime_ns'])
+
+# Header line of journal files
+journal_header = list(Change._fields)
+
+
+def _mtime_ns(st):
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1e9)
+    return mtime
+
+def _list_dir(path, pattern):
+    ''' Return the sub-directories of path and the {file path: (size, mtime_ns, inode)}
+        of the files matching pattern, following symbolic links to files but not to
+        directories, such as the latest links of a drstree, so that files are found
+        under their real version directory
+    '''
+    dirs = []
+    files = {}
+    if scandir is None:
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            if os.path.islink(full) and os.path.isdir(full):
+                continue
+            if os.path.isdir(full):
+                dirs.append(full)
+            elif fnmatch.fnmatch(name, pattern):
+                files.update(_stat_files([full]))
+        return sorted(dirs), files
+    for entry in scandir(path):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif entry.is_file() and fnmatch.fnmatch(entry.name, pattern):
+                st = entry.stat()
+                files[entry.path] = (st.st_size, _mtime_ns(st), st.st_ino)
+        except OSError:
+            # broken symbolic links
+            pass
+    return sorted(dirs), files
+
+def _stat_files(paths):
+    ''' Return {file path: (size, mtime_ns, inode)} for the paths that still exist '''
+    files = {}
+    for p in paths:
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        files[p] = (st.st_size, _mtime_ns(st), st.st_ino)
+    return files
+
+
+class ScanState(object):
+    """
+    Directories and files seen by the last scan of one or more trees
+
+    :argument path: path of the SQLite state file, created if missing
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60)
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS scan_dirs (
+                path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS ix_scan_dirs_parent ON scan_dirs (parent)')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS scan_files (
+                path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS ix_scan_files_dir ON scan_files (dir)')
+
+    def close(self):
+        ''' Close the state file '''
+        self._db.close()
+
+    def __len__(self):
+        ''' Number of files known '''
+        return self._db.execute('SELECT count(*) FROM scan_files').fetchone()[0]
+
+    def dir_mtime(self, path):
+        row = self._db.execute('SELECT mtime_ns FROM scan_dirs WHERE path = ?', (path,)).fetchone()
+        return row[0] if row is not None else None
+
+    def subdirs(self, path):
+        return [r[0] for r in self._db.execute('SELECT path FROM scan_dirs WHERE parent = ? ORDER BY path', (path,))]
+
+    def files(self, path):
+        ''' Return {file path: (size, mtime_ns, inode)} of the files known in a directory '''
+        return dict((r[0], tuple(r[1:])) for r in self._db.execute(
+            'SELECT path, size, mtime_ns, inode FROM scan_files WHERE dir = ?', (path,)))
+
+    def update_dir(self, path, parent, mtime_ns, files, removed):
+        ''' Record the current state of a directory, files are {path: (size, mtime_ns, inode)} '''
+        self._db.execute('INSERT OR REPLACE INTO scan_dirs VALUES (?, ?, ?)', (path, parent, mtime_ns))
+        self._db.executemany('INSERT OR REPLACE INTO scan_files VALUES (?, ?, ?, ?, ?)',
+                             [(p, path) + s for p, s in files.items()])
+        self._db.executemany('DELETE FROM scan_files WHERE path = ?', [(p,) for p in removed])
+
+    def remove_tree(self, path):
+        ''' Forget a directory and everything under it
+            :return: list of Change for the files removed
+        '''
+        # everything from path + '/' up to path + '0', the next character
+        inside = (path, path + '/', path + '0')
+        removed = [Change('removed', r[0], r[1], r[2]) for r in self._db.execute(
+            'SELECT path, size, mtime_ns FROM scan_files WHERE dir = ? OR (dir >= ? AND dir < ?) '
+            'ORDER BY path', inside)]
+        self._db.execute('DELETE FROM scan_files WHERE dir = ? OR (dir >= ? AND dir < ?)', inside)
+        self._db.execute('DELETE FROM scan_dirs WHERE path = ? OR (path >= ? AND path < ?)', inside)
+        return removed
+
+    def commit(self):
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+
+def scan(root, state, pattern='*.nc', check_files=False):
+    ''' Scan a directory tree for files changed since the last scan
+        Directories with the same modification time as in the last scan are not
+        listed again, only their known sub-directories are visited. The state is
+        saved when the scan completes.
+        :argument root: top directory
+        :argument state: a ScanState
+        :argument pattern: file name pattern of the files to track
+        :argument check_files: also check the size, modification time and inode of the
+                               files in unchanged directories, to find files modified in place
+        :return: generator of Change, per directory
+    '''
+    root = os.path.abspath(root).rstrip('/') or '/'
+    stack = [(root, None)]
+    visited = set()
+    try:
+        while stack:
+            path, parent = stack.pop()
+            try:
+                st = os.stat(path)
+            except OSError:
+                if parent is None:
+                    for c in state.remove_tree(path):
+                        yield c
+                continue
+            # don't follow symbolic links back into the tree
+            real = os.path.realpath(path)
+            if real in visited:
+                continue
+            visited.add(real)
+
+            mtime = _mtime_ns(st)
+            if state.dir_mtime(path) != mtime:
+                subdirs, current = _list_dir(path, pattern)
+                known = state.files(path)
+                for old in set(state.subdirs(path)) - set(subdirs):
+                    for c in state.remove_tree(old):
+                        yield c
+            elif check_files:
+                subdirs = state.subdirs(path)
+                known = state.files(path)
+                current = _stat_files(known.keys())
+            else:
+                subdirs = state.subdirs(path)
+                current = None
+
+            if current is not None:
+                changes = []
+                for p in sorted(set(known) | set(current)):
+                    if p not in current:
+                        changes.append(Change('removed', p, known[p][0], known[p][1]))
+                    elif p not in known:
+                        changes.append(Change('added', p, current[p][0], current[p][1]))
+                    elif current[p] != known[p]:
+                        changes.append(Change('modified', p, current[p][0], current[p][1]))
+                state.update_dir(path, parent, mtime,
+                                 dict((c.path, current[c.path]) for c in changes if c.change != 'removed'),
+                                 [c.path for c in changes if c.change == 'removed'])
+                for c in changes:
+                    yield c
+            stack.extend((d, path) for d in reversed(subdirs))
+    except:
+        state.rollback()
+        raise
+    state.commit()
+
+def write_journal(changes, path):
+    ''' Write changes to a journal csv file
+        :return: number of changes written
+    '''
+    n = 0
+    with open(path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(journal_header)
+        for c in changes:
+            writer.writerow(c)
+            n += 1
+    return n
+
+def read_journal(path):
+    ''' Read a journal csv file
+        :return: generator of Change
+    '''
+    with open(path, 'r') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            yield Change(row[0], row[1], int(row[2]), int(row[3]))
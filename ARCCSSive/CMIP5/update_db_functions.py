@@ -20,6 +20,7 @@ limitations under the License.
 
 from __future__ import print_function
 
+from sqlalchemy import tuple_, and_, or_
 from sqlalchemy.orm.exc import NoResultFound
 #from ARCCSSive.CMIP5.Model import Instance, Version, VersionFile, VersionWarning
 
@@ -57,6 +58,65 @@ def add_bulk_items(db, klass, rows):
     db.commit()
     return
 
+def bulk_upsert(db, klass, rows, key_columns, batch_size=500):
+    """Insert the rows that are not in the DB yet, in batches
+       Existing rows are found by their key columns with one query per batch,
+       the missing ones are added with a single INSERT and each batch is committed once
+       Duplicated rows within the input are inserted once. Only instances have a
+       unique constraint, conflicts with rows added by another session in the
+       meantime are skipped for them on SQLite and PostgreSQL, other tables can
+       get duplicates if written concurrently
+       input: rows is a list of dictionaries, key_columns is a list of fields identifying a row
+       Returns the list of ids, in the same order as rows """
+    ids = []
+    columns = set(c for r in rows for c in r.keys())
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start+batch_size]
+        existing = _find_keys(db, klass, batch, key_columns)
+        missing = []
+        for r in batch:
+            key = tuple(r.get(k) for k in key_columns)
+            if key not in existing:
+                existing[key] = None
+                missing.append(dict((c, r.get(c)) for c in columns))
+        if missing:
+            db.execute(_insert_ignore(db, klass), missing)
+            existing.update(_find_keys(db, klass, missing, key_columns))
+        db.commit()
+        ids.extend(existing[tuple(r.get(k) for k in key_columns)] for r in batch)
+    return ids
+
+def _find_keys(db, klass, rows, key_columns):
+    """Return a dictionary {key values: id} of the rows already in the DB
+       Rows are matched on all the key columns at once, the few with a null key
+       value are matched one by one as NULL never compares equal in SQL"""
+    keys = [getattr(klass, k) for k in key_columns]
+    wanted = set(tuple(r.get(k) for k in key_columns) for r in rows)
+    complete = [w for w in wanted if None not in w]
+    clauses = []
+    if complete:
+        clauses.append(tuple_(*keys).in_(complete))
+    for w in wanted:
+        if None in w:
+            clauses.append(and_(*[k.is_(None) if v is None else k == v for k, v in zip(keys, w)]))
+    found = db.query(klass.id, *keys).filter(or_(*clauses)) if clauses else []
+    return dict((tuple(x[1:]), x[0]) for x in found if tuple(x[1:]) in wanted)
+
+def _insert_ignore(db, klass):
+    """INSERT statement skipping rows that violate a unique constraint, where supported
+       Tables without unique constraints get a plain INSERT in effect"""
+    dialect = db.get_bind().dialect.name
+    try:
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            return klass.__table__.insert()
+    except ImportError:
+        return klass.__table__.insert()
+    return insert(klass.__table__).on_conflict_do_nothing()
+
 def update_item(db, klass, item_id, newvalues):
     '''Update database item 
        :argument: db database SQLalchemy connection session 
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# This calculates the checksums of the files in a directory tree ahead of a comparison and keeps them in the checksum cache.
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+from ARCCSSive.CMIP5.checksums import ChecksumCache, default_cache, checksum_files, hash_types
+import argparse
+import fnmatch
+import os
+import sys
+
+def parse_input():
+    ''' Parse input arguments '''
+    parser = argparse.ArgumentParser(description=r'''Manages the cache of file checksums used by
+             the catalogue update and comparison scripts.
+             Calculates the checksums of all the files matching the pattern under each directory,
+             only files new or changed since they were last hashed are read.
+             -e removes the entries of deleted or changed files, with -a also those not used in that many days
+             By default it uses the cache set by the ARCCSSIVE_CHECKSUM_CACHE environment variable.''',
+             formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('directory', type=str, nargs="*", help='directories to prewarm')
+    parser.add_argument('-c','--cache', type=str, help='checksum cache file', required=False)
+    parser.add_argument('-t','--type', type=str, nargs="*", choices=hash_types, default=hash_types,
+                        help='checksum types to calculate', required=False)
+    parser.add_argument('-p','--pattern', type=str, default='*.nc', help='file name pattern, default *.nc', required=False)
+    parser.add_argument('-w','--workers', type=int, help='number of threads used to calculate checksums', required=False)
+    parser.add_argument('-e','--evict', action='store_true', default=False, help='remove stale entries', required=False)
+    parser.add_argument('-a','--max-age', type=int, help='with -e remove also entries not used in MAX_AGE days', required=False)
+    return vars(parser.parse_args())
+
+def walk_files(directory, pattern):
+    ''' Return the paths of all files matching pattern under directory '''
+    for root, dirs, files in os.walk(directory, followlinks=True):
+        for f in sorted(fnmatch.filter(files, pattern)):
+            yield os.path.join(root, f)
+
+def prewarm(cache, directory, types=hash_types, pattern='*.nc', workers=None, batch=1000):
+    ''' Add to the cache the checksums of all the files under directory
+        :argument cache: a ChecksumCache
+        :return: number of files checked
+    '''
+    count = 0
+    paths = []
+    for path in walk_files(directory, pattern):
+        paths.append(path)
+        if len(paths) == batch:
+            checksum_files(paths, types, workers, cache)
+            count += len(paths)
+            paths = []
+    checksum_files(paths, types, workers, cache)
+    return count + len(paths)
+
+def main():
+    kwargs = parse_input()
+    if kwargs['cache']:
+        cache = ChecksumCache(kwargs['cache'])
+    else:
+        cache = default_cache()
+    if cache is None:
+        sys.exit("The checksum cache is disabled")
+
+    if kwargs['evict']:
+        print("removed", cache.evict(kwargs['max_age']), "entries")
+    for d in kwargs['directory']:
+        print(d, prewarm(cache, d, kwargs['type'], kwargs['pattern'], kwargs['workers']), "files")
+    print(cache.path, len(cache), "entries")
+
+if __name__ == '__main__':
+    # check python version and then call main()
+    if sys.version_info < ( 2, 7):
+        # python too old, kill the script
+        sys.exit("This script requires Python 2.7 or newer!")
+
+    main()
@@ -22,8 +22,12 @@ from __future__ import print_function
 
 from ARCCSSive.CMIP5 import connect
 from ARCCSSive.CMIP5.pyesgf_functions import ESGFSearch 
-from ARCCSSive.CMIP5.other_functions import assign_mips, combine_constraints 
+from ARCCSSive.CMIP5.esgf_store import ResponseStore
+from ARCCSSive.CMIP5.other_functions import assign_mips, group_by_constraints, experiment_families, read_constraint_sets
 from ARCCSSive.CMIP5.compare_helpers import *
+from multiprocessing.pool import ThreadPool
+import csv
+import shutil
 import sys
 from six.moves import input
 from distutils.util import strtobool
@@ -56,11 +60,21 @@ def parse_input():
             no replicas, PCMDI node and CMIP5 project. If you change project you need to export a different local database,
             currently only geomip is available:
                export CMIP5_DB=sqlite:////g/data1/ua6/unofficial-ESG-replica/tmp/tree/geomip_latest.db 
+            Batch mode (-b) compares without asking for confirmation the constraint sets listed in
+            a YAML or csv file, instead of the constraints passed as arguments, e.g. in YAML:
+               - {experiment: historical, variable: [tas, pr], mip: Amon}
+               - {experiment: rcp45, variable: tas, model: ACCESS1-3}
+            or as csv with a header line of constraint names and values separated by spaces:
+               experiment,variable,mip,model
+               historical,tas pr,Amon,
+            A version constraint compares only the local and ESGF versions listed.
+            --no-compare and --submit replace the answers to the questions.
+            The request files and a csv summary of every constraints combination are written at the end.
                ''',formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-a','--admin', action='store_true', default=False, help='running script as admin', required=False)
-    parser.add_argument('-e','--experiment', type=str, nargs="*", help='CMIP5 experiment', required=True)
+    parser.add_argument('-e','--experiment', type=str, nargs="*", help='CMIP5 experiment', required=False)
     parser.add_argument('-m','--model', type=str, nargs="*", help='CMIP5 model', required=False)
-    parser.add_argument('-v','--variable', type=str, nargs="*", help='CMIP5 variable', required=True)
+    parser.add_argument('-v','--variable', type=str, nargs="*", help='CMIP5 variable', required=False)
     parser.add_argument('-t','--mip', type=str, nargs="*", help='CMIP5 MIP table', required=False)
     parser.add_argument('-f','--frequency', type=str, nargs="*", help='CMIP5 frequency', required=False)
     parser.add_argument('-en','--ensemble', type=str, nargs="*", help='CMIP5 ensemble', required=False)
@@ -68,16 +82,40 @@ def parse_input():
     parser.add_argument('-r','--replica', help='search also replica', action='store_true', required=False)
     parser.add_argument('-n','--node', type=str, help='ESGF node to use for search', required=False)
     parser.add_argument('-p','--project', type=str, help='ESGF project to search', required=False)
-    return vars(parser.parse_args())
+    parser.add_argument('-j','--jobs', type=int, default=8, help='number of concurrent ESGF file searches, default 8', required=False)
+    parser.add_argument('--rate', type=float, default=4, help='maximum file searches per second to each ESGF index node, default 4', required=False)
+    parser.add_argument('--retries', type=int, default=3, help='times a failed ESGF file search is tried again, default 3', required=False)
+    parser.add_argument('--replay', action='store_true', default=False, help='replay the ESGF responses recorded by previous runs, recording the new ones', required=False)
+    parser.add_argument('--offline', action='store_true', default=False, help='use only the recorded ESGF responses, never search the node', required=False)
+    parser.add_argument('--ttl', type=float, default=24, help='hours a recorded ESGF response is replayed, default 24', required=False)
+    parser.add_argument('-b','--batch', type=str, help='YAML or csv file of constraint sets to compare in batch mode', required=False)
+    parser.add_argument('--no-compare', action='store_true', default=False, help='batch mode, only write current results without comparing', required=False)
+    parser.add_argument('--submit', action='store_true', default=False, help='batch mode, submit the requests to download new files', required=False)
+    parser.add_argument('--searches', type=int, default=4, help='batch mode, number of constraints combinations searched on ESGF concurrently, default 4', required=False)
+    args = vars(parser.parse_args())
+    if args['batch'] is None and (args['experiment'] is None or args['variable'] is None):
+        parser.error("the following arguments are required: -e/--experiment, -v/--variable, unless using -b/--batch")
+    return args
 
 def assign_constraints():
     ''' Assign default values and input to constraints '''
     kwargs = parse_input()
     admin = kwargs.pop("admin")
+    batchargs={}
+    for k in ['batch','no_compare','submit','searches']:
+        batchargs[k] = kwargs.pop(k)
     searchargs={}
     searchargs['replica'] = kwargs.pop("replica")
     searchargs['project'] = kwargs.pop("project")
     searchargs['node'] = kwargs.pop("node")
+    replay, offline, ttl = kwargs.pop("replay"), kwargs.pop("offline"), kwargs.pop("ttl")
+    if replay or offline:
+        searchargs['store'] = ResponseStore(ttl=ttl*3600)
+        searchargs['offline'] = offline
+    fetchargs={}
+    fetchargs['workers'] = kwargs.pop("jobs")
+    fetchargs['rate'] = kwargs.pop("rate")
+    fetchargs['retries'] = kwargs.pop("retries")
     # this can be only changed manuallyi, default True means that the search is distributed across all ESGF nodes
     #searchargs['distrib'] = True
     variables = kwargs.pop("variable")
@@ -93,14 +131,169 @@ def assign_constraints():
         if v is None or v==[]: newkwargs.pop(k)
     for k,v in list(searchargs.items()):
         if v is None or v==[]: searchargs.pop(k)
-    return newkwargs, variables, admin, searchargs
+    return newkwargs, variables, admin, searchargs, fetchargs, batchargs
+
+# directory where requests for downloads are stored
+requests_dir="/g/data1/ua6/unofficial-ESG-replica/tmp/pxp581/requests/"
+
+def batch_constraints(constraints):
+    ''' Split a constraint set from read_constraint_sets() in search constraints, variables
+        and versions, None if any, adding the mips of the frequencies as assign_constraints()
+        Versions aren't instance attributes, they select the local and remote versions compared '''
+    kwargs=dict(constraints)
+    variables=kwargs.pop('variable')
+    versions=kwargs.pop('version',None)
+    kwargs['mip']=assign_mips(frq=kwargs.pop('frequency',None),mip=kwargs.get('mip'))
+    if kwargs['mip']==[]: kwargs.pop('mip')
+    return kwargs, variables, versions
+
+def esgf_search(searchargs, fetchargs, constraints, variables, limiter=None):
+    ''' Search ESGF for the datasets matching a constraints combination and their files
+        :return: (number of datasets found, list of dictionaries from retrieve_ds() for each variable)
+    '''
+    # you can use the key 'distrib'=False to search only one node 
+    # for more info look at pyesgf module documentation
+    esgfargs=searchargs.copy()
+    esgfargs.update(constraints)
+    if 'mip' in constraints.keys():
+        esgfargs['cmor_table']=esgfargs.pop('mip')
+    if constraints['experiment'] in experiment_families:
+        esgfargs['query']=esgfargs.pop('experiment')+"%"
+    esgf=ESGFSearch()
+    esgf.search_node(**esgfargs)
+    esgf_results=[]
+    # the files of each dataset are searched concurrently, 8 at a time by default
+    # as it is the number of VCPU on VDI, limiting the rate of requests to each node
+    if esgf.ds_count()>=1:
+        results=[(ds,variables) for ds in esgf.get_ds()]
+        for ds_info in retrieve_all(results, limiter=limiter, **fetchargs):
+            esgf_results.extend(ds_info)
+    return esgf.ds_count(), esgf_results
+
+def write_request(kind, urls, dataset_info, outdir):
+    ''' Write the urls of the files to download in <kind>_<user>_<date>.txt
+        and the datasets info in the outdir directory
+        :argument kind: 'request' for new files, 'update' for files to update
+        :return: name of the file with the urls
+    '''
+    user_date="_".join([os.environ['USER'],datetime.now().strftime("%Y%m%dT%H%M")+".txt"])
+    outfile=kind+"_"+user_date
+    with open(outdir+{'request': "dsinfo_", 'update': "up-dsinfo_"}[kind]+user_date,'w') as ds_info:
+        ds_info.writelines(dataset_info)
+    with open(outfile,"w") as fout:
+        for s in urls:
+            fout.write("'" +s + "'\n")
+    return outfile
+
+# columns of the batch summary, after the constraints
+summary_columns=['variables','local_versions','remote_datasets','new_files','update_files','status']
+
+def write_summary(summary, filename):
+    ''' Write a csv file with a row for each constraints combination of a batch comparison '''
+    keys=sorted(set(k for row in summary for k in row.keys() if k not in summary_columns))
+    with open(filename,"w") as fout:
+        writer=csv.writer(fout, lineterminator="\n")
+        writer.writerow(keys+summary_columns)
+        for row in summary:
+            writer.writerow([row.get(k,"") for k in keys+summary_columns])
+
+def run_batch(cmip5, constraint_sets, admin, searchargs, fetchargs, compare=True, submit=False,
+              searches=4, outdir=requests_dir):
+    ''' Compare every constraints combination of a list of constraint sets without asking for confirmation
+        The local searches run first, then the ESGF searches of all the combinations concurrently
+        sharing the limit on the requests to each node, then the comparisons, updating the database
+        or the log one at a time, and at the end the request files and summaries are written
+        :argument cmip5: CMIP5 database session
+        :argument constraint_sets: list of constraint sets from read_constraint_sets()
+        :argument compare: if False only write the current results, as answering N to the first question
+        :argument submit: copy the request file of new files to outdir, as answering Y to the second question
+        :argument searches: number of combinations searched on ESGF at once
+        :return: list of summary rows, one for each constraints combination
+    '''
+    # local search, one query for each constraint set
+    jobs=[]
+    for constraints in constraint_sets:
+        kwargs, variables, versions = batch_constraints(constraints)
+        outputs=cmip5.outputs(load='versions+files',**kwargs).filter(Instance.variable.in_(variables))
+        for combination,local_outputs in group_by_constraints(outputs, **kwargs):
+            db_results=[v for o in local_outputs for v in o.versions if versions is None or v.version in versions]
+            jobs.append((combination, variables, db_results, versions))
+    print(len(jobs), "constraints combinations in", len(constraint_sets), "constraint sets")
+
+    # remote searches, a failed search skips only its combination
+    limiter=NodeRateLimiter(fetchargs.get('rate'))
+    def search_remote(job):
+        try:
+            return esgf_search(searchargs, fetchargs, job[0], job[1], limiter)
+        except Exception as e:
+            print("ESGF search failed for constraints:\n", job[0], "and variables:", job[1], "\n", e)
+            return None
+    pool=ThreadPool(max(1, min(searches, len(jobs))))
+    try:
+        remote_results=pool.map(search_remote, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    print("Finished to retrieve remote data")
+
+    # compare local to remote info
+    matrix=defaultdict(lambda: defaultdict(list))
+    log = None if admin else user_log()
+    urls, dataset_info, upd_urls, up_dataset_info, summary = [], [], [], [], []
+    for (combination, variables, db_results, versions), result in zip(jobs, remote_results):
+        ds_count, esgf_results = result or (0, [])
+        if versions is not None:
+            esgf_results=[ds for ds in esgf_results if ds['version'] in versions]
+        new, upd = [], []
+        if result is None:
+            status="search failed"
+        elif esgf_results==[]:
+            status="not on ESGF"
+        elif not compare:
+            status="not compared"
+        else:
+            esgf_results, db_results=compare_instances(cmip5.session, esgf_results, db_results, combination.keys(), admin, log)
+            new, new_info = new_files(esgf_results)
+            upd, upd_info = update_files(db_results, esgf_results)
+            urls.extend(new)
+            dataset_info.extend(new_info)
+            upd_urls.extend(upd)
+            up_dataset_info.extend(upd_info)
+            status="compared"
+        if versions is not None:
+            combination=dict(combination, version=" ".join(versions))
+        summary.append(dict(combination, variables=" ".join(variables), local_versions=len(db_results),
+                            remote_datasets=ds_count, new_files=len(new), update_files=len(upd), status=status))
+        for var in variables:
+            remote=[ds for ds in esgf_results if ds['variable']==var]
+            local=[v for v in db_results if v.variable.__dict__['variable']==var]
+            if remote != [] or local != []:
+                matrix = result_matrix(matrix,combination['experiment'],var,remote,local)
+    if log is not None:
+        log.close()
+
+    # write requests and summaries
+    if upd_urls!=[]:
+        print(len(upd_urls), "files to update written in", write_request("update", upd_urls, up_dataset_info, outdir))
+    if urls!=[]:
+        outfile=write_request("request", urls, dataset_info, outdir)
+        print(len(urls), "new files to download written in", outfile)
+        if submit: shutil.copy(outfile, outdir+outfile)
+    write_summary(summary, "summary_"+os.environ['USER']+"_"+datetime.now().strftime("%Y%m%dT%H%M")+".csv")
+    for exp in list(matrix.keys()):
+        write_table(matrix,exp)
+    return summary
 
 def main():
 
     # assign constraints from input
-    kwargs, variables, admin, searchargs = assign_constraints()
-    # define directory where requests for downloads are stored
-    outdir="/g/data1/ua6/unofficial-ESG-replica/tmp/pxp581/requests/"
+    kwargs, variables, admin, searchargs, fetchargs, batchargs = assign_constraints()
+    outdir=requests_dir
+    if batchargs['batch'] is not None:
+        run_batch(connect(), read_constraint_sets(batchargs['batch']), admin, searchargs, fetchargs,
+                  compare=not batchargs['no_compare'], submit=batchargs['submit'],
+                  searches=batchargs['searches'], outdir=outdir)
+        return
 
     # a list fo the standard unique constraints defining one instance in the database
     # initialize dictionary of exp/matrices
@@ -108,46 +301,24 @@ def main():
     # open connection to local database and intiate SQLalchemy session 
     cmip5 = connect()
 
-    # get constraints combination
-    combs=combine_constraints(**kwargs)
-    # initiate ESGFsearch object 
-    esgf=ESGFSearch()
+    # search on local DB all the constraints combinations with a single query
+    outputs=cmip5.outputs(load='versions+files',**kwargs).filter(Instance.variable.in_(variables))
+    # non-admin users record the changes to the database in a log for the admins to apply
+    log = None if admin else user_log()
     # for each constraints combination
-    for constraints in combs:
+    for constraints,local_outputs in group_by_constraints(outputs, **kwargs):
         db_results=[]
         esgf_results=[]
         print(constraints)
         print(variables)
         orig_args=constraints.copy()
-    # search on local DB, return instance_ids
-        if constraints['experiment'] in ['decadal','noVolc']:
-            exp0=constraints.pop('experiment')
-            outputs=cmip5.outputs(**constraints).filter(Instance.experiment.like(exp0+"%")).filter(Instance.variable.in_(variables))
-        else:
-            outputs=cmip5.outputs(**constraints).filter(Instance.variable.in_(variables))
     # loop through returned Instance objects
-        db_results=[v for o in outputs for v in o.versions]
+        db_results=[v for o in local_outputs for v in o.versions]
     # search in ESGF database
-    # you can use the key 'distrib'=False to search only one node 
-    # for more info look at pyesgf module documentation
-        esgfargs=searchargs.copy()
-        esgfargs.update(constraints)
-        if 'mip' in constraints.keys():
-            esgfargs['cmor_table']=esgfargs.pop('mip')
-        if 'exp0' in locals():
-            esgfargs['query']=exp0+"%"
-        esgf.search_node(**esgfargs)
-        print("Found ",esgf.ds_count(),"simulations for constraints")
-    # loop returned DatasetResult objects
-    # using multiprocessing Pool to parallelise process_file
-    # using 8 here as it is the number ov VCPU on VDI
-        if esgf.ds_count()>=1:
-            results=[(ds,variables) for ds in esgf.get_ds()]
-            async_results = map(retrieve_ds, results)
-            for ds_info in async_results:
-                esgf_results.extend(ds_info)
     # append to results list of version dictionaries containing useful info 
     # NB search should return only one latest, not replica version if any
+        ds_count, esgf_results = esgf_search(searchargs, fetchargs, constraints, variables)
+        print("Found ",ds_count,"simulations for constraints")
             
     # compare local to remote info
         print("Finished to retrieve remote data")
@@ -157,40 +328,24 @@ def main():
             else: 
                 print("Nothing currently available on ESGF nodes and no local version exists for constraints:\n",constraints,"and variables:",variables)
         else:
-            print(esgf.ds_count(),"instances were found on ESGF and ",outputs.count()," on the local database")
+            print(ds_count,"instances were found on ESGF and ",len(local_outputs)," on the local database")
             request = query_yes_no("Do you want to proceed with comparison (Y) or write current results (N) ? Y/N \n")
             if request:
-                esgf_results, db_results=compare_instances(cmip5.session, esgf_results, db_results, orig_args.keys(), admin)
+                esgf_results, db_results=compare_instances(cmip5.session, esgf_results, db_results, orig_args.keys(), admin, log)
 
     # build table to summarise results
                 urls,dataset_info=new_files(esgf_results)
                 upd_urls,up_dataset_info=update_files(db_results,esgf_results)
                 if upd_urls!=[]:
-                    user_date="_".join([os.environ['USER'],datetime.now().strftime("%Y%m%dT%H%M")+".txt"])
-                    outfile="update_"+user_date
-                    fout=open(outfile,"w")
-                    ds_info=open(outdir+"up-dsinfo_"+user_date,'w')
-                    for line in up_dataset_info:
-                        ds_info.write(line)
-                    ds_info.close()
+                    write_request("update", upd_urls, up_dataset_info, outdir)
                     print("These are files to update:\n")
                     for s in upd_urls:
                         print(s.split("'")[0])
-                        fout.writelines("'" +s + "'\n")
-                    fout.close()
                 if urls!=[]:
-                    user_date="_".join([os.environ['USER'],datetime.now().strftime("%Y%m%dT%H%M")+".txt"])
-                    outfile="request_"+user_date
-                    fout=open(outfile,"w")
-                    ds_info=open(outdir+"dsinfo_"+user_date,'w')
-                    for line in dataset_info:
-                        ds_info.write(line)
-                    ds_info.close()
+                    outfile=write_request("request", urls, dataset_info, outdir)
                     print("These are new files to download:\n")
                     for s in urls:
                         print(s.split("'")[0])
-                        fout.writelines("'" +s + "'\n")
-                    fout.close()
                     request2 = query_yes_no("submit a request to download these files? Y/N \n")
                     if request2: os.system ("cp %s %s" % (outfile, outdir+outfile)) 
         for var in variables:
@@ -198,6 +353,8 @@ def main():
             local=[v for v in db_results if v.variable.__dict__['variable']==var]
             if remote != [] or local != []:
                 matrix = result_matrix(matrix,orig_args['experiment'],var,remote,local)
+    if log is not None:
+        log.close()
     #write a table to summarise comparison results for each experiment in csv file
     if matrix:
         for exp in kwargs['experiment']:
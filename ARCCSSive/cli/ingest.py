@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# This adds to the catalogue database the datasets listed in tmp/tree listings, download logs or scan journals.
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+from ARCCSSive.CMIP5 import connect
+from ARCCSSive.CMIP5.ingest import ingest
+from ARCCSSive.CMIP5.checksums import default_cache
+import argparse
+import sys
+
+def parse_input():
+    ''' Parse input arguments '''
+    parser = argparse.ArgumentParser(description=r'''Adds to the CMIP5 catalogue database the datasets
+             listed in tmp/tree listings (csv files starting with the header line
+             variable,mip_table,model,experiment,ensemble,realm,version,path)
+             in download logs produced by compare_ESGF
+             or in journals of the files added, modified or removed written by arccssive-scan.
+             Files are scanned, hashed and their headers read in parallel, while a single
+             writer adds the datasets to the database in batches.
+             By default it uses the database set by the CMIP5_DB environment variable.''',
+             formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('input', type=str, nargs="+", help='tmp/tree listings, download logs or scan journals')
+    parser.add_argument('-d','--database', type=str, help='database URL, e.g. sqlite:////path/to/cmip5.db', required=False)
+    parser.add_argument('-w','--workers', type=int, help='number of threads calculating checksums and reading headers', required=False)
+    parser.add_argument('-b','--batch-size', type=int, default=200, help='datasets written to the database at once, default 200', required=False)
+    parser.add_argument('-q','--queue-size', type=int, help='datasets waiting between stages, default twice the batch size', required=False)
+    parser.add_argument('-n','--no-cache', action='store_true', default=False, help='do not use the checksum cache', required=False)
+    return vars(parser.parse_args())
+
+def print_progress(stats, elapsed):
+    ''' Print the throughput of each stage so far '''
+    print("after %.1fs" % elapsed)
+    for s in stats:
+        print("  " + s.report(elapsed))
+
+def main():
+    kwargs = parse_input()
+    cmip5 = connect(kwargs['database'])
+    cache = None if kwargs['no_cache'] else default_cache()
+
+    stats, elapsed = ingest(cmip5.session, kwargs['input'], workers=kwargs['workers'],
+                            batch_size=kwargs['batch_size'], queue_size=kwargs['queue_size'],
+                            cache=cache, progress=print_progress)
+    print("Completed in %.1fs" % elapsed)
+    for s in stats:
+        print("  " + s.report(elapsed))
+
+if __name__ == '__main__':
+    # check python version and then call main()
+    if sys.version_info < ( 2, 7):
+        # python too old, kill the script
+        sys.exit("This script requires Python 2.7 or newer!")
+
+    main()
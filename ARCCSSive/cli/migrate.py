@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# This applies schema migrations to an existing catalogue database and reports which indexes its queries use.
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+from ARCCSSive.CMIP5 import connect
+from ARCCSSive.CMIP5 import migrate
+import argparse
+import sys
+
+def parse_input():
+    ''' Parse input arguments '''
+    parser = argparse.ArgumentParser(description=r'''Brings an existing CMIP5 catalogue database
+             up to the current schema, applying in place the migrations it is missing.
+             By default it uses the database set by the CMIP5_DB environment variable.
+             -s only lists the applied and pending migrations
+             -x reports the query plan and indexes used by the main catalogue queries (SQLite only)''',
+             formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-d','--database', type=str, help='database URL, e.g. sqlite:////path/to/cmip5.db', required=False)
+    parser.add_argument('-s','--status', action='store_true', default=False, help='list migrations without applying them', required=False)
+    parser.add_argument('-x','--explain', action='store_true', default=False, help='report indexes used by the main queries', required=False)
+    return vars(parser.parse_args())
+
+def main():
+    kwargs = parse_input()
+    cmip5 = connect(kwargs['database'])
+    engine = cmip5.session.get_bind()
+
+    print("Database schema version:", migrate.current_version(engine))
+    todo = migrate.pending(engine)
+    if kwargs['status']:
+        for version, description, _ in todo:
+            print("pending", version, description)
+    elif not kwargs['explain']:
+        for version in migrate.upgrade(engine):
+            print("applied", version, dict((m[0], m[1]) for m in todo)[version])
+        print("Database schema version:", migrate.current_version(engine))
+
+    if kwargs['explain']:
+        for name, indexes, plan in migrate.explain(cmip5):
+            print(name + ":", ", ".join(indexes) if indexes else "no index")
+            for line in plan:
+                print("    " + line)
+
+if __name__ == '__main__':
+    # check python version and then call main()
+    if sys.version_info < ( 2, 7):
+        # python too old, kill the script
+        sys.exit("This script requires Python 2.7 or newer!")
+
+    main()
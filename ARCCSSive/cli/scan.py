@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# This lists the files added, removed or modified in a directory tree since the last scan and writes them to a journal.
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+from ARCCSSive.CMIP5.DB import cache_dir
+from ARCCSSive.CMIP5.scan import ScanState, scan, write_journal
+from collections import Counter
+import argparse
+import itertools
+import os
+import sys
+
+def parse_input():
+    ''' Parse input arguments '''
+    parser = argparse.ArgumentParser(description=r'''Finds the files added, removed or modified
+             under drstree or tmp/tree directories since the last scan.
+             Only directories modified since the last scan are listed again, the state of each
+             scan is saved in the state file, by default in the ARCCSSive cache directory.
+             The changes are written to a journal file that can be passed to arccssive-ingest.
+             -c checks also the files in unchanged directories, to find files modified in place''',
+             formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('directory', type=str, nargs="+", help='top directories to scan')
+    parser.add_argument('-j','--journal', type=str, help='journal file to write', required=True)
+    parser.add_argument('-s','--state', type=str, help='scan state file', required=False,
+                        default=os.path.join(cache_dir(), 'scan.db'))
+    parser.add_argument('-p','--pattern', type=str, default='*.nc', help='file name pattern, default *.nc', required=False)
+    parser.add_argument('-c','--check-files', action='store_true', default=False,
+                        help='check files in unchanged directories', required=False)
+    return vars(parser.parse_args())
+
+def main():
+    kwargs = parse_input()
+    state = ScanState(kwargs['state'])
+    counts = Counter()
+    def count(changes):
+        for c in changes:
+            counts[c.change] += 1
+            yield c
+    changes = itertools.chain.from_iterable(scan(d, state, kwargs['pattern'], kwargs['check_files'])
+                                            for d in kwargs['directory'])
+    write_journal(count(changes), kwargs['journal'])
+    print(", ".join("%d %s" % (counts[c], c) for c in ['added', 'removed', 'modified']))
+    print(state.path, len(state), "files")
+
+if __name__ == '__main__':
+    # check python version and then call main()
+    if sys.version_info < ( 2, 7):
+        # python too old, kill the script
+        sys.exit("This script requires Python 2.7 or newer!")
+
+    main()
@@ -29,8 +29,9 @@ Last modified:
 from __future__ import print_function
 
 from ARCCSSive import CMIP5
-from ARCCSSive.CMIP5.other_functions import combine_constraints 
-from ARCCSSive.CMIP5.Model import Instance
+from ARCCSSive.CMIP5.other_functions import group_by_constraints
+from ARCCSSive.CMIP5.Model import Instance, Version
+from sqlalchemy.orm import selectinload
 import argparse
 import sys
 
@@ -66,7 +67,7 @@ def parse_input():
 def assign_constraints():
     ''' Assign default values and input to constraints '''
     kwargs = parse_input()
-    for k,v in kwargs.items():
+    for k,v in list(kwargs.items()):
         if v is None: kwargs.pop(k)
     return kwargs
 
@@ -83,36 +84,34 @@ def main():
     # open connection to local database and intiate SQLalchemy session 
     cmip5 = CMIP5.connect()
 
-    # get constraints combination
-    combs=combine_constraints(**kwargs)
+    # search on local DB all the constraints combinations with a single query
+    # "decadal" and "noVolc" keywords return all decadalYYYY and noVolcYYYY experiments
+    # return every version or only the latest ones
+    if all_versions:
+        outputs=cmip5.outputs(**kwargs).join(Instance.versions).add_entity(Version) \
+                     .order_by(Instance.id, Version.version)
+    else:
+        outputs=cmip5.latest_outputs(**kwargs)
+    if warnings:
+        outputs=outputs.options(selectinload(Version.warnings))
     # for each constraints combination
-    for constraints in combs:
-        db_results=[]
+    for constraints,results in group_by_constraints(outputs, **kwargs):
         print(constraints)
-    # search on local DB, return instance_ids
-    # allow "decadal" keyword to search for all decadalYYYY experiments
-    # allow "noVolc" keyword to search for all noVolcYYYY experiments
-        if constraints['experiment'] in ['decadal','noVolc']:
-            exp0=constraints.pop('experiment')
-            outputs=cmip5.outputs(**constraints).filter(Instance.experiment.like(exp0+"%"))
-        else:
-            outputs=cmip5.outputs(**constraints)
-    # loop through returned Instance objects
+    # loop through returned (Instance, Version) pairs
         someresult=False
-        for o in outputs:
-            if all_versions:
-                db_results=[v for v in o.versions]
-            else:
-                db_results=[v for v in o.versions if v==o.latest()[0]]
+        seen=set()
+        for o,v in results:
+    # if more than one version is latest keep only the first one, o.latest()[0], latest_outputs() lists it first
+            if not all_versions and o.id in seen:
+                continue
+            seen.add(o.id)
     # write result to output file
-            if db_results!=[]:
-                someresult=True
-                for v in db_results:
-                    fout.write(",".join([o.experiment,o.variable,o.mip,o.model,o.ensemble,v.version,v.path]) + "\n")
-                    if warnings and v.warnings != []:
-                        fout.write("Warnings:\n")
-                        for w in v.warnings:
-                            fout.write(w.warning + "\n added by " + w.added_by + " on the " + w.added_on + "\n")
+            someresult=True
+            fout.write(",".join([o.experiment,o.variable,o.mip,o.model,o.ensemble,v.version,v.path]) + "\n")
+            if warnings and v.warnings != []:
+                fout.write("Warnings:\n")
+                for w in v.warnings:
+                    fout.write(w.warning + "\n added by " + w.added_by + " on the " + w.added_on + "\n")
         if not someresult:
              print("No local version exists for constraints:\n",constraints)
     fout.close()
@@ -6,6 +6,14 @@ from tests.CMIP5.db_fixture import session
 
 collect_ignore = ["setup.py", "docs/conf.py"]
 
+@pytest.fixture(autouse=True)
+def local_caches(tmpdir_factory, monkeypatch):
+    ''' Keep the caches written by tests and doctests out of the user's home directory '''
+    cache = tmpdir_factory.mktemp('cache')
+    monkeypatch.setenv('ARCCSSIVE_CACHE', cache.strpath)
+    monkeypatch.setenv('ARCCSSIVE_CHECKSUM_CACHE', cache.join('checksums.db').strpath)
+    monkeypatch.setenv('ARCCSSIVE_ESGF_STORE', cache.join('esgf').strpath)
+
 # Pyesgf doesn't work with python 3
 if sys.version_info >= (3,0):
     collect_ignore.append('ARCCSSive/CMIP5/pyesgf_functions.py')
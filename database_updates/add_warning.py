@@ -22,8 +22,8 @@ from __future__ import print_function
 
 from ARCCSSive.CMIP5 import connect
 from ARCCSSive.CMIP5.Model import Instance, VersionWarning
-from ARCCSSive.CMIP5.other_functions import combine_constraints, assign_mips
-from ARCCSSive.CMIP5.update_db_functions import insert_unique
+from ARCCSSive.CMIP5.other_functions import group_by_constraints, experiment_families, assign_mips
+from ARCCSSive.CMIP5.update_db_functions import bulk_upsert
 import argparse
 from datetime import datetime 
 import sys, os
@@ -98,26 +98,22 @@ db=cmip5.session
 vers_cnstr=None
 if 'version' in kwargs.keys():
     vers_cnstr=kwargs.pop('version')
-# get constraints combination
-combs=combine_constraints(**kwargs)
+# search on local DB all the constraints combinations with a single query
+# "decadal" experiment returns all decadalYYYY experiments
+outputs=cmip5.outputs(load='versions',**kwargs)
 # for each constraints combination
-for constraints in combs:
+for constraints,local_outputs in group_by_constraints(outputs, **kwargs):
     db_results=[]
     print(constraints,"versions=",vers_cnstr)
-# search on local DB, return instance_ids
-    if constraints['experiment']=='decadal':
-        print("Warning: this will apply to all decadal experiments")
-        exp0=constraints.pop('experiment')
-        outputs=cmip5.outputs(**constraints).filter(Instance.experiment.like(exp0))
-    else:
-        outputs=cmip5.outputs(**constraints)
+    if constraints['experiment'] in experiment_families:
+        print("Warning: this will apply to all",constraints['experiment'],"experiments")
 # if version/s defined in constraints filter results 
     if vers_cnstr:
-        db_results=[v for o in outputs for v in o.versions if v.version in vers_cnstr]
+        db_results=[v for o in local_outputs for v in o.versions if v.version in vers_cnstr]
         #db_results=[(v for v in o.versions if v.version in vers_cnstr) for o in outputs]
         print([v.version for v in db_results])
     else:
-        db_results=[v for o in outputs for v in o.versions]
+        db_results=[v for o in local_outputs for v in o.versions]
         print([v.version for v in db_results])
 # print out summary of what will happen and check if user wants to go ahead
     if db_results==[]:
@@ -138,7 +134,7 @@ for constraints in combs:
                 fout.write(","+",".join([str(v.id) for v in db_results]))
                 fout.close()
             else:
-                # if admin add warning directly to database, commit happens in function 
-                for v in db_results:
-                    insert_unique( db, VersionWarning, **{'version_id':v.id, 'warning':warning, 
-                                 'added_by':email, 'added_on':datetime.now().strftime("%Y%m%d")} )
+                # if admin add warnings directly to database, commit happens in function 
+                rows=[{'version_id':v.id, 'warning':warning, 'added_by':email,
+                       'added_on':datetime.now().strftime("%Y%m%d")} for v in db_results]
+                bulk_upsert(db, VersionWarning, rows, ['version_id','warning','added_by','added_on'])
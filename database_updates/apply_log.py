@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# This applies to the database the changes logged by non-admin compare_ESGF runs.
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+author: Paola Petrelli <paola.petrelli@utas.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from __future__ import print_function
+
+from ARCCSSive.CMIP5 import connect
+from ARCCSSive.CMIP5.comparison_log import read_log, apply_log
+import argparse
+import itertools
+import sys, os
+
+def parse_input():
+    ''' Parse input arguments '''
+    parser = argparse.ArgumentParser(description=r'''Applies to the CMIP5 catalogue database the changes
+             recorded in the logs written by compare_ESGF when run by non-admin users
+             (files log_<user>_<date>.jsonl or .csv in the requests directory).
+             Updates of the same row are merged, the last value wins, and new files
+             already in the database are skipped, so a log can be applied more than once.
+             By default it uses the database set by the CMIP5_DB environment variable.''',
+             formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('logs', type=str, nargs="+", help='comparison logs')
+    parser.add_argument('-d','--database', type=str, help='database URL, e.g. sqlite:////path/to/cmip5.db', required=False)
+    parser.add_argument('-b','--batch-size', type=int, default=500, help='rows written to the database at once, default 500', required=False)
+    return vars(parser.parse_args())
+
+def main():
+    kwargs = parse_input()
+    # check if this is an authorised user
+    if os.environ['USER'] not in ['pxp581','tae599']:
+        print(os.environ['USER'] + " is not an authorised admin")
+        sys.exit()
+    cmip5 = connect(kwargs['database'])
+    records = itertools.chain.from_iterable(read_log(f) for f in kwargs['logs'])
+    counts = apply_log(cmip5.session, records, batch_size=kwargs['batch_size'])
+    for (action, table), n in sorted(counts.items()):
+        print(action, n, "rows of", table)
+
+if __name__ == '__main__':
+    # check python version and then call main()
+    if sys.version_info < ( 2, 7):
+        # python too old, kill the script
+        sys.exit("This script requires Python 2.7 or newer!")
+
+    main()
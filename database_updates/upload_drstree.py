@@ -5,12 +5,16 @@
 
 from __future__ import print_function
 
-from ARCCSSive.CMIP5.update_db_functions import insert_unique, add_bulk_items
+from ARCCSSive.CMIP5.update_db_functions import bulk_upsert
+from ARCCSSive.CMIP5.ingest import inst_keys, vers_keys, file_keys
 from ARCCSSive.CMIP5.other_functions import *
+from ARCCSSive.CMIP5.checksums import checksum_files, default_cache
+from ARCCSSive.CMIP5.listing import glob_dirs
 #NB tmptree root dir is also defined there
 from ARCCSSive.CMIP5 import DB
 from ARCCSSive.CMIP5.Model import Instance, Version, VersionFile
 import glob
+import os
 
 
 # open local database using ARCSSive interface
@@ -25,51 +29,43 @@ kwargs=dict(model="IPSL-CM5A-MR", experiment="amip", frequency="mon")
 #loop through entire drstree or a subdir by using constraints **kwargs
 instances=list_drstree(**kwargs)
 print(instances)
-#for each instance individuated add instance row
+#for each instance individuated collect the instance row
+details=[]
 for inst in instances:
-# call file_details to retrieve experiment, variable, model etc. from filename
 # call drs_details to retrieve model, experiment, freq. & realm (become mip), variable, ensemble from drstree path
-# return dictionary
-    # could i create an Instance, Version and file object instead and pass that on?
-    kw_instance={}
-    kw_version={}
-    kw_files={}
+# call file_details via get_mip to retrieve the mip from a filename
     frequency, kw_instance = drs_details(inst)
-    filename=glob.glob(inst+"/latest/*.nc")
-    kw_instance['mip'] = get_mip(filename)
-    #print(kw_instance)
+    filenames=glob.glob(inst+"/latest/*.nc")
 # make sure details list isn't empty
-    if kw_instance:
-        versions = list_drs_versions(inst) 
-        # add instance to db if not already existing
-        inst_obj,new = insert_unique(db, Instance, **kw_instance)
-        print(inst)
-        print(inst_obj.id,new)
-        #P use following two lines  if tmp/tree
-        #kw_version['version'] = find_version(bits[:-1], version)
-        #kw_version['path'] = '/'.join(bits[:-1])
-        kw_version['instance_id'] = inst_obj.id
-        for v in versions:
-            # add version to db if not already existing
-            kw_version['version'] = v
-            files = list_drs_files(inst+"/"+v) 
-            kw_version['path'] = tree_path("/".join([inst,v,files[0]])) 
-            #print(kw_version.items())
-            v_obj,new = insert_unique(db, Version, **kw_version)
-            print(v)
-            print(v_obj.id,new)
-            if v_obj.filenames==[]: 
-                rows=[]
-                for f in files:
-                    checksum=check_hash(v_obj.path+"/"+f,'md5')
-                    rows.append(dict(filename=f, md5=checksum, version_id=v_obj.id))
-                    add_bulk_items(db, VersionFile, rows)
-            else:
-                kw_files['version_id']=v_obj.id
-                for f in files:
-                    kw_files['filename']=f
-                    kw_files['md5']=check_hash(v_obj.path+"/"+f,'md5')
-                    insert_unique(db, VersionFile, **kw_files)
+    if kw_instance and filenames:
+        kw_instance['mip'] = get_mip(os.path.basename(filenames[0]))
+        details.append((inst, kw_instance))
+# add the instances not already existing, in batches
+inst_ids = bulk_upsert(db, Instance, [kw for inst,kw in details], inst_keys)
+
+# collect the versions of all instances, listing their files in parallel
+#P use find_version(bits[:-1], version) and '/'.join(bits[:-1]) as version and path if tmp/tree
+version_rows=[]
+version_files=[]
+for (inst, kw_instance), inst_id in zip(details, inst_ids):
+    versions = list_drs_versions(inst)
+    vfiles = glob_dirs([inst+"/"+v for v in versions], "*.nc")
+    for v,fpaths in zip(versions,vfiles):
+        files = [x.split("/")[-1] for x in fpaths]
+        if not files:
+            continue
+        version_rows.append(dict(instance_id=inst_id, version=v, path=tree_path("/".join([inst,v,files[0]]))))
+        version_files.append(files)
+# add the versions not already existing, in batches
+vers_ids = bulk_upsert(db, Version, version_rows, vers_keys)
+print(len(inst_ids), "instances and", len(vers_ids), "versions")
+
+for kw_version, vers_id, files in zip(version_rows, vers_ids, version_files):
+    # calculate md5 checksums of all files in parallel
+    sums=checksum_files([kw_version['path']+"/"+f for f in files],['md5'],cache=default_cache())
+    rows=[dict(filename=f, md5=checksum['md5'], version_id=vers_id) for f,checksum in zip(files,sums)]
+    # add files to db if not already existing, in batches
+    bulk_upsert(db, VersionFile, rows, file_keys)
 
 # need to have function to map bits of path to db instance fields!!
     #model,experiment,variable,mip,ensemble
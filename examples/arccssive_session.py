@@ -25,7 +25,8 @@ from ARCCSSive.CMIP5.Model import Instance
 # connect to the database
 db=CMIP5.connect()
 #search database instances
-outputs=db.outputs(variable='tas',model='MIROC5',experiment='historical',mip='Amon',ensemble='r1i1p1')
+# load='versions' fetches the versions of all results together, instead of one query per instance
+outputs=db.outputs(variable='tas',model='MIROC5',experiment='historical',mip='Amon',ensemble='r1i1p1',load='versions')
 
 # loop through result instance objects returned by search
 for o in outputs:
@@ -40,7 +41,7 @@ for o in outputs:
         if v.is_latest: print("latest available version on ESGF as of ",str(v.checked_on))
 
 # search without specifying variables and then use filter to select only two
-outputs=db.outputs(model='MIROC5',experiment='historical',mip='Amon',ensemble='r1i1p1')\
+outputs=db.outputs(model='MIROC5',experiment='historical',mip='Amon',ensemble='r1i1p1',load='versions+files')\
         .filter(Instance.variable.in_(['tas','pr']))
 
 # loop through result instance objects returned by search
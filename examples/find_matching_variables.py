@@ -22,12 +22,10 @@ limitations under the License.
 from __future__ import print_function
 
 from ARCCSSive.CMIP5 import connect
-from ARCCSSive.CMIP5.Model import Instance
-from ARCCSSive.CMIP5.other_functions import assign_mips, combine_constraints, unique 
+from ARCCSSive.CMIP5.other_functions import assign_mips, group_by_constraints
 from collections import defaultdict
 import argparse
 import sys
-from sqlalchemy import and_
 
 # check python version and then call main()
 if sys.version_info < ( 2, 7):
@@ -81,39 +79,20 @@ results=defaultdict(list)
 cmip5 = connect()
 # remove variables from constraints dictionary and save it as a separate list
 variables=kwargs.pop("variable")
-# get constraints combination
-combs=combine_constraints(**kwargs)
+# search on local database for the models/ensembles that have all the variables for every constraints combination
+# with a single query, if key "decadal" used for experiments all experiments matching "decadal*" are returned
+outputs=cmip5.complete_ensembles(variables, **kwargs)
 # for each constraints combination
-for constraints in combs:
-    exp0=constraints['experiment']
-    mip0=constraints['mip']
-# search on localdatabase for matching Instances, if key "decadal" used for experiments, do this in two steps  
-# first search all other constraints, then filter results where experiment=="decadal*"
-# in both cases filter for variables which belong to input list
-    if constraints['experiment']=='decadal':
-        outputs=cmip5.outputs(**constraints).filter(and_(Instance.experiment.like(exp0), Instance.variable.in_(variables)))
-    else:
-        outputs=cmip5.outputs(**constraints).filter(Instance.variable.in_(variables))
-#extract list of models from Instances returned by search 
-    models=unique(outputs,'model')
+for constraints,local_outputs in group_by_constraints(outputs, **kwargs):
 # build string to use as result dict key
     str_constr="_".join([constraints["experiment"],constraints["mip"]])
-# filter results by model, then ensembles and check if all variables are present
 # save details in versions dictionary as a string joining "model ensemble variable" as key and a list of versions as value
-    for mod0 in models:
-        mod_outs=outputs.filter(Instance.model == mod0)
-        ensembles=unique(mod_outs,'ensemble')
-        for ens0 in ensembles:
-            varset=set()
-            res=mod_outs.filter(Instance.ensemble==ens0)
-            versions=defaultdict(set)
-            for o in res:
-                versions[" ".join([mod0,ens0,str(o.variable)])].update(str(v.version) for v in o.versions)
-                varset.add(str(o.variable))
-                # find version for each variable
-            if set(variables).issubset(varset):
-      #  if all variables  are available for an esemble/model pair than save in results dict else pass to next ensemble/model
-                results[str_constr].append(versions)
+    modens=defaultdict(lambda: defaultdict(set))
+    for o,v in local_outputs:
+        versions=modens[(o.model,o.experiment,o.ensemble)][" ".join([o.model,o.ensemble,str(o.variable)])]
+        if v is not None:
+            versions.add(str(v.version))
+    results[str_constr].extend(modens.values())
     
 # this is a bit ugly but works
 # for each model/ensemble pair in results if there saved results print them
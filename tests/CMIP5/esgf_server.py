@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Local stand-in for an ESGF search node, serving a fixed list of dataset and
+file documents from the `search` endpoint
+"""
+
+from __future__ import print_function
+
+import json
+import threading
+import pytest
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.urllib.parse import urlparse, parse_qsl
+
+# Query parameters that aren't constraints on the documents
+control_params = ['format', 'limit', 'offset', 'distrib', 'shards', 'facets',
+                  'fields', 'type', 'latest', 'replica', 'query', 'start', 'end']
+
+def _matches(doc, constraints):
+    for key, values in constraints.items():
+        value = doc.get(key)
+        if not isinstance(value, list):
+            value = [value]
+        if not set(str(v) for v in value) & set(values):
+            return False
+    return True
+
+class ESGFServer(HTTPServer):
+    """
+    Search node answering with the documents matching the query constraints
+
+    :argument docs: list of documents, each with a `type` key, Dataset or File
+    """
+    def __init__(self, docs):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SearchHandler)
+        self.docs = docs
+        self.queries = []
+        self.url = 'http://127.0.0.1:%d/esg-search' % self.server_port
+
+    def search(self, params):
+        self.queries.append(params)
+        query = dict(params)
+        constraints = {}
+        for k, v in params:
+            if k not in control_params:
+                constraints.setdefault(k, set()).add(v)
+        docs = [d for d in self.docs if d['type'] == query.get('type', 'Dataset')
+                and _matches(d, constraints)]
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 10))
+        return {'responseHeader': {'params': {'shards': '127.0.0.1:%d/solr' % self.server_port}},
+                'response': {'numFound': len(docs), 'docs': docs[offset:offset+limit]},
+                'facet_counts': {'facet_fields': {}}}
+
+class SearchHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not url.path.endswith('/search'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.search(parse_qsl(url.query))).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def sample_docs(datasets=3, files=2):
+    """
+    Dataset and file documents of tas datasets of different ensembles
+    """
+    docs = []
+    for i in range(datasets):
+        dataset_id = 'cmip5.output1.MIROC.MIROC-ESM.rcp45.mon.atmos.Amon.r%di1p1.v20120101|node' % (i+1)
+        docs.append({'type': 'Dataset', 'id': dataset_id, 'version': '20120101',
+                     'model': ['MIROC-ESM'], 'experiment': ['rcp45'], 'cmor_table': ['Amon'],
+                     'variable': ['tas'], 'ensemble': ['r%di1p1' % (i+1)], 'project': ['CMIP5'],
+                     'index_node': 'node', 'number_of_files': files})
+        for j in range(files):
+            filename = 'tas_Amon_MIROC-ESM_rcp45_r%di1p1_%d.nc' % (i+1, j)
+            docs.append({'type': 'File', 'id': dataset_id.replace('|', '.%s|' % filename),
+                         'dataset_id': dataset_id, 'title': filename, 'variable': ['tas'],
+                         'checksum': ['%032x' % (i*files + j)], 'checksum_type': ['MD5'],
+                         'tracking_id': ['id_%d_%d' % (i, j)], 'size': 100,
+                         'url': ['http://node/thredds/fileServer/%s|application/netcdf|HTTPServer' % filename]})
+    return docs
+
+@pytest.fixture
+def esgf_server():
+    """
+    Stand-in search node serving sample_docs(), running in a thread
+    """
+    server = ESGFServer(sample_docs())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import hashlib
+import pytest
+from ARCCSSive.CMIP5 import checksums
+from ARCCSSive.CMIP5.checksums import *
+from ARCCSSive.CMIP5.other_functions import check_hash
+
+def test_file_checksums(tmpdir, monkeypatch):
+    # Use a small block size to check reading in several blocks
+    monkeypatch.setattr(checksums, 'blocksize', 7)
+    monkeypatch.setenv('ARCCSSIVE_CHECKSUM_CACHE', tmpdir.join('checksums.db').strpath)
+    data = b'some netcdf data' * 10
+    f = tmpdir.join('f.nc')
+    f.write_binary(data)
+    sums = file_checksums(f.strpath)
+    assert sums == {'md5': hashlib.md5(data).hexdigest(), 'sha256': hashlib.sha256(data).hexdigest()}
+    assert file_checksums(f.strpath, ['SHA256']) == {'sha256': sums['sha256']}
+    assert check_hash(f.strpath, 'SHA256') == sums['sha256']
+    assert check_hash(f.strpath, 'md5') == sums['md5']
+
+def test_checksum_files(tmpdir):
+    paths = []
+    for i in range(10):
+        f = tmpdir.join('f%d.nc'%i)
+        f.write_binary(b'x' * i)
+        paths.append(f.strpath)
+    paths.append(tmpdir.join('missing.nc').strpath)
+    sums = checksum_files(paths, ['md5'], workers=4)
+    assert [s['md5'] for s in sums[:-1]] == [hashlib.md5(b'x' * i).hexdigest() for i in range(10)]
+    assert sums[-1] == {'md5': ''}
+    assert checksum_files(paths, ['md5'], workers=1) == sums
+    with pytest.raises(ValueError):
+        checksum_files(paths, ['none'])
+
+def test_checksum_cache(tmpdir, monkeypatch):
+    cache = ChecksumCache(tmpdir.join('cache', 'checksums.db').strpath)
+    f = tmpdir.join('f.nc')
+    f.write_binary(b'old data')
+    assert cache.get(f.strpath) is None
+
+    sums = checksum_files([f.strpath], ['md5'], cache=cache)
+    assert len(cache) == 1
+    assert cache.get(f.strpath, ['md5']) == sums[0]
+    # sha256 wasn't calculated yet
+    assert cache.get(f.strpath) is None
+
+    # cached values are used while the file is unchanged
+    monkeypatch.setattr(checksums, 'file_checksums', lambda path, types: {'md5': 'recalculated'})
+    assert checksum_files([f.strpath], ['md5'], cache=cache) == sums
+    # a new checksum type is added to the same entry
+    monkeypatch.setattr(checksums, 'file_checksums', lambda path, types: {'sha256': 'new'})
+    checksum_files([f.strpath], ['sha256'], cache=cache)
+    assert cache.get(f.strpath) == {'md5': sums[0]['md5'], 'sha256': 'new'}
+    monkeypatch.undo()
+
+    # changing the file invalidates its entry
+    f.write_binary(b'new data, longer')
+    assert cache.get(f.strpath, ['md5']) is None
+    assert checksum_files([f.strpath], ['md5'], cache=cache) == [{'md5': hashlib.md5(b'new data, longer').hexdigest()}]
+
+    # stale entries are evicted
+    g = tmpdir.join('g.nc')
+    g.write_binary(b'data')
+    checksum_files([g.strpath], cache=cache)
+    assert len(cache) == 2
+    g.remove()
+    assert cache.evict() == 1
+    assert cache.evict(max_age=-1) == 1
+    assert len(cache) == 0
+
+def test_checksum_cache_changed_file(tmpdir, monkeypatch):
+    cache = ChecksumCache(tmpdir.join('checksums.db').strpath)
+    paths = [tmpdir.join('f%d.nc'%i).strpath for i in range(3)]
+    for p in paths:
+        open(p, 'wb').write(b'data')
+    checksum_files(paths[:2], ['md5'], cache=cache)
+    assert [s is not None for s in cache.get_many(paths, ['md5'])] == [True, True, False]
+
+    # a file rewritten while it is hashed isn't cached with the old checksum
+    def rewrite(path, types):
+        sums = file_checksums(path, types)
+        open(path, 'wb').write(b'rewritten data')
+        return sums
+    monkeypatch.setattr(checksums, 'file_checksums', rewrite)
+    checksum_files(paths[2:], ['md5'], cache=cache)
+    monkeypatch.undo()
+    assert cache.get(paths[2], ['md5']) is None
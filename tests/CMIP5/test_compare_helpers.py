@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import time
+import pytest
+pytest.importorskip('pyesgf')
+from ARCCSSive.CMIP5 import compare_helpers
+from ARCCSSive.CMIP5.compare_helpers import *
+from ARCCSSive.CMIP5.comparison_log import ComparisonLog, read_log
+
+class FakeFile(object):
+    def __init__(self, var, i):
+        self.filename = '%s_%d.nc'%(var, i)
+        self.checksum = 'x' * 32
+        self.json = {'variable': [var]}
+
+class FakeDataset(object):
+    ''' Remote dataset whose file search fails the first `failures` times '''
+    def __init__(self, name, failures=0, node='node1'):
+        self.dataset_id = 'cmip5.output1.%s.v20120101|node'%name
+        self.index_node = node
+        self.json = {'version': '20120101'}
+        self.failures = failures
+        self.searches = 0
+        self._files = None
+
+    def files(self, refresh=False):
+        if refresh or self._files is None:
+            self.searches += 1
+            if self.searches <= self.failures:
+                raise IOError('server error')
+            self._files = [FakeFile('tas', 0), FakeFile('tas', 1), FakeFile('pr', 0)]
+        return self._files
+
+    def get_attribute(self, attr):
+        return self.json[attr]
+
+def test_retrieve_all(monkeypatch):
+    monkeypatch.setattr(compare_helpers.time, 'sleep', lambda s: None)
+    datasets = [FakeDataset('ds%d'%i, failures=i%3) for i in range(10)]
+    datasets.append(FakeDataset('nci', node='esgf.nci.org.au'))
+    datasets[-1].dataset_id += 'esgf.nci.org.au'
+    results = retrieve_all([(ds, ['tas']) for ds in datasets], workers=4, retries=3)
+    assert [r[0]['dataset_id'] for r in results[:-1]] == [ds.dataset_id for ds in datasets[:-1]]
+    assert [len(r[0]['files']) for r in results[:-1]] == [2] * 10
+    assert [ds.searches for ds in datasets] == [i%3 + 1 for i in range(10)] + [0]
+    assert results[-1] == []
+
+    # give up after the retries
+    ds = FakeDataset('bad', failures=10)
+    assert retrieve_all([(ds, ['tas'])], retries=2) == [[]]
+    assert ds.searches == 3
+
+def test_node_rate_limiter():
+    limiter = NodeRateLimiter(rate=20)
+    start = time.time()
+    for i in range(5):
+        limiter.wait('node1')
+    limiter.wait('node2')
+    assert time.time() - start >= 0.19
+    assert NodeRateLimiter().interval == 0
+
+class FakeInstance(object):
+    def __init__(self, variable, ensemble):
+        self.variable, self.mip, self.model, self.experiment, self.ensemble = (
+            variable, 'Amon', 'MIROC-ESM', 'rcp45', ensemble)
+
+class FakeVersion(object):
+    def __init__(self, id, variable, ensemble, version, dataset_id=None):
+        self.id = id
+        self.variable = FakeInstance(variable, ensemble)
+        self.version = version
+        self.dataset_id = dataset_id
+        self.to_update = False
+        self.is_latest = None
+
+class FakeDB(object):
+    dirty = False
+    def commit(self):
+        pass
+
+def test_compare_instances(monkeypatch):
+    # files differ only for r2i1p1
+    monkeypatch.setattr(compare_helpers, 'compare_files',
+                        lambda db, ds, v, admin, log=None: set(['x']) if v.variable.ensemble == 'r2i1p1' else set())
+    dsid = 'cmip5.output1.MIROC.MIROC-ESM.rcp45.mon.atmos.Amon.%s.v20120101|node'
+    remote = [{'dataset_id': dsid % ens, 'variable': var, 'version': 'v20120101'}
+              for ens in ['r1i1p1', 'r2i1p1', 'r3i1p1'] for var in ['tas', 'pr']]
+    local = [FakeVersion(1, 'tas', 'r1i1p1', 'v20120101'),
+             FakeVersion(2, 'tas', 'r1i1p1', 'NA'),
+             FakeVersion(3, 'pr', 'r1i1p1', 'v20110101', 'old'),
+             FakeVersion(4, 'tas', 'r2i1p1', 'v20120101', dsid % 'r2i1p1'),
+             FakeVersion(5, 'pr', 'r4i1p1', 'v20120101')]
+    remote, local = compare_instances(FakeDB(), remote, local, ['model', 'experiment', 'mip'], True)
+
+    same = dict(((r['dataset_id'].split('.')[8], r['variable']), r['same_as']) for r in remote)
+    assert same == {('r1i1p1', 'tas'): [1, 2], ('r1i1p1', 'pr'): [],
+                    ('r2i1p1', 'tas'): [4], ('r2i1p1', 'pr'): [],
+                    ('r3i1p1', 'tas'): [], ('r3i1p1', 'pr'): []}
+    assert [r['update'] for r in remote] == [[], [], [4], [], [], []]
+    assert local[1].version == 'v20120101'
+    assert [v.is_latest for v in local] == [True, True, False, True, None]
+    assert local[2].dataset_id == 'old'
+
+def test_compare_instances_missing_field():
+    # dataset ids from esgfcog have no mip
+    remote = [{'dataset_id': 'cmip5.output1.MIROC.MIROC-ESM.rcp45.mon.atmos.r1i1p1.v20120101|esgfcog',
+               'variable': 'tas', 'version': 'v20120101'}]
+    local = [FakeVersion(1, 'tas', 'r1i1p1', 'v20120101')]
+    with pytest.raises(KeyError):
+        compare_instances(FakeDB(), remote, local, ['model', 'experiment'], True)
+    # nothing to compare with
+    remote, local = compare_instances(FakeDB(), remote, [], ['model', 'experiment'], True)
+    assert remote[0]['same_as'] == []
+
+def test_compare_instances_log(monkeypatch, tmpdir):
+    monkeypatch.setattr(compare_helpers, 'compare_files',
+                        lambda db, ds, v, admin, log=None: set(['x']))
+    dsid = 'cmip5.output1.MIROC.MIROC-ESM.rcp45.mon.atmos.Amon.r1i1p1.v20120101|node'
+    remote = [{'dataset_id': dsid, 'variable': 'tas', 'version': 'v20120101'}]
+    local = [FakeVersion(1, 'tas', 'r1i1p1', 'v20120101'), FakeVersion(2, 'tas', 'r1i1p1', 'v20110101')]
+    db = FakeDB()
+    db.dirty = set(local[:1])
+    path = str(tmpdir.join('log.jsonl'))
+    with ComparisonLog(path) as log:
+        compare_instances(db, remote, local, ['model', 'experiment', 'mip'], False, log)
+
+    records = list(read_log(path))
+    assert len(records) == 1
+    assert records[0]['action'] == 'update' and records[0]['id'] == 1
+    assert records[0]['values']['dataset_id'] == dsid
+    assert records[0]['values']['to_update'] is True
+
+class FakeVersionFile(object):
+    def __init__(self, filename, md5):
+        self.filename = filename
+        self.md5 = md5
+        self.sha256 = None
+
+class FakeRemoteFile(object):
+    def __init__(self, filename, checksum):
+        self.filename = filename
+        self.checksum = checksum
+        self.tracking_id = 'id_' + filename
+        self.download_url = 'http://node/thredds/fileServer/cmip5/output1/tas/' + filename
+
+def test_diff_files():
+    local = [FakeVersionFile('a.nc', 'sa'), FakeVersionFile('b.nc', 'sb'), FakeVersionFile('c.nc', 'sc')]
+    remote = [FakeRemoteFile('a.nc', 'sa'), FakeRemoteFile('b.nc', 'new'), FakeRemoteFile('d.nc', 'sd')]
+    diff = diff_files(local, remote, 'MD5')
+    assert diff == {'missing': set(['d.nc']), 'extra': set(['c.nc']),
+                    'same': set(['a.nc', 'b.nc']), 'changed': set(['b.nc'])}
+    assert diff_files(local, remote, 'None')['changed'] == set()
+    v = FakeVersion(1, 'tas', 'r1i1p1', 'v1')
+    v.files = local
+    assert check_same(['a.nc', 'b.nc'], v, remote, 'md5') == ['b.nc']
+
+def test_compare_files_no_checksums(tmpdir):
+    # remote files without checksums can't be compared
+    v = FakeVersion(1, 'tas', 'r1i1p1', 'v20120101')
+    v.path = tmpdir.strpath
+    v.files = [FakeVersionFile('a.nc', None)]
+    v.tracking_ids = lambda: [None]
+    tmpdir.join('a.nc').write('x')
+    rds = {'files': [FakeRemoteFile('a.nc', None)], 'checksum_type': 'None'}
+    assert compare_files(FakeDB(), rds, v, True) is None
+
+def test_update_files():
+    dsid = 'cmip5.output1.MIROC.MIROC-ESM.rcp45.mon.atmos.Amon.r1i1p1.v20120101'
+    v = FakeVersion(1, 'tas', 'r1i1p1', 'v20120101', dsid)
+    v.files = [FakeVersionFile('a.nc', 'sa'), FakeVersionFile('b.nc', 'sb')]
+    remote = [FakeRemoteFile('a.nc', 'sa'), FakeRemoteFile('b.nc', 'new'), FakeRemoteFile('d.nc', 'sd')]
+    ds = {'dataset_id': dsid, 'variable': 'tas', 'checksum_type': 'md5', 'files': remote, 'update': [1]}
+    urls, info = update_files([v], [ds])
+    assert [u.split("'")[0] for u in urls] == ['b.nc', 'd.nc']
+    assert info[1:] == ['b.nc,id_b.nc,new\n', 'd.nc,id_d.nc,sd\n']
+    # nothing to update
+    v.files.append(FakeVersionFile('d.nc', 'sd'))
+    v.files[1].md5 = 'new'
+    assert update_files([v], [ds]) == ([], [])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import pytest
+from ARCCSSive import CMIP5
+from ARCCSSive.CMIP5.Model import Instance, Version, VersionFile
+from ARCCSSive.CMIP5.comparison_log import *
+
+@pytest.mark.parametrize('name', ['log.jsonl', 'log.csv'])
+def test_log_round_trip(tmpdir, name):
+    path = tmpdir.join(name).strpath
+    with ComparisonLog(path, buffer_size=2) as log:
+        log.update('versions', 1, is_latest=True, dataset_id='cmip5.x')
+        log.insert('files', filename='tas.nc', version_id=1)
+        log.update('files', 3, md5='abc')
+        with pytest.raises(ValueError):
+            log.update('outputs', 1, x=1)
+    # appending to an existing log
+    with ComparisonLog(path) as log:
+        log.update('versions', 1, is_latest=False)
+
+    records = list(read_log(path))
+    assert [(r['action'], r['table'], r['id']) for r in records] == [
+        ('update', 'versions', 1), ('insert', 'files', None),
+        ('update', 'files', 3), ('update', 'versions', 1)]
+    assert records[0]['values'] == {'is_latest': True, 'dataset_id': 'cmip5.x'}
+    assert records[1]['values'] == {'filename': 'tas.nc', 'version_id': 1}
+
+def test_apply_log(tmpdir):
+    cmip5 = CMIP5.connect('sqlite:///:memory:')
+    db = cmip5.session
+    v = Version(version='v1', path='/tmp', is_latest=False,
+                variable=Instance(variable='tas', experiment='rcp45', mip='Amon', model='M', ensemble='r1i1p1'))
+    v.files.append(VersionFile(filename='tas_0.nc'))
+    db.add(v)
+    db.commit()
+
+    path = tmpdir.join('log.jsonl').strpath
+    with ComparisonLog(path) as log:
+        log.update('versions', v.id, is_latest=True, checked_on='2018-01-01')
+        log.update('versions', v.id, dataset_id='cmip5.x')
+        log.insert('files', filename='tas_0.nc', version_id=v.id)
+        log.insert('files', filename='tas_1.nc', version_id=v.id)
+        log.update('files', v.files[0].id, md5='abc')
+
+    counts = apply_log(db, read_log(path))
+    assert counts == {('update', 'versions'): 1, ('insert', 'files'): 2, ('update', 'files'): 1}
+    db.expire_all()
+    assert (v.is_latest, v.checked_on, v.dataset_id) == (True, '2018-01-01', 'cmip5.x')
+    assert sorted(f.filename for f in v.files) == ['tas_0.nc', 'tas_1.nc']
+    assert [f.md5 for f in v.files if f.filename == 'tas_0.nc'] == ['abc']
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import time
+import pytest
+from ARCCSSive.CMIP5.esgf_store import *
+from tests.CMIP5.esgf_server import esgf_server
+
+def test_response_store(tmpdir):
+    store = ResponseStore(tmpdir.join('store').strpath, ttl=60)
+    query = [('type', 'Dataset'), ('variable', 'tas'), ('variable', 'pr')]
+    assert store.get('http://node/esg-search', 'search', query) is None
+    store.put('http://node/esg-search', 'search', query, {'response': 1})
+    # same parameters in any order
+    assert store.get('http://node/esg-search/', 'search', query[::-1]) == {'response': 1}
+    assert store.get('http://other/esg-search', 'search', query) is None
+    assert store.get('http://node/esg-search', 'search', query[:2]) is None
+    assert len(store) == 1
+
+    store.put('http://node/esg-search', 'search', query[:1], {'response': 2})
+    old = ResponseStore(store.path, ttl=-1)
+    assert old.get('http://node/esg-search', 'search', query) is None
+    assert old.get('http://node/esg-search', 'search', query, expired=True) == {'response': 1}
+    assert old.evict() == 2
+    assert len(store) == 0
+
+def test_replay(tmpdir, esgf_server):
+    pytest.importorskip('pyesgf')
+    from pyesgf.search.exceptions import EsgfSearchException
+    from ARCCSSive.CMIP5.pyesgf_functions import ESGFSearch
+
+    def search(**kwargs):
+        esgf = ESGFSearch()
+        esgf.search_node(node=esgf_server.url, distrib=False, experiment='rcp45',
+                         variable='tas', **kwargs)
+        return [(ds.dataset_id, ds.filenames()) for ds in esgf.get_ds()]
+
+    store = ResponseStore(tmpdir.join('store').strpath)
+    expected = search()
+    assert len(expected) == 3 and all(len(files) == 2 for _, files in expected)
+    queries = len(esgf_server.queries)
+
+    # recording, then replaying without querying the node
+    assert search(store=store) == expected
+    assert len(esgf_server.queries) == 2 * queries
+    assert search(store=store) == expected
+    assert search(store=store, offline=True) == expected
+    assert len(esgf_server.queries) == 2 * queries
+
+    with pytest.raises(EsgfSearchException):
+        search(store=store, offline=True, ensemble='r1i1p1')
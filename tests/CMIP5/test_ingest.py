@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import hashlib
+import pytest
+from ARCCSSive import CMIP5
+from ARCCSSive.CMIP5.Model import Instance, Version, VersionFile
+from ARCCSSive.CMIP5.ingest import *
+from tests.CMIP5.test_netcdf_header import classic_file
+
+@pytest.fixture
+def tmptree(tmpdir):
+    ''' Two versions of tas files with headers and a download log for the second '''
+    v1 = tmpdir.mkdir('v1')
+    v2 = tmpdir.mkdir('v2')
+    for i in range(3):
+        classic_file(v1.join('tas_Amon_ACCESS1-3_rcp45_r1i1p1_%d.nc'%i),
+                     [('tracking_id', 'id%d'%i), ('modeling_realm', 'atmos'), ('version_number', 'v20120101')])
+        classic_file(v2.join('tas_Amon_ACCESS1-3_rcp45_r2i1p1_%d.nc'%i), [('tracking_id', 'r2id%d'%i)])
+    # file of another variable in the same directory
+    classic_file(v1.join('pr_Amon_ACCESS1-3_rcp45_r1i1p1_0.nc'), [('tracking_id', 'pr')])
+    listing = tmpdir.join('tmptree.csv')
+    listing.write('variable,mip_table,model,experiment,ensemble,realm,version,path\n'
+                  'tas,Amon,ACCESS1-3,rcp45,r1i1p1,NA,NA,%s\n' % v1.strpath)
+    log = tmpdir.join('download.log')
+    log.write('tas,Amon,ACCESS1-3,rcp45,r2i1p1,atmos,v20130101,cmip5.tas.v20130101,%s,MD5\n' % v2.strpath +
+              'tas_Amon_ACCESS1-3_rcp45_r2i1p1_0.nc,,somemd5\n'
+              'tas_Amon_ACCESS1-3_rcp45_r2i1p1_1.nc,r2id1,None\n')
+    return tmpdir, listing.strpath, log.strpath
+
+def test_read_datasets(tmptree):
+    tmpdir, listing, log = tmptree
+    assert input_format(listing) == 'tmpdir'
+    assert input_format(log) == 'log'
+    d = list(read_datasets(listing))
+    assert len(d) == 1
+    assert [f['filename'][-4:] for f in d[0]['files']] == ['0.nc', '1.nc', '2.nc']
+    assert d[0]['files'][0]['sha256'] is None
+    d = list(read_datasets(log))
+    assert d[0]['checksum_type'] == 'md5'
+    assert d[0]['version'] == {'version': 'v20130101', 'dataset_id': 'cmip5.tas.v20130101',
+                               'path': tmpdir.join('v2').strpath}
+    assert d[0]['files'][0] == {'filename': 'tas_Amon_ACCESS1-3_rcp45_r2i1p1_0.nc',
+                                'tracking_id': None, 'md5': 'somemd5'}
+
+def test_process_dataset(tmptree):
+    tmpdir, listing, log = tmptree
+    d = process_dataset(next(read_datasets(listing)))
+    assert d['instance']['realm'] == 'atmos'
+    assert d['version']['version'] == 'v20120101'
+    assert [f['tracking_id'] for f in d['files']] == ['id0', 'id1', 'id2']
+    f = tmpdir.join('v1', d['files'][0]['filename'])
+    assert d['files'][0]['sha256'] == hashlib.sha256(f.read_binary()).hexdigest()
+
+def test_journal_datasets(tmpdir):
+    from ARCCSSive.CMIP5.scan import Change, write_journal
+    v1 = tmpdir.mkdir('v20120101')
+    journal = tmpdir.join('journal.csv').strpath
+    write_journal([Change('added', v1.join(f).strpath, 1, 1) for f in
+                   ['notes_1.nc', 'orog_fx_ACCESS1-0_historical_r0i0p0.nc',
+                    'tas_Amon_ACCESS1-0_historical_r1i1p1_185001-185012_a_b.nc']], journal)
+    d = list(read_datasets(journal))
+    # only the file with too few fields is skipped
+    assert [x['instance']['ensemble'] for x in d] == ['r0i0p0', 'r1i1p1']
+    assert d[0]['instance']['mip'] == 'fx'
+    assert d[0]['version']['version'] == 'v20120101'
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_ingest(tmptree, workers):
+    tmpdir, listing, log = tmptree
+    cmip5 = CMIP5.connect('sqlite:///:memory:')
+    progress = []
+    stats, elapsed = ingest(cmip5.session, [listing, log], workers=workers, batch_size=1,
+                            queue_size=1, progress=lambda s, e: progress.append(s[2].datasets))
+    assert progress == [1, 2]
+    assert [(s.name, s.datasets, s.files) for s in stats] == [
+        ('scan', 2, 5), ('process', 2, 5), ('write', 2, 5)]
+
+    assert cmip5.query(Instance).count() == 2
+    versions = dict((v.variable.ensemble, v) for v in cmip5.query(Version))
+    assert versions['r1i1p1'].version == 'v20120101'
+    assert versions['r1i1p1'].variable.realm == 'atmos'
+    assert sorted(versions['r1i1p1'].tracking_ids()) == ['id0', 'id1', 'id2']
+    files = dict((f.filename[-4:], f) for f in versions['r2i1p1'].files)
+    assert files['0.nc'].md5 == 'somemd5'
+    assert files['0.nc'].tracking_id == 'r2id0'
+    assert files['1.nc'].md5 == hashlib.md5(tmpdir.join('v2', files['1.nc'].filename).read_binary()).hexdigest()
+
+    # ingesting again doesn't add any row
+    ingest(cmip5.session, [listing, log], workers=workers)
+    assert cmip5.query(VersionFile).count() == 5
+
+def test_ingest_error(tmpdir):
+    cmip5 = CMIP5.connect('sqlite:///:memory:')
+    with pytest.raises(IOError):
+        ingest(cmip5.session, [tmpdir.join('missing.csv').strpath], workers=2)
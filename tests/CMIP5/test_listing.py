@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import os
+import glob
+from ARCCSSive.CMIP5 import listing
+from ARCCSSive.CMIP5.listing import *
+
+def test_glob_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(listing, 'racy_seconds', -1)
+    clear_cache()
+    for name in ['tas_1.nc', 'tas_2.nc', 'pr_1.nc', '.tas_3.nc', 'notes.txt']:
+        tmpdir.join(name).write('x')
+    tmpdir.mkdir('v20120101')
+    for pattern in ['tas_*.nc', '*.nc', 'v*', '.*', '*']:
+        assert glob_dir(tmpdir.strpath, pattern) == sorted(glob.glob(os.path.join(tmpdir.strpath, pattern)))
+    assert glob_dir(tmpdir.join('missing').strpath, '*') == []
+
+def test_listdir_cache(tmpdir, monkeypatch):
+    clear_cache()
+    tmpdir.join('a.nc').write('x')
+    # recently modified directories are not cached
+    assert listdir(tmpdir.strpath) == ['a.nc']
+    assert len(listing._listings) == 0
+
+    monkeypatch.setattr(listing, 'racy_seconds', -1)
+    assert listdir(tmpdir.strpath) == ['a.nc']
+    assert len(listing._listings) == 1
+    # the cached listing is used while the directory doesn't change
+    monkeypatch.setattr(listing, 'scandir', None)
+    monkeypatch.setattr(os, 'listdir', lambda path: ['not', 'listed'])
+    assert listdir(tmpdir.strpath) == ['a.nc']
+    monkeypatch.undo()
+
+    monkeypatch.setattr(listing, 'racy_seconds', -1)
+    tmpdir.join('b.nc').write('x')
+    st = os.stat(tmpdir.strpath)
+    os.utime(tmpdir.strpath, (st.st_atime, st.st_mtime + 10))
+    assert listdir(tmpdir.strpath) == ['a.nc', 'b.nc']
+
+    # least recently used directories are removed first
+    monkeypatch.setattr(listing, 'cache_size', 2)
+    dirs = [tmpdir.mkdir('d%d'%i).strpath for i in range(3)]
+    for d in dirs:
+        listdir(d)
+    assert [k[0] for k in listing._listings] == dirs[1:]
+
+def test_glob_dirs(tmpdir):
+    dirs = []
+    for i in range(5):
+        d = tmpdir.mkdir('v%d'%i)
+        for j in range(i):
+            d.join('f%d.nc'%j).write('x')
+        dirs.append(d.strpath)
+    results = glob_dirs(dirs, '*.nc', workers=3)
+    assert [len(r) for r in results] == [0, 1, 2, 3, 4]
+    assert results[2] == [os.path.join(dirs[2], 'f0.nc'), os.path.join(dirs[2], 'f1.nc')]
+    assert glob_dirs(dirs, ['f0.nc'] * 5, workers=1) == [r[:1] for r in results]
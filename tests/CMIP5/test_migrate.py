@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from ARCCSSive import CMIP5
+from ARCCSSive.CMIP5.migrate import *
+from sqlalchemy import inspect, text
+from .db_fixture import session
+
+def old_catalogue(path):
+    ''' Create a catalogue without the indexes added by migrations '''
+    cmip5 = CMIP5.connect('sqlite:///' + path)
+    engine = cmip5.session.get_bind()
+    with engine.begin() as conn:
+        for name in ['ix_instances_model_experiment_mip_ensemble', 'ix_versions_instance_latest',
+                     'ix_versions_dataset_id', 'ix_files_version_filename', 'ix_files_tracking_id']:
+            conn.execute(text('DROP INDEX ' + name))
+        conn.execute(text('DROP TABLE schema_version'))
+    return cmip5
+
+def test_upgrade(tmpdir):
+    cmip5 = old_catalogue(tmpdir.join('cmip5.db').strpath)
+    engine = cmip5.session.get_bind()
+    assert current_version(engine) == 0
+    assert [m[0] for m in pending(engine)] == [m[0] for m in migrations]
+
+    assert upgrade(engine) == [m[0] for m in migrations]
+    assert current_version(engine) == migrations[-1][0]
+    assert pending(engine) == []
+    assert upgrade(engine) == []
+    indexes = [i['name'] for i in inspect(engine).get_indexes('files')]
+    assert 'ix_files_tracking_id' in indexes
+
+def test_explain(session):
+    report = explain(session)
+    assert [r[0] for r in report] == [q[0] for q in query_shapes(session)]
+    indexes = dict((r[0], r[1]) for r in report)
+    assert indexes['version by dataset_id'] == ['ix_versions_dataset_id']
+    assert indexes['version files'] == ['ix_files_version_filename']
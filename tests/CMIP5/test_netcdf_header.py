@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import struct
+from ARCCSSive.CMIP5.netcdf_header import *
+from ARCCSSive.CMIP5.other_functions import get_trackid
+
+def _name(name):
+    data = name.encode()
+    return struct.pack('>i', len(data)) + data + b'\0' * (-len(data) % 4)
+
+def classic_file(path, attrs, version=1):
+    ''' Write the header of a classic NetCDF file with one dimension and global attributes '''
+    header = b'CDF' + struct.pack('>B', version) + struct.pack('>i', 0)
+    header += struct.pack('>ii', 10, 1) + _name('time') + struct.pack('>i', 0)
+    header += struct.pack('>ii', 12, len(attrs))
+    for name, value in attrs:
+        if isinstance(value, float):
+            header += _name(name) + struct.pack('>iid', 6, 1, value)
+        else:
+            header += _name(name) + struct.pack('>i', 2) + _name(value)
+    # no variables
+    header += struct.pack('>ii', 0, 0)
+    path.write_binary(header)
+    return path.strpath
+
+def test_read_header(tmpdir):
+    f = classic_file(tmpdir.join('tas.nc'), [
+        ('institution', 'CSIRO-BOM'),
+        ('tracking_id', 'a4d7a1e4-f5f4-4e5f-9d42-1d6f3c2b0e61'),
+        ('modeling_realm', 'atmos'),
+        ('version_number', 'v20120115'),
+        ('frequency', 'mon'),
+        ('forcing_level', 1.5),
+        ], version=2)
+    header = read_header(f)
+    assert header == {'tracking_id': 'a4d7a1e4-f5f4-4e5f-9d42-1d6f3c2b0e61',
+                      'version_number': 'v20120115', 'modeling_realm': 'atmos',
+                      'creation_date': None, 'frequency': 'mon'}
+    assert read_header(f, ['forcing_level']) == {'forcing_level': 1.5}
+    assert get_trackid(f) == header['tracking_id']
+
+def test_read_header_invalid(tmpdir):
+    f = tmpdir.join('bad.nc')
+    f.write_binary(b'not netcdf')
+    assert read_header(f.strpath) is None
+    assert get_trackid(f.strpath) == 'INVALID'
+    # truncated header
+    g = classic_file(tmpdir.join('g.nc'), [('tracking_id', 'x')])
+    tmpdir.join('g.nc').write_binary(open(g, 'rb').read()[:30])
+    assert read_header(g) is None
+
+def test_read_headers(tmpdir):
+    paths = [classic_file(tmpdir.join('f%d.nc'%i), [('tracking_id', 'id%d'%i)]) for i in range(6)]
+    paths.append(tmpdir.join('missing.nc').strpath)
+    headers = read_headers(paths, ['tracking_id'], workers=3)
+    assert headers == [{'tracking_id': 'id%d'%i} for i in range(6)] + [None]
@@ -87,6 +87,11 @@ def test_file_details():
     filename='thetao_Omon_CanESM2_rcp85_r2i1p1_209101-210012.nc'
     assert file_details(filename)=={'variable':"thetao",'mip':"Omon",
                'model':"CanESM2",'experiment': "rcp85", 'ensemble': "r2i1p1"}
+    # fx files have no period, extra fields are ignored
+    assert file_details('orog_fx_ACCESS1-0_historical_r0i0p0.nc')=={'variable':"orog",'mip':"fx",
+               'model':"ACCESS1-0",'experiment': "historical", 'ensemble': "r0i0p0"}
+    assert file_details('tas_Amon_m_e_r1i1p1_2000_2001_extra.nc')['ensemble']=="r1i1p1"
+    assert file_details('tas_Amon_m.nc') is None
 
 def test_unique(session):
     outs=session.outputs()
@@ -101,3 +106,81 @@ def test_unique(session):
     assert unique(outs,'variable').sort() == variables
     assert unique(outs,'mip').sort() == mips
      
+
+def test_group_by_constraints(session):
+    constraints = {'model': ['ACCESS1-3', 'MIROC5'], 'experiment': ['rcp45', 'rcp26'], 'variable': 'tas'}
+    outs = session.outputs(**constraints)
+    groups = group_by_constraints(outs, **constraints)
+    assert len(groups) == 4
+    found = dict(((c['model'], c['experiment']), [o.id for o in res]) for c, res in groups)
+    assert len(found[('ACCESS1-3', 'rcp45')]) == 1
+    assert len(found[('ACCESS1-3', 'rcp26')]) == 1
+    assert len(found[('MIROC5', 'rcp45')]) == 1
+    assert found[('MIROC5', 'rcp26')] == []
+    for c, res in groups:
+        assert c['variable'] == 'tas'
+
+def test_match_constraint():
+    assert match_constraint('experiment', 'decadal1960', 'decadal')
+    assert not match_constraint('experiment', 'historical', 'decadal')
+    assert not match_constraint('model', 'decadal1960', 'decadal')
+    assert match_constraint('model', 'MIROC5', 'MIROC5')
+
+def test_iter_tmpdir(tmpdir):
+    f = tmpdir.join('tmptree.csv')
+    # no newline after the last line
+    f.write('variable,mip_table,model,experiment,ensemble,realm,version,path\n'
+            'tas,Amon,ACCESS1-3,rcp45,r1i1p1,atmos,v20120101,/tmp/tree/a\n'
+            '\n'
+            'pr,Amon,ACCESS1-3,rcp45,r1i1p1,NA,NA,/tmp/tree/b')
+    inst = iter_tmpdir(f.strpath)
+    assert next(inst)['path'] == '/tmp/tree/a'
+    assert next(inst) == {'variable': 'pr', 'mip': 'Amon', 'model': 'ACCESS1-3', 'experiment': 'rcp45',
+                          'ensemble': 'r1i1p1', 'realm': 'NA', 'version': 'NA', 'path': '/tmp/tree/b'}
+    assert len(list_tmpdir(f.strpath)) == 2
+    f.write('variable,mip_table,model,experiment,ensemble,realm,version,path\n'
+            'tas,Amon,ACCESS1-3,rcp45,r1i1p1,/tmp/tree/a\n')
+    with pytest.raises(ValueError):
+        list_tmpdir(f.strpath)
+
+def test_iter_logfile(tmpdir):
+    f = tmpdir.join('download.log')
+    f.write('tas,Amon,ACCESS1-3,rcp45,r1i1p1,atmos,v20120101|esgfcog.ccs.ornl.gov,cmip5.x.v20120101|esgfcog.ccs.ornl.gov,/tmp/a,MD5\n'
+            'tas_1.nc,id1,sum1\n'
+            'tas_2.nc,None,None\n'
+            'pr,Amon,ACCESS1-3,rcp45,r1i1p1,atmos,v20120101,cmip5.y,/tmp/b,None\r\n'
+            'pr_1.nc,id3,sum3')
+    ds = list(iter_logfile(f.strpath))
+    assert len(ds) == 2
+    assert ds[0]['version'] == 'v20120101'
+    assert ds[0]['dataset_id'] == 'cmip5.x.v20120101|esgfcog.ccs.ornl.gov'
+    assert ds[0]['files'] == [{'filename': 'tas_1.nc', 'tracking_id': 'id1', 'checksum': 'sum1'},
+                              {'filename': 'tas_2.nc', 'tracking_id': 'None', 'checksum': 'None'}]
+    assert ds[1]['cks_type'] == 'None'
+    assert ds[1]['files'] == [{'filename': 'pr_1.nc', 'tracking_id': 'id3', 'checksum': 'sum3'}]
+    assert list_logfile(f.strpath) == ds
+    f.write('tas_1.nc,id1,sum1\n')
+    with pytest.raises(ValueError):
+        list_logfile(f.strpath)
+    f.write('tas,Amon,ACCESS1-3,rcp45,r1i1p1,atmos,v20120101,/tmp/a,MD5\n')
+    with pytest.raises(ValueError):
+        list_logfile(f.strpath)
+
+def test_read_constraint_sets(tmpdir):
+    f = tmpdir.join('sets.csv')
+    f.write('experiment,variable,model,frequency\n'
+            'rcp45,tas pr,ACCESS1-3,\n'
+            'historical,tas,,mon\n')
+    sets = read_constraint_sets(f.strpath)
+    assert sets == [{'experiment': ['rcp45'], 'variable': ['tas', 'pr'], 'model': ['ACCESS1-3']},
+                    {'experiment': ['historical'], 'variable': ['tas'], 'frequency': ['mon']}]
+    pytest.importorskip('yaml')
+    f = tmpdir.join('sets.yaml')
+    f.write('- experiment: rcp45\n'
+            '  variable: [tas, pr]\n'
+            '  model: ACCESS1-3\n'
+            '- {experiment: historical, variable: tas, frequency: mon}\n')
+    assert read_constraint_sets(f.strpath) == sets
+    f.write('- {experiment: historical, realm: atmos}\n')
+    with pytest.raises(ValueError):
+        read_constraint_sets(f.strpath)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import pytest
+pytest.importorskip('pyesgf')
+from ARCCSSive.CMIP5.pyesgf_functions import DatasetResult
+
+class FakeFile(object):
+    def __init__(self, i):
+        self.filename = 'f%d.nc'%i
+        self.tracking_id = 'id%d'%i
+        self.checksum = 'sum%d'%i
+        self.checksum_type = 'MD5'
+        self.size = i
+        self.download_url = 'http://node/f%d.nc'%i
+
+class FakeContext(object):
+    searches = 0
+    def search(self):
+        FakeContext.searches += 1
+        return iter([FakeFile(0), FakeFile(1)])
+
+class FakeDataset(object):
+    def file_context(self):
+        return FakeContext()
+
+for name in ['files', 'clear_files', 'filenames', 'tracking_ids', 'checksums', 'chksum_type', 'file_table']:
+    setattr(FakeDataset, name, DatasetResult.__dict__[name])
+
+def test_files_cached():
+    FakeContext.searches = 0
+    ds = FakeDataset()
+    assert ds.filenames() == ['f0.nc', 'f1.nc']
+    assert ds.tracking_ids() == ['id0', 'id1']
+    assert ds.checksums() == ['sum0', 'sum1']
+    assert ds.chksum_type() == 'MD5'
+    assert FakeContext.searches == 1
+    ds.clear_files()
+    ds.files()
+    ds.files(refresh=True)
+    assert FakeContext.searches == 3
+
+def test_file_table():
+    table = FakeDataset().file_table()
+    assert table['filename'] == ['f0.nc', 'f1.nc']
+    assert table['size'] == [0, 1]
+    assert table['download_url'] == ['http://node/f0.nc', 'http://node/f1.nc']
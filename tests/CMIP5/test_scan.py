@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import os
+import pytest
+from ARCCSSive import CMIP5
+from ARCCSSive.CMIP5.Model import Version, VersionFile
+from ARCCSSive.CMIP5.scan import *
+from ARCCSSive.CMIP5.ingest import ingest
+from tests.CMIP5.test_netcdf_header import classic_file
+
+def changes(root, state, **kwargs):
+    return [(c.change, os.path.relpath(c.path, root.strpath)) for c in scan(root.strpath, state, **kwargs)]
+
+def bump(path):
+    ''' Change the modification time of a directory as adding a file would '''
+    st = os.stat(path.strpath)
+    os.utime(path.strpath, (st.st_atime, st.st_mtime + 10))
+
+def test_scan(tmpdir):
+    root = tmpdir.mkdir('tree')
+    v1 = root.mkdir('tas').mkdir('v20120101')
+    v1.join('a.nc').write('a')
+    v1.join('b.nc').write('b')
+    v1.join('notes.txt').write('not tracked')
+    state = ScanState(tmpdir.join('scan.db').strpath)
+
+    assert changes(root, state) == [('added', 'tas/v20120101/a.nc'), ('added', 'tas/v20120101/b.nc')]
+    assert len(state) == 2
+    assert changes(root, state) == []
+
+    # new file and new version
+    v1.join('c.nc').write('c')
+    bump(v1)
+    v2 = root.join('tas').mkdir('v20130101')
+    v2.join('a.nc').write('a')
+    assert changes(root, state) == [('added', 'tas/v20120101/c.nc'), ('added', 'tas/v20130101/a.nc')]
+
+    # files modified in place are found only checking the files
+    v1.join('a.nc').write('new content')
+    assert changes(root, state) == []
+    assert changes(root, state, check_files=True) == [('modified', 'tas/v20120101/a.nc')]
+
+    # removed file and directory
+    v1.join('b.nc').remove()
+    bump(v1)
+    v2.remove()
+    assert sorted(changes(root, state)) == [('removed', 'tas/v20120101/b.nc'), ('removed', 'tas/v20130101/a.nc')]
+    assert len(state) == 2
+
+@pytest.mark.parametrize('use_scandir', [True, False])
+def test_scan_latest_link(tmpdir, monkeypatch, use_scandir):
+    from ARCCSSive.CMIP5 import scan as scan_module
+    if not use_scandir:
+        monkeypatch.setattr(scan_module, 'scandir', None)
+    root = tmpdir.mkdir('tree')
+    tas = root.mkdir('tas')
+    tas.mkdir('v20120101').join('a.nc').write('a')
+    tas.join('latest').mksymlinkto('v20120101')
+    # linked files are followed, linked directories are not
+    tmpdir.join('b.nc').write('b')
+    tas.join('v20120101', 'b.nc').mksymlinkto(tmpdir.join('b.nc'))
+    state = ScanState(tmpdir.join('scan.db').strpath)
+    assert changes(root, state) == [('added', 'tas/v20120101/a.nc'), ('added', 'tas/v20120101/b.nc')]
+
+def test_scan_unchanged_dirs(tmpdir, monkeypatch):
+    root = tmpdir.mkdir('tree')
+    root.mkdir('a').mkdir('v1').join('a.nc').write('a')
+    root.mkdir('b').mkdir('v1').join('b.nc').write('b')
+    state = ScanState(tmpdir.join('scan.db').strpath)
+    changes(root, state)
+
+    # only the changed directory is listed again
+    listed = []
+    from ARCCSSive.CMIP5 import scan as scan_module
+    list_dir = scan_module._list_dir
+    monkeypatch.setattr(scan_module, '_list_dir', lambda p, pattern: listed.append(p) or list_dir(p, pattern))
+    root.join('b', 'v1', 'c.nc').write('c')
+    bump(root.join('b', 'v1'))
+    assert changes(root, state) == [('added', 'b/v1/c.nc')]
+    assert listed == [root.join('b', 'v1').strpath]
+
+def test_journal_ingest(tmpdir):
+    root = tmpdir.mkdir('tree')
+    v1 = root.mkdir('tas').mkdir('v20120101')
+    for i in range(2):
+        classic_file(v1.join('tas_Amon_ACCESS1-3_rcp45_r1i1p1_%d.nc'%i), [('tracking_id', 'id%d'%i)])
+    state = ScanState(tmpdir.join('scan.db').strpath)
+    journal = tmpdir.join('journal.csv').strpath
+    assert write_journal(scan(root.strpath, state), journal) == 2
+    assert [c.change for c in read_journal(journal)] == ['added', 'added']
+
+    cmip5 = CMIP5.connect('sqlite:///:memory:')
+    ingest(cmip5.session, [journal], workers=2)
+    files = cmip5.query(VersionFile).order_by(VersionFile.filename).all()
+    assert [f.tracking_id for f in files] == ['id0', 'id1']
+    assert files[0].version.version == 'v20120101'
+    assert files[0].version.variable.variable == 'tas'
+
+    # a modified file gets the new tracking id and checksum
+    old = files[0].sha256
+    classic_file(v1.join('tas_Amon_ACCESS1-3_rcp45_r1i1p1_0.nc'), [('tracking_id', 'new')])
+    write_journal(scan(root.strpath, state, check_files=True), journal)
+    ingest(cmip5.session, [journal], workers=2)
+    cmip5.session.expire_all()
+    files = cmip5.query(VersionFile).order_by(VersionFile.filename).all()
+    assert len(files) == 2
+    assert files[0].tracking_id == 'new'
+    assert files[0].sha256 != old
+
+    # removed files are deleted, the versions left empty are kept
+    v1.join('tas_Amon_ACCESS1-3_rcp45_r1i1p1_1.nc').remove()
+    write_journal(scan(root.strpath, state), journal)
+    assert [c.change for c in read_journal(journal)] == ['removed']
+    stats, elapsed = ingest(cmip5.session, [journal], workers=2)
+    assert stats[2].removed == 1
+    assert 'removed 1 files' in stats[2].report(elapsed)
+    cmip5.session.expire_all()
+    assert [f.tracking_id for f in cmip5.query(VersionFile)] == ['new']
+    v1.join('tas_Amon_ACCESS1-3_rcp45_r1i1p1_0.nc').remove()
+    write_journal(scan(root.strpath, state), journal)
+    ingest(cmip5.session, [journal], workers=2)
+    assert cmip5.query(VersionFile).count() == 0
+    assert [v.version for v in cmip5.query(Version)] == ['v20120101']
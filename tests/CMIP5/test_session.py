@@ -18,6 +18,7 @@ limitations under the License.
 """
 
 import re
+from sqlalchemy import text
 from .db_fixture import session
 
 # Tests for the basic list queries
@@ -112,3 +113,222 @@ def test_latest(session):
     assert q[0].latest()[0].version == 'v20120101'
     # write test for inst2_id has 2 versions, oldest one has is_latest True
     assert q[1].latest()[0].version == 'v20111201'
+
+def test_latest_outputs(session):
+    """
+    Does the single query agree with Instance.latest()
+    """
+    pairs = session.latest_outputs().all()
+    found = {}
+    for o, v in pairs:
+        found.setdefault(o.id, []).append(v.id)
+    for o in session.outputs():
+        assert sorted(found.get(o.id, [])) == sorted(v.id for v in o.latest())
+
+    pairs = session.latest_outputs(mip='cfMon').all()
+    assert [v.version for o, v in pairs] == ['v20111201']
+
+def test_latest_outputs_tie():
+    """
+    Is the first of versions with the same date the first listed by Instance.latest()
+    """
+    from ARCCSSive import CMIP5
+    from ARCCSSive.CMIP5.Model import Instance, Version
+    db = CMIP5.connect('sqlite:///:memory:')
+    inst = Instance(variable='tas', mip='Amon', model='m', experiment='e', ensemble='r1i1p1')
+    for version, path in [('v20120101', 'b'), ('20130101', 'c'), ('v20130101', 'd'), ('v20130101', 'a')]:
+        inst.versions.append(Version(version=version, path=path, is_latest=False))
+    db.session.add(inst)
+    db.session.commit()
+    pairs = db.latest_outputs().all()
+    assert [v.path for o, v in pairs] == [v.path for v in inst.latest()] == ['a', 'd', 'c']
+
+    # flagged versions keep the order of Instance.versions
+    for v in inst.versions:
+        v.is_latest = v.path in ['c', 'd']
+    db.session.commit()
+    pairs = db.latest_outputs().all()
+    assert [v.path for o, v in pairs] == [v.path for v in inst.latest()] == ['c', 'd']
+
+def test_outputs_load(session):
+    """
+    Are relationships loaded together with the instances
+    """
+    from sqlalchemy import inspect
+    import pytest
+
+    session.session.expire_all()
+    outs = session.outputs(experiment='d', load='versions+files+warnings').all()
+    for o in outs:
+        assert 'versions' not in inspect(o).unloaded
+        for v in o.versions:
+            assert 'files' not in inspect(v).unloaded
+            assert 'warnings' not in inspect(v).unloaded
+
+    with pytest.raises(ValueError):
+        session.outputs(load='files')
+
+def test_outputs_lists(session):
+    """
+    Are lists of values searched in a single query
+    """
+    outs = session.outputs(variable=['a', 'tas'], experiment=['rcp45', 'rcp26'])
+    assert outs.count() == 5
+    assert outs.filter_by(model='MIROC5').count() == 3
+    assert session.outputs(model=[]).count() == 0
+    assert session.outputs(experiment=['decadal', 'd']).count() == 2
+
+def test_facets(session):
+    facets = session.facets()
+    assert facets['model'] == {'c': 2, 'ACCESS1-3': 2, 'MIROC5': 3}
+    assert sorted(facets['ensemble']) == ['e', 'r1i1p1', 'r2i1p1']
+    assert sum(facets['variable'].values()) == session.outputs().count()
+
+def test_facets_cache(tmpdir, monkeypatch):
+    """
+    Is the facet cache reused and refreshed when the database changes
+    """
+    import os
+    from ARCCSSive import CMIP5
+    from ARCCSSive.CMIP5.Model import Instance
+    monkeypatch.setenv('ARCCSSIVE_CACHE', tmpdir.join('cache').strpath)
+    dbfile = tmpdir.join('cmip5.db').strpath
+
+    cmip5 = CMIP5.connect('sqlite:///' + dbfile)
+    cmip5.session.add(Instance(variable='tas', mip='Amon', model='m1', experiment='e', ensemble='r1i1p1'))
+    cmip5.session.commit()
+    assert cmip5.models() == ['m1']
+    assert len(tmpdir.join('cache', 'facets').listdir()) == 1
+
+    # A new connection uses the cache file
+    other = CMIP5.connect('sqlite:///' + dbfile)
+    other._query_facets = None
+    assert other.models() == ['m1']
+
+    # Writing to the database invalidates the cache
+    cmip5.session.add(Instance(variable='tas', mip='Amon', model='m2', experiment='e', ensemble='r1i1p1'))
+    cmip5.session.commit()
+    assert cmip5.models() == ['m1', 'm2']
+    # also a change in the same second that doesn't change the file size
+    cmip5.session.query(Instance).filter_by(model='m2').update({'model': 'm3'})
+    cmip5.session.commit()
+    assert cmip5.models() == ['m1', 'm3']
+
+def test_facet_counts(session):
+    counts = session.facet_counts(variable=['a', 'tas'], mip='Amon')
+    assert counts['variable'] == {'a': 1, 'tas': 2}
+    assert counts['mip'] == {'6hrLev': 2, 'Amon': 3, 'cfMon': 1}
+    assert counts['model'] == {'ACCESS1-3': 2, 'MIROC5': 1}
+    assert counts['realm'] == {'realm': 3}
+    assert session.facet_counts() == session.facets()
+
+def test_complete_ensembles(tmpdir):
+    from ARCCSSive import CMIP5
+    from ARCCSSive.CMIP5.Model import Instance, Version
+    cmip5 = CMIP5.connect('sqlite:///' + tmpdir.join('cmip5.db').strpath)
+    db = cmip5.session
+    for model, ensemble, variable in [('m1', 'r1i1p1', 'tas'), ('m1', 'r1i1p1', 'pr'),
+                                      ('m1', 'r2i1p1', 'tas'), ('m2', 'r1i1p1', 'tas'),
+                                      ('m2', 'r1i1p1', 'pr'), ('m2', 'r1i1p1', 'uas')]:
+        o = Instance(variable=variable, mip='Amon', model=model, experiment='e', ensemble=ensemble)
+        db.add(o)
+        if model == 'm1':
+            o.versions = [Version(version='v1'), Version(version='v2')]
+    db.commit()
+
+    results = cmip5.complete_ensembles(['tas', 'pr']).all()
+    assert [(o.model, o.variable, v.version if v else None) for o, v in results] == [
+            ('m1', 'pr', 'v1'), ('m1', 'pr', 'v2'), ('m1', 'tas', 'v1'), ('m1', 'tas', 'v2'),
+            ('m2', 'pr', None), ('m2', 'tas', None)]
+    assert cmip5.complete_ensembles(['tas', 'pr'], model='m2').count() == 2
+    assert cmip5.complete_ensembles(['tas', 'pr', 'uas'], ensemble='r1i1p1').count() == 3
+    assert cmip5.complete_ensembles(['tas', 'hus']).count() == 0
+
+def test_connect_engine(tmpdir):
+    """
+    Are engines shared between connections to the same database
+    """
+    from ARCCSSive import CMIP5
+    from sqlalchemy import inspect
+
+    url = 'sqlite:///' + tmpdir.join('cmip5.db').strpath
+    a = CMIP5.connect(url, create=False)
+    assert inspect(a.session.get_bind()).get_table_names() == []
+    b = CMIP5.connect(url)
+    assert a.session.get_bind() is b.session.get_bind()
+    assert a.session is not b.session
+    assert 'instances' in inspect(b.session.get_bind()).get_table_names()
+
+    # Sessions don't share a connection, a commit in one doesn't commit the other's work
+    from ARCCSSive.CMIP5.Model import Instance
+    a.session.add(Instance(variable='tas', mip='Amon', model='m1', experiment='e', ensemble='r1i1p1'))
+    a.session.flush()
+    b.session.commit()
+    a.session.rollback()
+    assert b.session.query(Instance).count() == 0
+
+    c = CMIP5.connect('sqlite:///:memory:')
+    d = CMIP5.connect('sqlite:///:memory:')
+    assert c.session.get_bind() is not d.session.get_bind()
+
+def test_connect_readonly(tmpdir):
+    from ARCCSSive import CMIP5
+    from ARCCSSive.CMIP5.Model import Instance
+    from sqlalchemy.exc import OperationalError
+    import pytest
+
+    url = 'sqlite:///' + tmpdir.join('cmip5.db').strpath
+    rw = CMIP5.connect(url)
+    rw.session.add(Instance(variable='tas', mip='Amon', model='m1', experiment='e', ensemble='r1i1p1'))
+    rw.session.commit()
+
+    ro = CMIP5.connect(url, readonly=True)
+    assert ro.session.get_bind() is not rw.session.get_bind()
+    assert ro.models() == ['m1']
+    assert ro.session.execute(text('PRAGMA query_only')).scalar() == 1
+
+    ro.session.add(Instance(variable='pr', mip='Amon', model='m1', experiment='e', ensemble='r1i1p1'))
+    with pytest.raises(OperationalError):
+        ro.session.commit()
+    ro.session.rollback()
+
+    with pytest.raises(ValueError):
+        CMIP5.connect('sqlite:///:memory:', readonly=True)
+
+def test_local_snapshot(tmpdir):
+    import os
+    from ARCCSSive import CMIP5
+    from ARCCSSive.CMIP5.DB import local_snapshot
+    from ARCCSSive.CMIP5.Model import Instance
+
+    dbfile = tmpdir.join('cmip5.db').strpath
+    localdir = tmpdir.join('local').strpath
+    rw = CMIP5.connect('sqlite:///' + dbfile)
+    rw.session.add(Instance(variable='tas', mip='Amon', model='m1', experiment='e', ensemble='r1i1p1'))
+    rw.session.commit()
+
+    local = local_snapshot(dbfile, localdir)
+    assert os.path.dirname(local) == localdir
+    # Reused while the source is unchanged
+    assert local_snapshot(dbfile, localdir) == local
+    assert CMIP5.connect('sqlite:///' + dbfile, snapshot=localdir).models() == ['m1']
+
+    # Refreshed when it changes
+    rw.session.add(Instance(variable='tas', mip='Amon', model='m2', experiment='e', ensemble='r1i1p1'))
+    rw.session.commit()
+    new = local_snapshot(dbfile, localdir)
+    assert new != local
+    assert os.listdir(localdir) == [os.path.basename(new)]
+    assert CMIP5.connect('sqlite:///' + dbfile, snapshot=localdir).models() == ['m1', 'm2']
+    # The engine of the old snapshot was replaced
+    from ARCCSSive.CMIP5.DB import _engines
+    assert [e[0] for k, e in _engines.items() if k == ('snapshot', dbfile)] == ['sqlite:///' + new]
+
+    # Transactions still in the write-ahead log are copied
+    from sqlalchemy import text
+    wal = CMIP5.connect('sqlite:///' + dbfile)
+    wal.session.execute(text('PRAGMA journal_mode=WAL'))
+    wal.session.add(Instance(variable='tas', mip='Amon', model='m3', experiment='e', ensemble='r1i1p1'))
+    wal.session.commit()
+    assert os.path.getsize(dbfile + '-wal') > 0
+    assert CMIP5.connect('sqlite:///' + dbfile, snapshot=localdir).models() == ['m1', 'm2', 'm3']
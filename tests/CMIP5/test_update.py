@@ -56,3 +56,37 @@ def test_add_bulk_items(session):
     add_bulk_items(db,VersionFile,rows)
     num2=session.query(VersionFile).filter(VersionFile.version_id==vid).count() 
     assert num2==num1+4
+
+def test_bulk_upsert(session):
+    db=session.session
+    vid=2
+    num1=session.query(VersionFile).filter(VersionFile.version_id==vid).count() 
+    rows=[dict(filename='b%s.nc'%i, md5='x%s'%i, version_id=vid) for i in range(7)]
+    ids=bulk_upsert(db,VersionFile,rows,['version_id','filename'],batch_size=3)
+    assert len(ids)==7
+    assert None not in ids
+    num2=session.query(VersionFile).filter(VersionFile.version_id==vid).count() 
+    assert num2==num1+7
+    # existing rows are not added again, new and repeated ones only once
+    rows.extend([dict(filename='b8.nc', md5='y', version_id=vid)]*2)
+    ids2=bulk_upsert(db,VersionFile,rows,['version_id','filename'])
+    assert ids2[:7]==ids
+    assert ids2[7]==ids2[8]
+    assert session.query(VersionFile).filter(VersionFile.version_id==vid).count()==num2+1
+
+def test_bulk_upsert_unique(session):
+    db=session.session
+    kwargs={'variable': 'a', 'mip': '6hrLev', 'model': 'c',
+            'experiment': 'd', 'ensemble': 'e','realm':  'realm'}
+    new={'variable': 'a3', 'mip': '6hrLev', 'model': 'c',
+            'experiment': 'd', 'ensemble': 'e','realm':  'realm'}
+    ids=bulk_upsert(db,Instance,[kwargs,new],['variable','experiment','mip','model','ensemble'])
+    assert ids[0]==1
+    assert search_item(db,Instance,**new).id==ids[1]
+
+def test_bulk_upsert_null_key(session):
+    db=session.session
+    rows=[dict(instance_id=1, version='v20990101', path=None), dict(instance_id=1, version='v20990102', path='/p')]
+    ids=bulk_upsert(db,Version,rows,['instance_id','version','path'])
+    assert bulk_upsert(db,Version,rows,['instance_id','version','path'])==ids
+    assert session.query(Version).filter(Version.version.in_(['v20990101','v20990102'])).count()==2
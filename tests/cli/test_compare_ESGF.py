@@ -15,6 +15,9 @@
 # limitations under the License.
 from __future__ import print_function
 from ARCCSSive.cli.compare_ESGF import *
+from ARCCSSive import CMIP5
+from ARCCSSive.CMIP5.Model import Instance, Version
+from tests.CMIP5.esgf_server import esgf_server
 import mock
 
 def sample_query_yes_no(answer, value):
@@ -31,3 +34,54 @@ def test_query_yes_no():
     sample_query_yes_no("n", False)
     sample_query_yes_no("no", False)
     sample_query_yes_no("nO", False)
+
+def test_run_batch(tmpdir, monkeypatch, esgf_server):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv('USER', 'tester')
+    outdir = tmpdir.mkdir('requests').strpath + '/'
+    cmip5 = CMIP5.connect('sqlite:///:memory:')
+    cmip5.session.add(Version(version='v20120101', path=tmpdir.strpath,
+                              variable=Instance(variable='tas', mip='Amon', model='MIROC-ESM',
+                                                experiment='rcp45', ensemble='r1i1p1')))
+    cmip5.session.commit()
+
+    sets = [{'experiment': ['rcp45'], 'variable': ['tas'], 'mip': ['Amon'], 'model': ['MIROC-ESM']},
+            {'experiment': ['historical'], 'variable': ['tas']}]
+    searchargs = {'node': esgf_server.url, 'distrib': False}
+    fetchargs = {'workers': 2, 'rate': None, 'retries': 0}
+    summary = run_batch(cmip5, sets, True, searchargs, fetchargs, submit=True, outdir=outdir)
+
+    assert [(s['experiment'], s['status']) for s in summary] == [('rcp45', 'compared'), ('historical', 'not on ESGF')]
+    assert (summary[0]['local_versions'], summary[0]['remote_datasets']) == (1, 3)
+    # new files of the other ensembles and the files missing from the local version
+    assert (summary[0]['new_files'], summary[0]['update_files']) == (4, 2)
+    assert cmip5.query(Version).one().is_latest
+    requests = [f.basename for f in tmpdir.listdir() if f.basename.startswith('request_')]
+    assert len(requests) == 1 and tmpdir.join('requests', requests[0]).check()
+    assert len(tmpdir.join(requests[0]).readlines()) == 4
+    assert len([f for f in tmpdir.listdir() if f.basename.startswith('summary_')]) == 1
+    assert tmpdir.join('rcp45.csv').check()
+
+def test_run_batch_version(tmpdir, monkeypatch, esgf_server):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv('USER', 'tester')
+    cmip5 = CMIP5.connect('sqlite:///:memory:')
+    cmip5.session.add(Version(version='v20120101', path=tmpdir.strpath,
+                              variable=Instance(variable='tas', mip='Amon', model='MIROC-ESM',
+                                                experiment='rcp45', ensemble='r1i1p1')))
+    cmip5.session.commit()
+
+    batch = tmpdir.join('sets.csv')
+    batch.write('experiment,variable,model,version\n'
+                'rcp45,tas,MIROC-ESM,v20120101\n'
+                'rcp45,tas,MIROC-ESM,v20130101\n')
+    searchargs = {'node': esgf_server.url, 'distrib': False}
+    fetchargs = {'workers': 2, 'rate': None, 'retries': 0}
+    summary = run_batch(cmip5, read_constraint_sets(batch.strpath), True, searchargs, fetchargs,
+                        compare=False, outdir=tmpdir.strpath + '/')
+
+    # versions select the local and remote versions, they aren't instance constraints
+    assert [(s['version'], s['local_versions'], s['status']) for s in summary] == [
+        ('v20120101', 1, 'not compared'), ('v20130101', 0, 'not on ESGF')]
+    summaries = [f for f in tmpdir.listdir() if f.basename.startswith('summary_')]
+    assert summaries[0].readlines()[0].startswith('experiment,model,version,variables')